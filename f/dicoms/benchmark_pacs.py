@@ -0,0 +1,308 @@
+import json
+import resource
+import shutil
+import socket
+import tempfile
+import time
+import tracemalloc
+import uuid
+from datetime import datetime
+from multiprocessing import Pipe, get_context
+import psycopg2
+from pynetdicom import AE
+from pynetdicom.sop_class import (
+    PatientRootQueryRetrieveInformationModelFind,
+    StudyRootQueryRetrieveInformationModelFind
+)
+import wmill
+import f.dicoms.download_series as download
+import f.dicoms.series_locations as series_locations
+from f.dicoms.cfind_engine import CFindEngine
+from f.dicoms.mock_pacs import MOCK_AET, build_catalog, start_mock_pacs, stop_mock_pacs
+from f.dicoms.pacs_queries import plan_patient_queries, query_patients, query_studies, query_study_series
+
+db_credentials = json.loads(wmill.get_variable("f/kobo/vultr_db"))
+db_credentials = db_credentials["db_settings"]
+
+STAGES = ('patients', 'studies', 'series', 'download')
+
+# download_series indexes what it writes; the download stage keeps that index here
+SCRATCH_SCHEMA = 'pacs_benchmark'
+
+
+def connect():
+    return psycopg2.connect(
+        dbname=db_credentials['dbname'],
+        user=db_credentials['username'],
+        password=db_credentials['password'],
+        host=db_credentials['host'],
+        port=db_credentials['port']
+    )
+
+
+def ensure_benchmark_table(conn):
+    """Create the benchmark results table if it is missing."""
+    with conn.cursor() as cur:
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS fieldsite.pacs_benchmark_runs (
+                id BIGSERIAL PRIMARY KEY,
+                run_id TEXT NOT NULL,
+                stage TEXT NOT NULL,
+                params JSONB NOT NULL,
+                items INTEGER NOT NULL,
+                seconds DOUBLE PRECISION NOT NULL,
+                items_per_s DOUBLE PRECISION,
+                mb_per_s DOUBLE PRECISION,
+                peak_rss_mb DOUBLE PRECISION,
+                peak_traced_mb DOUBLE PRECISION,
+                report JSONB,
+                created_at TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP
+            );
+            CREATE INDEX IF NOT EXISTS pacs_benchmark_runs_stage_idx
+                ON fieldsite.pacs_benchmark_runs (stage, created_at);
+        """)
+    conn.commit()
+
+
+def peak_rss_mb():
+    # ru_maxrss is in KiB on Linux
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def run_stage_process(run_stage, trace_allocations):
+    """Run one stage in a forked child process and return its result.
+
+    ru_maxrss is the peak over a process's whole lifetime, so every stage
+    gets a process of its own for its peak RSS to be its own. The parent
+    only holds the catalog, so each child starts from the same baseline.
+    """
+    receiver, sender = Pipe(duplex=False)
+
+    def target():
+        try:
+            if trace_allocations:
+                tracemalloc.start()
+            result = run_stage()
+            result["peak_rss_mb"] = peak_rss_mb()
+            if trace_allocations:
+                result["peak_traced_mb"] = round(tracemalloc.get_traced_memory()[1] / 1e6, 1)
+            sender.send(result)
+        except BaseException as e:
+            sender.send({"error": f"{type(e).__name__}: {e}"})
+            raise
+
+    process = get_context('fork').Process(target=target)
+    process.start()
+    sender.close()
+    try:
+        result = receiver.recv()
+    except EOFError:
+        result = {"error": f"stage process exited with code {process.exitcode}"}
+    process.join()
+    if "error" in result:
+        raise RuntimeError(result["error"])
+    return result
+
+
+def run_cfind_stage(port, concurrency, items, query):
+    """Run one level's C-FINDs on the engine, the way the db_insert_* scripts do, and count the rows."""
+    ae = AE()
+    ae.add_requested_context(PatientRootQueryRetrieveInformationModelFind)
+    ae.add_requested_context(StudyRootQueryRetrieveInformationModelFind)
+    engine = CFindEngine(ae, '127.0.0.1', port, MOCK_AET, concurrency=concurrency)
+    rows = 0
+    failed = 0
+    started = time.monotonic()
+    for _, found, error in engine.run(items, query):
+        if error is not None:
+            failed += 1
+        rows += len(found)
+    seconds = time.monotonic() - started
+    return {
+        "items": len(items),
+        "seconds": seconds,
+        "items_per_s": len(items) / seconds if seconds else None,
+        "report": {"rows": rows, "queries_failed": failed, "cfind": engine.report()},
+    }
+
+
+def run_download_stage(port, catalog, series_count, async_writes):
+    """Retrieve series with download_series over one pooled association into a scratch directory.
+
+    Runs in its own process with its own connection. The series location
+    index goes to SCRATCH_SCHEMA, which is dropped afterwards, so nothing
+    is written to fieldsite.
+    """
+    download.storage_dir = tempfile.mkdtemp(prefix='benchmark_pacs_')
+    download.write_mode = 'files'
+    download.transfer_totals.update(bytes=0, instances=0, skipped=0)
+    if async_writes:
+        download.store_writer = download.StoreWriter()
+    conn = connect()
+    with conn.cursor() as cur:
+        cur.execute(f"CREATE SCHEMA IF NOT EXISTS {SCRATCH_SCHEMA}")
+    conn.commit()
+    series_locations.locations_schema = SCRATCH_SCHEMA
+    series_locations.ensure_locations_table(conn)
+    ae = download.setup_ae()
+    assoc_pool = download.PooledAssociation(ae, '127.0.0.1', port, MOCK_AET)
+    series = catalog["series"][:series_count] if series_count else catalog["series"]
+    failed = 0
+    started = time.monotonic()
+    try:
+        for record in series:
+            try:
+                download.download_series(
+                    ae, '127.0.0.1', port, MOCK_AET, 'BENCHMARK',
+                    record["PatientID"], record["StudyInstanceUID"], record["SeriesInstanceUID"],
+                    record["SeriesDescription"], conn, assoc_pool=assoc_pool
+                )
+            except Exception as e:
+                print(f"Download of {record['SeriesInstanceUID']} failed: {e}")
+                failed += 1
+        seconds = time.monotonic() - started
+    finally:
+        assoc_pool.close()
+        if download.store_writer is not None:
+            download.store_writer.close()
+            download.store_writer = None
+        shutil.rmtree(download.storage_dir, ignore_errors=True)
+        conn.rollback()
+        with conn.cursor() as cur:
+            cur.execute(f"DROP SCHEMA IF EXISTS {SCRATCH_SCHEMA} CASCADE")
+        conn.commit()
+        conn.close()
+
+    images = download.transfer_totals["instances"]
+    return {
+        "items": images,
+        "seconds": seconds,
+        "items_per_s": images / seconds if seconds else None,
+        "mb_per_s": download.transfer_totals["bytes"] / 1e6 / seconds if seconds else None,
+        "report": {"series": len(series), "series_failed": failed,
+                   "expected_images": len(series) * catalog["images_per_series"]},
+    }
+
+
+def previous_run(conn, stage, params):
+    """Throughput of the last run of a stage with the same parameters, None if there is none."""
+    with conn.cursor() as cur:
+        cur.execute("""
+            SELECT items_per_s
+            FROM fieldsite.pacs_benchmark_runs
+            WHERE stage = %s AND params = %s::jsonb
+            ORDER BY created_at DESC
+            LIMIT 1
+        """, (stage, json.dumps(params)))
+        row = cur.fetchone()
+    conn.commit()
+    return row[0] if row else None
+
+
+def main(
+        stages: list = ['patients', 'studies', 'series', 'download'],
+        num_patients: int = 20,
+        studies_per_patient: int = 2,
+        series_per_study: int = 4,
+        images_per_series: int = 100,
+        image_rows: int = 512,
+        image_columns: int = 512,
+        latency_ms: int = 20,
+        concurrency: int = 4,
+        download_series_count: int = 10,
+        async_writes: bool = False,
+        trace_allocations: bool = False,
+        regression_threshold: float = 0.2,
+):
+    """Benchmark the PACS scripts against a local mock PACS seeded with synthetic CT and MR series.
+
+    The mock answers every C-FIND and C-GET after `latency_ms`, from its own
+    process. The patients, studies and series stages run each level's C-FINDs
+    on the C-FIND engine with `concurrency` associations, the way the
+    db_insert_* scripts do, and report queries/s. The download stage
+    retrieves `download_series_count` series (0 for all) with download_series
+    over one pooled association and reports images/s and MB/s. Each stage
+    runs in a process of its own, so the peak RSS reported is the stage's;
+    `trace_allocations` adds the Python allocation peak at the cost of
+    slower runs.
+
+    Results are kept in fieldsite.pacs_benchmark_runs. A stage more than
+    `regression_threshold` slower than the last run with the same
+    parameters is reported as a regression.
+    """
+    unknown = set(stages) - set(STAGES)
+    if unknown:
+        raise ValueError(f"Unknown stages: {sorted(unknown)}")
+
+    catalog_options = {
+        "num_patients": num_patients,
+        "studies_per_patient": studies_per_patient,
+        "series_per_study": series_per_study,
+        "images_per_series": images_per_series,
+    }
+    params = dict(catalog_options, image_rows=image_rows, image_columns=image_columns, latency_ms=latency_ms,
+                  concurrency=concurrency, download_series_count=download_series_count,
+                  async_writes=async_writes, trace_allocations=trace_allocations)
+    catalog = build_catalog(**catalog_options)
+    run_id = f"{socket.gethostname()}:{datetime.now().strftime('%Y%m%d%H%M%S')}:{uuid.uuid4().hex[:8]}"
+
+    conn = connect()
+    process, port = start_mock_pacs(catalog_options, latency_ms, image_rows, image_columns)
+    print(f"Mock PACS on port {port}: {len(catalog['patients'])} patients, {len(catalog['studies'])} studies, "
+          f"{len(catalog['series'])} series of {images_per_series} images")
+
+    results = []
+    regressions = []
+    try:
+        ensure_benchmark_table(conn)
+        for stage in STAGES:
+            if stage not in stages:
+                continue
+
+            if stage == 'patients':
+                run_stage = lambda: run_cfind_stage(port, concurrency, plan_patient_queries([]),
+                                                    lambda assoc, query: query_patients(assoc, *query))
+            elif stage == 'studies':
+                run_stage = lambda: run_cfind_stage(port, concurrency,
+                                                    [patient["PatientID"] for patient in catalog["patients"]],
+                                                    lambda assoc, patient_id: query_studies(assoc, patient_id))
+            elif stage == 'series':
+                studies = [(study["StudyInstanceUID"], study["StudyID"]) for study in catalog["studies"]]
+                run_stage = lambda: run_cfind_stage(port, concurrency, studies,
+                                                    lambda assoc, study: query_study_series(assoc, *study))
+            else:
+                run_stage = lambda: run_download_stage(port, catalog, download_series_count, async_writes)
+
+            result = run_stage_process(run_stage, trace_allocations)
+            result["stage"] = stage
+
+            baseline = previous_run(conn, stage, params)
+            if baseline and result["items_per_s"] is not None \
+                    and result["items_per_s"] < baseline * (1 - regression_threshold):
+                regressions.append({"stage": stage, "items_per_s": round(result["items_per_s"], 2),
+                                    "previous_items_per_s": round(baseline, 2)})
+
+            with conn.cursor() as cur:
+                cur.execute("""
+                    INSERT INTO fieldsite.pacs_benchmark_runs
+                        (run_id, stage, params, items, seconds, items_per_s, mb_per_s, peak_rss_mb, peak_traced_mb,
+                         report)
+                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+                """, (run_id, stage, json.dumps(params), result["items"], result["seconds"], result["items_per_s"],
+                      result.get("mb_per_s"), result["peak_rss_mb"], result.get("peak_traced_mb"),
+                      json.dumps(result["report"])))
+            conn.commit()
+
+            for key in ("seconds", "items_per_s", "mb_per_s"):
+                if result.get(key) is not None:
+                    result[key] = round(result[key], 2)
+            print(f"{stage}: {result}")
+            results.append(result)
+    finally:
+        stop_mock_pacs(process)
+        conn.close()
+
+    for regression in regressions:
+        print(f"Regression in {regression['stage']}: {regression['items_per_s']}/s, "
+              f"previously {regression['previous_items_per_s']}/s")
+    return {"run_id": run_id, "stages": results, "regressions": regressions}
@@ -0,0 +1,160 @@
+import json
+import heapq
+from datetime import datetime, timedelta
+import psycopg2
+import wmill
+
+db_credentials = json.loads(wmill.get_variable("f/kobo/vultr_db"))
+db_credentials = db_credentials["db_settings"]
+
+# Python equivalents of download_series.SCHEDULING_POLICIES. Each key sorts
+# ascending over the snapshot rows built in load_snapshot.
+NEWEST = lambda row: -row["timestamp"]
+
+POLICY_KEYS = {
+    'uid': lambda row: row["uid"],
+    'newest_first': lambda row: (NEWEST(row), row["uid"]),
+    'smallest_first': lambda row: (row["images"], row["uid"]),
+    'patient_round_robin': lambda row: (row["patient_rank"], NEWEST(row), row["uid"]),
+    'priority': lambda row: (-row["priority"], NEWEST(row), row["uid"]),
+}
+
+
+def parse_series_datetime(value):
+    """series_datetime holds either a timestamp or the raw 'YYYYMMDD HHMMSS' string from the PACS."""
+    if value is None:
+        return None
+    if isinstance(value, datetime):
+        return value
+    for fmt in ("%Y%m%d %H%M%S.%f", "%Y%m%d %H%M%S", "%Y%m%d"):
+        try:
+            return datetime.strptime(str(value).strip(), fmt)
+        except ValueError:
+            continue
+    return None
+
+
+def load_snapshot(conn, only_pending):
+    """Read the series queue from fieldsite.series into plain dicts."""
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT
+            s.seriesinstanceuid,
+            st.patient_id,
+            s.series_datetime,
+            s.numberofimages,
+            COALESCE(s.download_priority, 0)
+        FROM fieldsite.series s
+        JOIN fieldsite.studies st ON s.studyinstanceuid = st.studyinstanceuid
+        WHERE NOT %s
+           OR s.download_status IS NULL OR s.download_status = '' OR s.download_status = 'failed'
+    """, (only_pending,))
+    rows = []
+    for uid, patient_id, series_datetime, images, priority in cur.fetchall():
+        acquired = parse_series_datetime(series_datetime)
+        rows.append({
+            "uid": uid,
+            "patient_id": patient_id,
+            "acquired": acquired,
+            # NULLS LAST for newest first
+            "timestamp": acquired.timestamp() if acquired else float('-inf'),
+            "images": int(images) if images is not None else float('inf'),
+            "priority": priority,
+        })
+    cur.close()
+
+    # Rank of each series within its patient, newest first, for round robin
+    by_patient = {}
+    for row in rows:
+        by_patient.setdefault(row["patient_id"], []).append(row)
+    for patient_rows in by_patient.values():
+        patient_rows.sort(key=NEWEST)
+        for rank, row in enumerate(patient_rows, start=1):
+            row["patient_rank"] = rank
+    return rows
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+def simulate(rows, policy, num_workers, seconds_per_image, seconds_per_series, urgent_since):
+    """Replay the queue with `num_workers` workers each taking the next series in policy order.
+
+    A series takes seconds_per_series plus seconds_per_image per image. All
+    series are assumed queued at t=0, so a series' completion time is its
+    latency.
+    """
+    queue = sorted(rows, key=POLICY_KEYS[policy])
+    workers = [0.0] * num_workers
+    heapq.heapify(workers)
+
+    completions = []
+    urgent_completions = []
+    patient_first = {}
+    for row in queue:
+        start = heapq.heappop(workers)
+        images = row["images"] if row["images"] != float('inf') else 0
+        finish = start + seconds_per_series + images * seconds_per_image
+        heapq.heappush(workers, finish)
+
+        completions.append(finish)
+        if urgent_since and row["acquired"] and row["acquired"] >= urgent_since:
+            urgent_completions.append(finish)
+        patient_first.setdefault(row["patient_id"], finish)
+
+    minutes = lambda seconds: round(seconds / 60, 1) if seconds is not None else None
+    first_per_patient = list(patient_first.values())
+    return {
+        "policy": policy,
+        "makespan_min": minutes(max(completions) if completions else 0),
+        "p50_latency_min": minutes(percentile(completions, 0.5)),
+        "p95_latency_min": minutes(percentile(completions, 0.95)),
+        "urgent_series": len(urgent_completions),
+        "urgent_p95_latency_min": minutes(percentile(urgent_completions, 0.95)),
+        "urgent_max_latency_min": minutes(max(urgent_completions) if urgent_completions else None),
+        "patient_first_series_p95_min": minutes(percentile(first_per_patient, 0.95)),
+        "patient_first_series_max_min": minutes(max(first_per_patient) if first_per_patient else None),
+    }
+
+
+def main(
+        num_workers: int = 3,
+        seconds_per_image: float = 0.25,
+        seconds_per_series: float = 5.0,
+        urgent_days: int = 2,
+        only_pending: bool = False,
+):
+    """Compare download scheduling policies on a snapshot of fieldsite.series.
+
+    Returns one row per policy with the overall makespan, series latency
+    percentiles, latency of series acquired in the last `urgent_days` days and
+    how long patients wait for their first series.
+    """
+    conn = psycopg2.connect(
+        dbname=db_credentials['dbname'],
+        user=db_credentials['username'],
+        password=db_credentials['password'],
+        host=db_credentials['host'],
+        port=db_credentials['port']
+    )
+    try:
+        rows = load_snapshot(conn, only_pending)
+    finally:
+        conn.close()
+
+    print(f"Simulating {len(rows)} series with {num_workers} workers")
+    acquired = [row["acquired"] for row in rows if row["acquired"]]
+    urgent_since = None
+    if acquired:
+        urgent_since = max(acquired) - timedelta(days=urgent_days)
+
+    results = []
+    for policy in POLICY_KEYS:
+        result = simulate(rows, policy, num_workers, seconds_per_image, seconds_per_series, urgent_since)
+        print(result)
+        results.append(result)
+    return results
@@ -0,0 +1,181 @@
+import queue
+import threading
+import time
+from f.dicoms.pacs_retry import PacsError, RetryPolicy, classify_association, run_with_retry
+
+# Concurrent C-FIND queries over a small pool of persistent associations,
+# shared by the metadata scripts. Imported with
+# `from f.dicoms.cfind_engine import CFindEngine`.
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of a list of numbers."""
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+# Tells an engine thread there is no more work
+_DONE = object()
+
+
+class _Session:
+    """One persistent association, owned by a single engine thread."""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.assoc = None
+        self.requests = 0
+        self.slot_holder = None
+
+    def acquire(self):
+        engine = self.engine
+        if self.assoc is not None and self.assoc.is_established:
+            if not engine.max_requests_per_association or self.requests < engine.max_requests_per_association:
+                self.requests += 1
+                return self.assoc
+        self.close()
+
+        if engine.pacs_slots is not None:
+            self.slot_holder = engine.pacs_slots.acquire()
+        assoc = engine.ae.associate(engine.pacs_address, engine.pacs_port, ae_title=engine.called_aet)
+        if not assoc.is_established:
+            self.close()
+            raise PacsError(classify_association(assoc), "association rejected, aborted or never connected")
+        with engine.lock:
+            engine.associations_opened += 1
+        self.assoc = assoc
+        self.requests = 1
+        return assoc
+
+    def close(self):
+        if self.assoc is not None and self.assoc.is_established:
+            self.assoc.release()
+        self.assoc = None
+        self.requests = 0
+        if self.slot_holder is not None:
+            self.engine.pacs_slots.release(self.slot_holder)
+            self.slot_holder = None
+
+
+class CFindEngine:
+    """Run C-FIND queries concurrently over a small pool of persistent associations.
+
+    `concurrency` threads each keep one association open and issue their
+    queries on it one after another, reconnecting when the PACS drops it and
+    retrying retryable errors with `retry_policy`. With `pacs_slots` every
+    open association holds one of the shared PACS slots.
+
+    Results are handed back through a bounded queue, so the threads stall
+    rather than pile up results when the caller is slow to consume them.
+    """
+
+    def __init__(self, ae, pacs_address, pacs_port, called_aet, concurrency=4,
+                 retry_policy=None, breaker=None, pacs_slots=None, max_requests_per_association=0):
+        self.ae = ae
+        self.pacs_address = pacs_address
+        self.pacs_port = pacs_port
+        self.called_aet = called_aet
+        self.concurrency = max(1, concurrency)
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.breaker = breaker
+        self.pacs_slots = pacs_slots
+        self.max_requests_per_association = max_requests_per_association
+        self.lock = threading.Lock()
+        self.associations_opened = 0
+        # (description, seconds) of every query that succeeded
+        self.latencies = []
+        self.failed = 0
+
+    def submit(self, item):
+        """Queue one more item while run() is being iterated, e.g. a follow-up query built from a result."""
+        self.pending += 1
+        self.work.put(item)
+
+    def run(self, items, query, describe=str):
+        """Call `query(assoc, item)` for every item and yield (item, rows, error) as queries finish.
+
+        Results come back in completion order. `error` is None on success,
+        otherwise the exception the query gave up with and `rows` is empty.
+        Items passed to submit() while iterating are run as well, and the
+        iteration ends once every item has a result.
+        """
+        self.work = queue.Queue()
+        self.pending = 0
+        for item in items:
+            self.submit(item)
+        if not self.pending:
+            return
+        work = self.work
+        results = queue.Queue(maxsize=self.concurrency * 2)
+        stop = threading.Event()
+
+        def worker():
+            session = _Session(self)
+            try:
+                while True:
+                    item = work.get()
+                    if item is _DONE or stop.is_set():
+                        return
+                    timing = {}
+
+                    def attempt():
+                        assoc = session.acquire()
+                        started = time.monotonic()
+                        try:
+                            rows = query(assoc, item)
+                        except Exception:
+                            session.close()
+                            raise
+                        timing["seconds"] = time.monotonic() - started
+                        return rows
+
+                    try:
+                        rows = run_with_retry(attempt, self.retry_policy, self.breaker, f"C-FIND for {describe(item)}")
+                    except Exception as e:
+                        with self.lock:
+                            self.failed += 1
+                        results.put((item, [], e))
+                        continue
+                    with self.lock:
+                        self.latencies.append((describe(item), timing["seconds"]))
+                    results.put((item, rows, None))
+            finally:
+                session.close()
+
+        threads = [threading.Thread(target=worker, daemon=True) for _ in range(self.concurrency)]
+        for thread in threads:
+            thread.start()
+
+        try:
+            while self.pending:
+                result = results.get()
+                self.pending -= 1
+                yield result
+        finally:
+            # Also reached when the caller stops early, unblock the threads and let them release their associations
+            stop.set()
+            for _ in threads:
+                work.put(_DONE)
+            while any(thread.is_alive() for thread in threads):
+                try:
+                    results.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+
+    def report(self, slowest=5):
+        """Per-query latency summary, for inclusion in a job result."""
+        seconds = [latency for _, latency in self.latencies]
+        ms = lambda value: round(value * 1000) if value is not None else None
+        return {
+            "queries": len(seconds),
+            "queries_failed": self.failed,
+            "concurrency": self.concurrency,
+            "associations_opened": self.associations_opened,
+            "latency_p50_ms": ms(percentile(seconds, 0.5) if seconds else None),
+            "latency_p95_ms": ms(percentile(seconds, 0.95) if seconds else None),
+            "latency_max_ms": ms(max(seconds) if seconds else None),
+            "slowest": [
+                {"query": description, "ms": ms(latency)}
+                for description, latency in sorted(self.latencies, key=lambda entry: entry[1], reverse=True)[:slowest]
+            ],
+        }
@@ -2,9 +2,13 @@ import json
 import wmill
 import psycopg2
 import os
-import glob
-import zipfile
+import time
 import shutil
+from multiprocessing import Pool
+from f.dicoms.series_locations import ARCHIVED, DOWNLOADED, ensure_locations_table, ensure_short_uid_column, locate_series, record_location
+from f.dicoms.series_manifest import ensure_manifest_table, load_manifest, verify_archive
+from f.dicoms.series_status import StatusWriter
+from f.dicoms.series_compression import check_codec, compress_directory
 
 db_credentials = json.loads(wmill.get_variable("f/kobo/vultr_db"))
 db_credentials = db_credentials["db_settings"]
@@ -18,21 +22,25 @@ conn = psycopg2.connect(
     port=db_credentials['port']
 )
 cur = conn.cursor()
+ensure_locations_table(conn)
+ensure_short_uid_column(conn)
+ensure_manifest_table(conn)
 
 # Query all series with download status 'complete' grouped by seriesdescription
 cur.execute("""
     select
         st.patient_id,
         s.seriesdescription,
-        (
-            select string_agg(value, '.' order by idx)
-            from unnest(string_to_array(s.seriesinstanceuid, '.')) with ordinality as t(value, idx)
-            where idx > 6
-        ) as seriesuid
+        s.short_uid as seriesuid,
+        s.seriesinstanceuid,
+        sl.relpath,
+        sl.state
     from
         fieldsite.series s
     join fieldsite.studies st on
         s.studyid = st.studyid
+    left join fieldsite.series_locations sl on
+        sl.seriesinstanceuid = s.seriesinstanceuid
     where
         s.validation = 'complete'
         and (s.compression_status = ''
@@ -44,33 +52,80 @@ cur.execute("""
 series_list = cur.fetchall()
 compression_report = []
 
-def update_validation_status(patient_id, seriesuid, status):
-    """Update the validation status in the PostgreSQL database."""
-    print("About to update", status, seriesuid, patient_id)
-    cur.execute("""
-        UPDATE fieldsite.series
-        SET compression_status = %s, date_modified = CURRENT_TIMESTAMP
-        WHERE seriesinstanceuid LIKE %s AND studyid IN (
-            SELECT studyid FROM fieldsite.studies
-            WHERE patient_id = %s
-        )
-    """, (status, f"%{seriesuid}", patient_id))
-    conn.commit()
-        
+# Written in batches on the full SeriesInstanceUID
+status_writer = StatusWriter(conn, ['compression_status'])
+
+def update_compression_status(seriesinstanceuid, status):
+    """Queue the compression status of a series."""
+    print("About to update", status, seriesinstanceuid)
+    status_writer.add(seriesinstanceuid, status)
+
+
+def finish_compression(result, fullseriesuid, inprogress_dir, report):
+    """Check a new zip against the series manifest, then delete the source directory and record the archive."""
+    report.update(result)
+    if result["error"] is not None:
+        print(f"Compression of {result['src_dir']} failed: {result['error']}")
+        report["status"] = "failed"
+        update_compression_status(fullseriesuid, "failed")
+        return
+
+    series_dir = result["src_dir"]
+    dest_zip_file = result["dst_zip"]
+    print(f"Compressed {series_dir} to {dest_zip_file}: {result['mb_per_s']} MB/s, ratio {result['ratio']}")
+
+    # Series validated with content checks have a manifest, check the zip against it
+    # from its central directory before the only other copy is deleted
+    manifest = load_manifest(conn, fullseriesuid)
+    problems = verify_archive(dest_zip_file, manifest) if manifest is not None else []
+    if problems:
+        print(f"Archive {dest_zip_file} does not match the manifest: {problems[:10]}")
+        os.remove(dest_zip_file)
+        report["status"] = "failed"
+        report["manifest_problems"] = problems
+        update_compression_status(fullseriesuid, "failed")
+        return
+
+    # Delete the original directory after successful compression
+    shutil.rmtree(series_dir)
+    print(f"Original directory {series_dir} deleted")
+    record_location(conn, fullseriesuid, os.path.relpath(series_dir, inprogress_dir), ARCHIVED, result["bytes_out"])
+
+    report["status"] = "complete"
+    update_compression_status(fullseriesuid, "complete")
+
 
 def main(
         inprogress_dir = '/blockstorage/dicoms_inprogress',
-        destination_dir = '/blockstorage/dicoms_complete'
+        destination_dir = '/blockstorage/dicoms_complete',
+        workers = 4,
+        codec = 'stored',
+        compression_level = 6,
+        buffer_size_mb = 4,
 ):
+    """Zip every validated series directory into destination_dir and delete the directory.
+
+    `workers` series are compressed at once in a process pool. `codec` is
+    'stored', 'deflate' at `compression_level` 0-9, or 'zstd' inside the
+    zip at -7 to 22 where this Python's zipfile supports it. Zips are
+    written through a `buffer_size_mb` buffer. Each series reports its MB/s and
+    compression ratio, and the totals are printed at the end.
+    """
+    level = compression_level if codec != 'stored' else None
+    check_codec(codec, level)
+    buffer_size = int(buffer_size_mb * 1024 * 1024)
+    started = time.monotonic()
+
     index = 1
     total_loop = len(series_list)
+    jobs = []
+    pending = {}
     for series_info in series_list:
-        patient_id, series_name, seriesuid = series_info
+        patient_id, series_name, seriesuid, fullseriesuid, relpath, state = series_info
         print(f"Working on: {series_info}")
-        # Use glob to find directories that end with the series name
-        pattern = os.path.join(inprogress_dir, patient_id, f'*___{seriesuid}')
-        matching_dirs = glob.glob(pattern)
-        print(f"Matching dirs: {matching_dirs}")
+        # Resolved from fieldsite.series_locations, series not indexed yet are searched for once
+        series_dir = locate_series(conn, inprogress_dir, patient_id, fullseriesuid, seriesuid, relpath, state, DOWNLOADED)
+        print(f"Series dir: {series_dir}")
 
         report = {
             "patient_id": patient_id, 
@@ -78,9 +133,9 @@ def main(
             "seriesuid": seriesuid,
             "status": "unknown"
             }
+        compression_report.append(report)
         
-        if matching_dirs:
-            series_dir = matching_dirs[0]
+        if series_dir and os.path.isdir(series_dir):
             # Get the directory path for the destination zip file
             dest_path = os.path.join(destination_dir, patient_id)
             os.makedirs(dest_path, exist_ok=True)
@@ -90,36 +145,48 @@ def main(
             zip_file_name = f"{series_base_name}.zip"
             dest_zip_file = os.path.join(dest_path, zip_file_name)
 
-            report["src_dir"] = series_dir
-            report["dst_zip"] = dest_zip_file
-
-            print(f"Compressing {series_dir} to {dest_zip_file}")
-            
-            # Compress the series directory
-            with zipfile.ZipFile(dest_zip_file, 'w') as zipf:
-                for root, dirs, files in os.walk(series_dir):
-                    for file in files:
-                        file_path = os.path.join(root, file)
-                        rel_path = os.path.relpath(file_path, start=inprogress_dir)
-                        zipf.write(file_path, rel_path)
-
-            print(f"Compression of {series_dir} complete")
-            
-            # Delete the original directory after successful compression
-            shutil.rmtree(series_dir)
-            print(f"Original directory {series_dir} deleted")
-
+            # Compressed in the pool below, finished here as results come back
+            jobs.append((series_dir, dest_zip_file, inprogress_dir, codec, level, buffer_size))
+            pending[series_dir] = (fullseriesuid, report)
+            continue
+        elif locate_series(conn, destination_dir, patient_id, fullseriesuid, seriesuid, relpath, state, ARCHIVED):
+            # Downloaded with download_mode='zip', the archive is already in place
+            print(f"Series {series_info} was downloaded straight into an archive")
             report["status"] = "complete"
-            update_validation_status(patient_id, seriesuid, "complete")
+            update_compression_status(fullseriesuid, "complete")
         else:
             print(f"No matching directory found for {series_info}")
             report["status"] = "failed"
-            update_validation_status(patient_id, seriesuid, "failed")
+            update_compression_status(fullseriesuid, "failed")
 
-        compression_report.append(report)
         wmill.set_progress(int(index / total_loop * 100))
         index +=1
 
+    print(f"Compressing {len(jobs)} series with {codec} on {workers} workers")
+    if workers > 1 and len(jobs) > 1:
+        with Pool(processes=min(workers, len(jobs))) as pool:
+            # Results are handled as each series finishes; the pool only compresses
+            for result in pool.imap_unordered(compress_directory, jobs):
+                fullseriesuid, report = pending[result["src_dir"]]
+                finish_compression(result, fullseriesuid, inprogress_dir, report)
+                wmill.set_progress(int(index / total_loop * 100))
+                index +=1
+    else:
+        for job in jobs:
+            fullseriesuid, report = pending[job[0]]
+            finish_compression(compress_directory(job), fullseriesuid, inprogress_dir, report)
+            wmill.set_progress(int(index / total_loop * 100))
+            index +=1
+
+    status_writer.flush()
+
+    compressed = [report for report in compression_report if report.get("bytes_out")]
+    bytes_in = sum(report["bytes_in"] for report in compressed)
+    bytes_out = sum(report["bytes_out"] for report in compressed)
+    seconds = time.monotonic() - started
+    print(f"Compressed {len(compressed)} series, {bytes_in / 1e6:.0f} MB to {bytes_out / 1e6:.0f} MB "
+          f"(ratio {bytes_in / bytes_out if bytes_out else 0:.3f}) in {seconds:.1f}s, "
+          f"{bytes_in / 1e6 / seconds if seconds else 0:.1f} MB/s")
 
     # Close the database connection
     cur.close()
@@ -4,22 +4,24 @@ from psycopg2 import sql, extras
 from tqdm import tqdm
 from pynetdicom import AE, debug_logger
 from pynetdicom.sop_class import (
-    PatientRootQueryRetrieveInformationModelFind
+    PatientRootQueryRetrieveInformationModelFind,
+    StudyRootQueryRetrieveInformationModelFind
 )
-from pydicom.dataset import Dataset
 from datetime import datetime
 import os
 import wmill
-
-# Super complex script for detecting patients that are in THLHP cohort
-def detect_thlhp_patient(patient, custom_id):
-    if len(patient) > 5 and patient[4] == '-' and int(patient[:4]) < 5000:
-        return True
-    if patient in custom_id:
-        print("Adding custom patient:", patient)
-        return True
-    return False
-
+from f.dicoms.pacs_retry import RetryPolicy, breaker_for
+from f.dicoms.cfind_engine import CFindEngine
+from f.dicoms.pacs_slots import PacsSlots, pacs_key
+from f.dicoms.pacs_sync import (
+    INCREMENTAL,
+    advance_watermark,
+    ensure_content_hash_column,
+    new_upsert_counts,
+    plan_sync,
+    study_dates,
+)
+from f.dicoms.pacs_queries import detect_thlhp_patient, plan_patient_queries, query_patients, upsert_patients
 
 pacs_credentials = wmill.get_resource("f/dicoms/trinidad_pacs")
 db_credentials = json.loads(wmill.get_variable("f/kobo/vultr_db"))
@@ -34,17 +36,47 @@ conn = psycopg2.connect(
     port=db_credentials['port']
 )
 
+
+def describe_query(query):
+    study_date, patient_id = query
+    if study_date:
+        return f"PatientID {patient_id or '*'} with a study on {study_date}"
+    return f"PatientID {patient_id}" if patient_id else "all patients"
+
+
 def main(
-        custom_patient_ids = []
+        custom_patient_ids = [],
+        slot_accounting = False,
+        full_sync = False,
+        full_sync_every_days = 7,
+        overlap_days = 1,
+        concurrency = 4,
+        query_prefix_digits = 1,
 ):
+    """Sync THLHP cohort patients from the PACS into fieldsite.patients.
+
+    The cohort rule is sent to the PACS as PatientID wildcard keys, one
+    C-FIND per leading `query_prefix_digits` digits, run in parallel, so
+    only cohort patients cross the wire. An incremental run only asks for
+    patients with a study acquired since the last successful sync, one
+    StudyDate per C-FIND. A full run, forced with `full_sync` or due every
+    `full_sync_every_days` days, asks for every cohort patient.
+    """
     print("Running with:", custom_patient_ids)
     cur = conn.cursor()
+    pacs = pacs_key(pacs_credentials)
+
+    # Hold PACS slots shared with the other scripts while associated
+    pacs_slots = None
+    if slot_accounting:
+        pacs_slots = PacsSlots(db_credentials, pacs, 'db_insert_patients')
 
     # Initialize the Application Entity (AE)
     ae = AE()
 
     # Add requested presentation context for C-FIND operation
     ae.add_requested_context(PatientRootQueryRetrieveInformationModelFind)
+    ae.add_requested_context(StudyRootQueryRetrieveInformationModelFind)
 
     # Define the PACS server details
     PACS_IP = pacs_credentials['ip']
@@ -52,59 +84,51 @@ def main(
     PACS_AET = pacs_credentials['aet']
     LOCAL_AET = pacs_credentials['local_aet']
 
-    # Define the query dataset
-    ds = Dataset()
-    ds.QueryRetrieveLevel = 'PATIENT'
-    ds.PatientID = ''
-    ds.PatientName = ''
-    ds.PatientSex = ''
-
-    # Perform the association with the PACS
-    assoc = ae.associate(PACS_IP, PACS_PORT, ae_title=PACS_AET)
-
-    if assoc.is_established:
-        # Send the C-FIND request
-        responses = assoc.send_c_find(ds, PatientRootQueryRetrieveInformationModelFind)
-        
-        batch_data = []
-        batch_size = 100  # Adjust batch size as needed
-
-        for (status, identifier) in responses:
-            if status.Status in (0xFF00, 0xFF01):
-                patient_id = identifier.PatientID if 'PatientID' in identifier else None
-                patient_name = str(identifier.PatientName) if 'PatientName' in identifier else None
-                patient_sex = identifier.PatientSex if 'PatientSex' in identifier else None
-
-                if patient_id and detect_thlhp_patient(patient_id, custom_patient_ids):
-                    batch_data.append((patient_id, patient_name, patient_sex))
-
-                    if len(batch_data) >= batch_size:
-                        extras.execute_values(cur, sql.SQL("""
-                            INSERT INTO fieldsite.patients (patient_id, patient_name, patient_sex)
-                            VALUES %s
-                            ON CONFLICT (patient_id) DO UPDATE
-                            SET patient_name = EXCLUDED.patient_name,
-                                patient_sex = EXCLUDED.patient_sex,
-                                date_modified = CURRENT_TIMESTAMP;
-                        """), batch_data)
-                        conn.commit()
-                        batch_data = []
-
-        # Insert any remaining data in the batch
-        if batch_data:
-            extras.execute_values(cur, sql.SQL("""
-                INSERT INTO fieldsite.patients (patient_id, patient_name, patient_sex)
-                VALUES %s
-                ON CONFLICT (patient_id) DO UPDATE
-                SET patient_name = EXCLUDED.patient_name,
-                    patient_sex = EXCLUDED.patient_sex,
-                    date_modified = CURRENT_TIMESTAMP;
-            """), batch_data)
-            conn.commit()
-
-        # Release the association
-        assoc.release()
-    else:
+    ensure_content_hash_column(conn, 'patients')
+    plan = plan_sync(conn, pacs, 'patients', full_sync, full_sync_every_days, overlap_days)
+    queries = plan_patient_queries(custom_patient_ids,
+                                   study_dates(plan) if plan["mode"] == INCREMENTAL else None,
+                                   query_prefix_digits)
+    print(f"{plan['mode'].capitalize()} sync since {plan['since'] or 'the beginning'} with {len(queries)} queries")
+
+    engine = CFindEngine(ae, PACS_IP, PACS_PORT, PACS_AET, concurrency=concurrency,
+                         retry_policy=RetryPolicy(), breaker=breaker_for(PACS_IP, PACS_PORT, PACS_AET),
+                         pacs_slots=pacs_slots)
+
+    # Keyed by patient ID, a patient with studies on several days is returned once per day
+    batch_data = {}
+    batch_size = 100  # Adjust batch size as needed
+    queries_failed = 0
+    counts = new_upsert_counts()
+
+    results = engine.run(queries, lambda assoc, query: query_patients(assoc, *query), describe=describe_query)
+    for query, rows, error in results:
+        if error is not None:
+            print(f"Giving up on {describe_query(query)}: {error}")
+            queries_failed += 1
+            continue
+
+        for patient_id, patient_name, patient_sex in rows:
+            if patient_id and detect_thlhp_patient(patient_id, custom_patient_ids):
+                batch_data[patient_id] = (patient_id, patient_name, patient_sex)
+
+                if len(batch_data) >= batch_size:
+                    upsert_patients(conn, list(batch_data.values()), counts)
+                    batch_data = {}
+
+    # Insert any remaining data in the batch
+    if batch_data:
+        upsert_patients(conn, list(batch_data.values()), counts)
+
+    print(f"C-FIND latency: {engine.report()}")
+    print(f"Patients: {counts['inserted']} inserted, {counts['updated']} updated, {counts['unchanged']} unchanged")
+    if pacs_slots is not None:
+        pacs_slots.close()
+
+    advance_watermark(conn, pacs, plan, complete=not queries_failed)
+    if queries_failed:
+        cur.close()
+        conn.close()
         return "Association rejected, aborted or never connected"
 
     # Close the database connection
@@ -1,3 +1,4 @@
+import itertools
 import json
 import psycopg2
 from psycopg2 import sql, extras
@@ -5,14 +6,24 @@ from psycopg2.extras import execute_values
 from tqdm import tqdm
 from pynetdicom import AE, debug_logger
 from pynetdicom.sop_class import (
-    PatientRootQueryRetrieveInformationModelFind,
     StudyRootQueryRetrieveInformationModelFind
 )
-from pydicom.dataset import Dataset
 from datetime import datetime
 import os
 import wmill
 import pandas as pd
+from f.dicoms.pacs_retry import RetryPolicy, breaker_for
+from f.dicoms.cfind_engine import CFindEngine
+from f.dicoms.pacs_slots import PacsSlots, pacs_key
+from f.dicoms.pacs_sync import (
+    FULL,
+    advance_watermark,
+    ensure_content_hash_column,
+    new_upsert_counts,
+    plan_sync,
+)
+from f.dicoms.pacs_queries import ensure_series_columns, query_study_series, upsert_series
+from f.dicoms.pacs_cache import CFindCache
 
 pacs_credentials = wmill.get_resource("f/dicoms/trinidad_pacs")
 db_credentials = json.loads(wmill.get_variable("f/kobo/vultr_db"))
@@ -33,17 +44,10 @@ PACS_PORT = pacs_credentials['port']
 PACS_AET = pacs_credentials['aet']
 LOCAL_AET = pacs_credentials['local_aet']
 
-# List to hold series data for batch insertion
-series_data = []
-
 cur = conn.cursor()
 
-# Query all studies from the studies table
-cur.execute("SELECT studyid, studyinstanceuid FROM fieldsite.studies WHERE date_created >= CURRENT_DATE - INTERVAL '5 day'")
-studies = cur.fetchall()
-
-study_map = {study[1]: study[0] for study in studies}  # Map studyinstanceuid to studyid
-study_map_size = len(study_map)
+# Shared PACS association slots, set in main when slot accounting is on
+pacs_slots = None
 
 # Initialize the Application Entity (AE)
 ae = AE()
@@ -51,136 +55,155 @@ ae = AE()
 # Add requested presentation context for C-FIND operation
 ae.add_requested_context(StudyRootQueryRetrieveInformationModelFind)
 
-def main():
-    index = 1
-    for studyinstanceuid, studyid in study_map.items():
-        index +=1
+# information_schema data types of a study_datetime holding the PACS' 'YYYYMMDD HHMMSS' text
+TEXT_TYPES = {'text', 'character varying', 'character'}
+
+def study_datetime_is_text():
+    """Whether fieldsite.studies.study_datetime is text rather than a date or timestamp."""
+    cur.execute("""
+        SELECT data_type FROM information_schema.columns
+        WHERE table_schema = 'fieldsite' AND table_name = 'studies' AND column_name = 'study_datetime'
+    """)
+    row = cur.fetchone()
+    return row is not None and row[0] in TEXT_TYPES
+
+def load_study_map(plan):
+    """Map studyinstanceuid to studyid, and to the study's YYYYMMDD date, for the studies whose series this run queries.
+
+    A full run queries every study. An incremental run queries the studies
+    acquired since the last sync, which may still be receiving series, and
+    the studies added or changed since then. study_datetime is compared as
+    text or as a date depending on the column's type.
+    """
+    if study_datetime_is_text():
+        # 'YYYYMMDD HHMMSS' sorts like the date it starts with
+        study_date = sql.SQL("left(study_datetime, 8)")
+        since = plan["since"].strftime('%Y%m%d') if plan["since"] else None
+    else:
+        study_date = sql.SQL("to_char(study_datetime, 'YYYYMMDD')")
+        since = plan["since"]
+
+    if plan["mode"] == FULL:
+        cur.execute(sql.SQL("SELECT studyid, studyinstanceuid, {} FROM fieldsite.studies").format(study_date))
+    else:
+        cur.execute(sql.SQL("""
+            SELECT studyid, studyinstanceuid, {study_date}
+            FROM fieldsite.studies
+            WHERE study_datetime >= %s
+               OR date_created >= %s
+               OR date_modified >= %s
+        """).format(study_date=study_date), (since, plan["changed_since"], plan["changed_since"]))
+    studies = cur.fetchall()
+    return {study[1]: study[0] for study in studies}, {study[1]: study[2] for study in studies}
+
+def main(
+        max_attempts = 5,
+        retry_base_seconds = 5,
+        slot_accounting = False,
+        concurrency = 4,
+        upsert_batch_size = 500,
+        full_sync = False,
+        full_sync_every_days = 7,
+        overlap_days = 1,
+        use_cache = True,
+        cache_refresh = False,
+        cache_ttl_hours = 24,
+        cache_stable_ttl_days = 30,
+):
+    """Query the series of studies with concurrent C-FINDs and upsert them in batches as they arrive.
+
+    An incremental run only queries studies acquired or changed since the
+    last successful sync; a full run, forced with `full_sync` or due every
+    `full_sync_every_days` days, queries every study. Up to `concurrency`
+    associations are kept open and reused across studies. Every
+    `upsert_batch_size` series are committed straight away, so only one
+    batch is ever held in memory and a run cut short by the PACS keeps
+    everything committed before it.
+
+    With `use_cache` the series of a study are taken from the C-FIND cache
+    when fresh: studies older than 30 days are kept for
+    `cache_stable_ttl_days`, recent ones for `cache_ttl_hours`, so repeat
+    runs over historical studies barely touch the PACS. `cache_refresh`
+    asks the PACS again and overwrites the cache. A full sync always does,
+    as its point is to reconcile with the PACS. On the nightly incremental
+    runs the recent studies' answers have expired, so hits come from reruns
+    within `cache_ttl_hours` and from older studies that changed; the hit
+    rate is in the returned cfind report.
+    """
+    global pacs_slots
+    pacs = pacs_key(pacs_credentials)
+    if slot_accounting:
+        pacs_slots = PacsSlots(db_credentials, pacs, 'db_insert_series')
+
+    ensure_content_hash_column(conn, 'series')
+    ensure_series_columns(conn)
+    plan = plan_sync(conn, pacs, 'series', full_sync, full_sync_every_days, overlap_days)
+    study_map, study_days = load_study_map(plan)
+    study_map_size = len(study_map)
+
+    cache = None
+    cached = {}
+    to_query = list(study_map.items())
+    if use_cache:
+        cache = CFindCache(conn, pacs, ttl_hours=cache_ttl_hours, stable_ttl_days=cache_stable_ttl_days,
+                           refresh=cache_refresh or plan["mode"] == FULL)
+        cached, to_query = cache.lookup('series', to_query)
+
+    retry_policy = RetryPolicy(max_attempts, retry_base_seconds)
+    breaker = breaker_for(PACS_IP, PACS_PORT, PACS_AET)
+    engine = CFindEngine(ae, PACS_IP, PACS_PORT, PACS_AET, concurrency=concurrency,
+                         retry_policy=retry_policy, breaker=breaker, pacs_slots=pacs_slots)
+
+    print(f"{plan['mode'].capitalize()} sync since {plan['since'] or 'the beginning'}: "
+          f"querying series of {study_map_size} studies over {concurrency} associations, "
+          f"{len(cached)} answered from the cache")
+
+    batch = []
+    counts = new_upsert_counts()
+    studies_failed = 0
+    queries = itertools.chain(
+        ((study, rows, None) for study, rows in cached.items()),
+        engine.run(
+            to_query,
+            lambda assoc, study: query_study_series(assoc, *study),
+            describe=lambda study: f"StudyInstanceUID {study[0]}"
+        ),
+    )
+    for index, ((studyinstanceuid, studyid), rows, error) in enumerate(queries, start=1):
         current_progress = int(index / study_map_size * 100)
         wmill.set_progress(current_progress)
 
-        # Define the query dataset
-        ds = Dataset()
-        ds.QueryRetrieveLevel = 'SERIES'
-        ds.StudyInstanceUID = studyinstanceuid
-        ds.SeriesInstanceUID = ''
-        ds.SeriesDate = ''
-        ds.SeriesTime = ''
-        ds.SeriesNumber = ''
-        ds.Modality = ''
-        ds.InstitutionName = ''
-        ds.InstitutionalDepartmentName = ''
-        ds.SeriesDescription = ''
-        ds.BodyPartExamined = ''
-        ds.NumberOfSeriesRelatedInstances = ''
-        ds.add_new((0x0040, 0x0310), 'ST', '')
-        ds.add_new((0x0018, 0x1210), 'SH', '')
-        ds.add_new((0x0018, 0x1030), 'LO', '')
-        ds.add_new((0x0018, 0x0050), 'DS', '')
-        ds.add_new((0x0054, 0x0081), 'US', '')
-        ds.add_new((0x0018, 0x0088), 'DS', '')
-        ds.add_new((0x0018, 0x0060), 'DS', '')
-        ds.add_new((0x0018, 0x7005), 'CS', '')
-        ds.add_new((0x1092, 0x7005), 'CS', '')
-        ds.add_new((0x100B, 0x7005), 'CS', '')
-        ds.add_new((0x0010, 0x4000), 'LT', '')
-        ds.add_new((0x0018, 0x0022), 'CS', '')
-        ds.add_new((0x1011, 0x7005), 'UN', '')
-
-        # Perform the association with the PACS
-        assoc = ae.associate(PACS_IP, PACS_PORT, ae_title=PACS_AET)
-
-        if assoc.is_established:
-            # Send the C-FIND request
-            responses = assoc.send_c_find(ds, StudyRootQueryRetrieveInformationModelFind)
-            
-            for (status, identifier) in responses:
-                if status.Status in (0xFF00, 0xFF01):
-                    series_instance_uid = identifier.SeriesInstanceUID if 'SeriesInstanceUID' in identifier else None
-                    series_number = identifier.SeriesNumber if 'SeriesNumber' in identifier else None
-                    modality = identifier.Modality if 'Modality' in identifier else None
-                    institution_name = identifier.InstitutionName if 'InstitutionName' in identifier else None
-                    institutional_department_name = identifier.InstitutionalDepartmentName if 'InstitutionalDepartmentName' in identifier else None
-                    series_description = identifier.SeriesDescription if 'SeriesDescription' in identifier else None
-                    body_part_examined = identifier.BodyPartExamined if 'BodyPartExamined' in identifier else None
-                    number_of_images = identifier.NumberOfSeriesRelatedInstances if 'NumberOfSeriesRelatedInstances' in identifier else None
-                    series_date = identifier.SeriesDate if 'SeriesDate' in identifier else None
-                    series_time = identifier.SeriesTime if 'SeriesTime' in identifier else None
-                    comments_on_radiation_dose = identifier[(0x0040, 0x0310)].value if (0x0040, 0x0310) in identifier else None
-                    convolution_kernel = identifier[(0x0018, 0x1210)].value if (0x0018, 0x1210) in identifier else None
-                    protocol_name = identifier[(0x0018, 0x1030)].value if (0x0018, 0x1030) in identifier else None
-                    slice_thickness = identifier[(0x0018, 0x0050)].value if (0x0018, 0x0050) in identifier else None
-                    number_of_slices = identifier[(0x0054, 0x0081)].value if (0x0054, 0x0081) in identifier else None
-                    spacing_between_slices = identifier[(0x0018, 0x0088)].value if (0x0018, 0x0088) in identifier else None
-                    kvp = identifier[(0x0018, 0x0060)].value if (0x0018, 0x0060) in identifier else None
-                    detector_configuration = identifier[(0x0018, 0x7005)].value if (0x0018, 0x7005) in identifier else None
-                    aice = identifier[(0x1092, 0x7005)].value if (0x1092, 0x7005) in identifier else None
-                    aidr_3d_estd = identifier[(0x100B, 0x7005)].value if (0x100B, 0x7005) in identifier else None
-                    patient_comments = identifier[(0x0010, 0x4000)].value if (0x0010, 0x4000) in identifier else None
-                    scan_options = identifier[(0x0018, 0x0022)].value if (0x0018, 0x0022) in identifier else None
-                    vol = identifier[(0x1011, 0x7005)].value if (0x1011, 0x7005) in identifier else None
-
-                    if series_date and series_time:
-                        series_datetime = f"{series_date} {series_time}"
-                    elif series_date:
-                        series_datetime = series_date
-                    elif series_time:
-                        series_datetime = series_time
-                    else:
-                        series_datetime = None
-
-                    if series_instance_uid:
-                        series_data.append(
-                            (studyid, series_instance_uid, series_datetime, series_number, modality,
-                            institution_name, institutional_department_name, series_description,
-                            body_part_examined, number_of_images, comments_on_radiation_dose,
-                            convolution_kernel, protocol_name, slice_thickness, number_of_slices,
-                            spacing_between_slices, kvp, detector_configuration, aice, aidr_3d_estd,
-                            patient_comments, scan_options, vol, studyinstanceuid)
-                        )
-
-            # Release the association
-            assoc.release()
-        else:
-            print(f"Association rejected, aborted or never connected for StudyInstanceUID: {studyinstanceuid}")
-
-    # Insert series data in batch
-    if series_data:
-        insert_query = """
-            INSERT INTO fieldsite.series (studyid, seriesinstanceuid, series_datetime, seriesnumber, modality,
-                                        institutionname, institutionaldepartmentname, seriesdescription,
-                                        bodypartexamined, numberofimages, comments_on_radiation_dose, 
-                                        convolution_kernel, protocol_name, slice_thickness, number_of_slices, 
-                                        spacing_between_slices, kvp, detector_configuration, aice, 
-                                        aidr_3d_estd, patient_comments, scan_options, vol, studyinstanceuid)
-            VALUES %s
-            ON CONFLICT (seriesinstanceuid) DO UPDATE
-            SET studyid = EXCLUDED.studyid,
-                series_datetime = EXCLUDED.series_datetime,
-                seriesnumber = EXCLUDED.seriesnumber,
-                modality = EXCLUDED.modality,
-                institutionname = EXCLUDED.institutionname,
-                institutionaldepartmentname = EXCLUDED.institutionaldepartmentname,
-                seriesdescription = EXCLUDED.seriesdescription,
-                bodypartexamined = EXCLUDED.bodypartexamined,
-                numberofimages = EXCLUDED.numberofimages,
-                comments_on_radiation_dose = EXCLUDED.comments_on_radiation_dose,
-                convolution_kernel = EXCLUDED.convolution_kernel,
-                protocol_name = EXCLUDED.protocol_name,
-                slice_thickness = EXCLUDED.slice_thickness,
-                number_of_slices = EXCLUDED.number_of_slices,
-                spacing_between_slices = EXCLUDED.spacing_between_slices,
-                kvp = EXCLUDED.kvp,
-                detector_configuration = EXCLUDED.detector_configuration,
-                aice = EXCLUDED.aice,
-                aidr_3d_estd = EXCLUDED.aidr_3d_estd,
-                patient_comments = EXCLUDED.patient_comments,
-                scan_options = EXCLUDED.scan_options,
-                vol = EXCLUDED.vol,
-                studyinstanceuid = EXCLUDED.studyinstanceuid,
-                date_modified = CURRENT_TIMESTAMP;
-        """
-        extras.execute_values(cur, insert_query, series_data)
-        conn.commit()
+        if error is not None:
+            print(f"Giving up on StudyInstanceUID {studyinstanceuid}: {error}")
+            studies_failed += 1
+            continue
+        if cache is not None and (studyinstanceuid, studyid) not in cached:
+            cache.store('series', (studyinstanceuid, studyid), rows, cache.ttl_for(study_days[studyinstanceuid]))
+
+        batch.extend(rows)
+        if len(batch) >= upsert_batch_size:
+            upsert_series(conn, batch, counts)
+            batch = []
+
+    # Insert the last partial batch
+    if batch:
+        upsert_series(conn, batch, counts)
+    print(f"Series: {counts['inserted']} inserted, {counts['updated']} updated, {counts['unchanged']} unchanged")
+
+    cfind_report = engine.report()
+    print(f"C-FIND latency: {cfind_report}")
+    if cache is not None:
+        cache.flush()
+        cfind_report["cache"] = cache.summary()
+        print(f"C-FIND cache: {cfind_report['cache']}")
+
+    if studies_failed:
+        print(f"{studies_failed} studies failed, keeping the previous watermark so the next run covers them again")
+    advance_watermark(conn, pacs, plan, complete=not studies_failed)
+
+    if pacs_slots is not None:
+        print(f"PACS slot waits: {pacs_slots.summary()}")
+        pacs_slots.close()
 
     # Close the database connection
     cur.close()
@@ -188,4 +211,13 @@ def main():
 
     print("Series data has been populated.")
 
-    return series_data
+    return {
+        "mode": plan["mode"],
+        "since": str(plan["since"]) if plan["since"] else None,
+        "studies_queried": study_map_size,
+        "studies_failed": studies_failed,
+        "series_inserted": counts["inserted"],
+        "series_updated": counts["updated"],
+        "series_unchanged": counts["unchanged"],
+        "cfind": cfind_report,
+    }
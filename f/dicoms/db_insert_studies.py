@@ -1,3 +1,4 @@
+import itertools
 import json
 import psycopg2
 from psycopg2 import sql
@@ -5,14 +6,26 @@ from psycopg2.extras import execute_values
 from tqdm import tqdm
 from pynetdicom import AE, debug_logger
 from pynetdicom.sop_class import (
-    PatientRootQueryRetrieveInformationModelFind,
     StudyRootQueryRetrieveInformationModelFind
 )
-from pydicom.dataset import Dataset
 from datetime import datetime
 import os
 import wmill
 import pandas as pd
+from f.dicoms.pacs_retry import RetryPolicy, breaker_for
+from f.dicoms.cfind_engine import CFindEngine
+from f.dicoms.pacs_slots import PacsSlots, pacs_key
+from f.dicoms.pacs_sync import (
+    FULL,
+    INCREMENTAL,
+    advance_watermark,
+    ensure_content_hash_column,
+    new_upsert_counts,
+    plan_sync,
+    study_dates,
+)
+from f.dicoms.pacs_queries import query_studies, upsert_studies
+from f.dicoms.pacs_cache import CFindCache
 
 pacs_credentials = wmill.get_resource("f/dicoms/trinidad_pacs")
 db_credentials = json.loads(wmill.get_variable("f/kobo/vultr_db"))
@@ -34,12 +47,9 @@ PACS_AET = pacs_credentials['aet']
 LOCAL_AET = pacs_credentials['local_aet']
 
 cur = conn.cursor()
-print("Getting patients from DB")
-# Query all patients from the patients table
-cur.execute("SELECT patient_id FROM fieldsite.patients where date_created >= CURRENT_DATE - interval '5 day'")
-patients = cur.fetchall()
 
-patient_ids = [patient[0] for patient in patients]
+# Shared PACS association slots, set in main when slot accounting is on
+pacs_slots = None
 
 # Initialize the Application Entity (AE)
 ae = AE()
@@ -50,82 +60,136 @@ ae.add_requested_context(StudyRootQueryRetrieveInformationModelFind)
 # List to hold study data for batch insertion
 studies_data = []
 
-def main():
-    # Calculate total number of steps (number of patient IDs)
-    total_patients = len(patient_ids)
-    index = 1
-
-
-
-    print("Iterating over patients")
-
-    for patient_id in patient_ids:
-        index += 1
+def load_patient_ids(plan):
+    """Patients whose studies are queried one patient at a time.
+
+    A full run queries every patient. An incremental run only queries the
+    patients added since the last sync, to pick up their older studies; new
+    studies of everyone else come from the StudyDate queries.
+    """
+    print("Getting patients from DB")
+    if plan["mode"] == FULL:
+        cur.execute("SELECT patient_id FROM fieldsite.patients")
+    else:
+        cur.execute("SELECT patient_id FROM fieldsite.patients WHERE date_created >= %s", (plan["changed_since"],))
+    return [patient[0] for patient in cur.fetchall()]
+
+def describe_query(query):
+    patient_id, study_date = query
+    return f"PatientID {patient_id}" if patient_id else f"StudyDate {study_date}"
+
+
+def main(
+        max_attempts = 5,
+        retry_base_seconds = 5,
+        slot_accounting = False,
+        concurrency = 4,
+        upsert_batch_size = 500,
+        full_sync = False,
+        full_sync_every_days = 7,
+        overlap_days = 1,
+        use_cache = True,
+        cache_refresh = False,
+        cache_ttl_hours = 24,
+        cache_stable_ttl_days = 30,
+):
+    """Sync study metadata of cohort patients from the PACS with concurrent C-FINDs.
+
+    An incremental run queries the PACS one StudyDate at a time from the
+    last successful sync on, plus every patient added since then. A full
+    run, forced with `full_sync` or due every `full_sync_every_days` days,
+    queries every patient. Up to `concurrency` associations are kept open
+    and rows are committed every `upsert_batch_size` studies.
+
+    With `use_cache` answers are taken from the C-FIND cache when fresh:
+    StudyDates older than 30 days are kept for `cache_stable_ttl_days`,
+    patients and recent dates for `cache_ttl_hours`. `cache_refresh` asks
+    the PACS again and overwrites the cache. A full sync always does, as
+    its point is to reconcile with the PACS. On the nightly incremental
+    runs the recent StudyDates have expired and new patients were never
+    cached, so hits come from reruns within `cache_ttl_hours`; the hit rate
+    is printed with the cache summary.
+    """
+    global pacs_slots
+    pacs = pacs_key(pacs_credentials)
+    if slot_accounting:
+        pacs_slots = PacsSlots(db_credentials, pacs, 'db_insert_studies')
+
+    ensure_content_hash_column(conn, 'studies')
+    plan = plan_sync(conn, pacs, 'studies', full_sync, full_sync_every_days, overlap_days)
+    patient_ids = load_patient_ids(plan)
+    cur.execute("SELECT patient_id FROM fieldsite.patients")
+    cohort = {patient[0] for patient in cur.fetchall()}
+
+    queries = [(patient_id, '') for patient_id in patient_ids]
+    if plan["mode"] == INCREMENTAL:
+        queries += [('', study_date) for study_date in study_dates(plan)]
+    # Calculate total number of steps (number of queries)
+    total_queries = len(queries)
+
+    cache = None
+    cached = {}
+    if use_cache:
+        cache = CFindCache(conn, pacs, ttl_hours=cache_ttl_hours, stable_ttl_days=cache_stable_ttl_days,
+                           refresh=cache_refresh or plan["mode"] == FULL)
+        cached, queries = cache.lookup('studies', queries)
+
+    retry_policy = RetryPolicy(max_attempts, retry_base_seconds)
+    breaker = breaker_for(PACS_IP, PACS_PORT, PACS_AET)
+    engine = CFindEngine(ae, PACS_IP, PACS_PORT, PACS_AET, concurrency=concurrency,
+                         retry_policy=retry_policy, breaker=breaker, pacs_slots=pacs_slots)
+
+    print(f"{plan['mode'].capitalize()} sync since {plan['since'] or 'the beginning'}: "
+          f"{len(patient_ids)} patients and {total_queries - len(patient_ids)} study dates over {concurrency} associations, "
+          f"{len(cached)} answered from the cache")
+
+    # Keyed by StudyInstanceUID, a study can come back from both a patient and a date query
+    batch = {}
+    queries_failed = 0
+    counts = new_upsert_counts()
+    results = itertools.chain(
+        ((query, rows, None) for query, rows in cached.items()),
+        engine.run(queries, lambda assoc, query: query_studies(assoc, *query), describe=describe_query),
+    )
+    for index, (query, rows, error) in enumerate(results, start=1):
         # Calculate the current progress percentage and update the progress bar
-        current_progress = index / total_patients * 100
-        wmill.set_progress(int(current_progress))
-    
-        # Define the query dataset
-        ds = Dataset()
-        ds.QueryRetrieveLevel = 'STUDY'
-        ds.PatientID = patient_id
-        ds.StudyInstanceUID = ''
-        ds.StudyDate = ''
-        ds.StudyTime = ''
-        ds.StudyID = ''
-        ds.AccessionNumber = ''
-
-        # Perform the association with the PACS
-        assoc = ae.associate(PACS_IP, PACS_PORT, ae_title=PACS_AET)
-
-        if assoc.is_established:
-            # Send the C-FIND request
-            responses = assoc.send_c_find(ds, StudyRootQueryRetrieveInformationModelFind)
-            
-            for (status, identifier) in responses:
-                if status.Status in (0xFF00, 0xFF01):
-                    study_id = identifier.StudyID if 'StudyID' in identifier else None
-                    study_instance_uid = identifier.StudyInstanceUID if 'StudyInstanceUID' in identifier else None
-                    accession_number = identifier.AccessionNumber if 'AccessionNumber' in identifier else None
-                    study_date = identifier.StudyDate if 'StudyDate' in identifier else None
-                    study_time = identifier.StudyTime if 'StudyTime' in identifier else None
-
-                    if study_date and study_time:
-                        study_datetime = f"{study_date} {study_time}"
-                    elif study_date:
-                        study_datetime = study_date
-                    elif study_time:
-                        study_datetime = study_time
-                    else:
-                        study_datetime = None
-
-                    if study_id and patient_id and study_instance_uid:
-                        studies_data.append(
-                            (study_id, patient_id, study_datetime, study_instance_uid, accession_number)
-                        )
-
-            # Release the association
-            assoc.release()
-        else:
-            print(f"Association rejected, aborted or never connected for PatientID: {patient_id}")
+        wmill.set_progress(int(index / total_queries * 100))
+
+        if error is not None:
+            print(f"Giving up on {describe_query(query)}: {error}")
+            queries_failed += 1
+            continue
+        if cache is not None and query not in cached:
+            cache.store('studies', query, rows, cache.ttl_for(query[1]))
+
+        # Date queries return every patient in the PACS, keep the cohort only
+        rows = [row for row in rows if row[1] in cohort]
+        studies_data.extend(rows)
+        batch.update((row[3], row) for row in rows)
+        if len(batch) >= upsert_batch_size:
+            upsert_studies(conn, list(batch.values()), counts)
+            batch = {}
+
+    # Insert the last partial batch
+    if batch:
+        upsert_studies(conn, list(batch.values()), counts)
+
+    print(f"C-FIND latency: {engine.report()}")
+    if cache is not None:
+        cache.flush()
+        print(f"C-FIND cache: {cache.summary()}")
+    print(f"Studies: {counts['inserted']} inserted, {counts['updated']} updated, {counts['unchanged']} unchanged")
+
+    if queries_failed:
+        print(f"{queries_failed} queries failed, keeping the previous watermark so the next run covers them again")
+    advance_watermark(conn, pacs, plan, complete=not queries_failed)
 
     # Convert studies data to a DataFrame
     studies_df = pd.DataFrame(studies_data, columns=['StudyID', 'PatientID', 'StudyDatetime', 'StudyInstanceUID', 'AccessionNumber'])
 
-    # Insert studies data in batch
-    if studies_data:
-        insert_query = """
-            INSERT INTO fieldsite.studies (studyid, patient_id, study_datetime, studyinstanceuid, accession_number)
-            VALUES %s
-            ON CONFLICT (studyinstanceuid) DO UPDATE
-            SET patient_id = EXCLUDED.patient_id,
-                study_datetime = EXCLUDED.study_datetime,
-                studyinstanceuid = EXCLUDED.studyinstanceuid,
-                accession_number = EXCLUDED.accession_number,
-                date_modified = CURRENT_TIMESTAMP;
-        """
-        execute_values(cur, insert_query, studies_data)
-        conn.commit()
+    if pacs_slots is not None:
+        print(f"PACS slot waits: {pacs_slots.summary()}")
+        pacs_slots.close()
 
     # Close the database connection
     cur.close()
@@ -26,8 +26,35 @@ from pydicom.dataset import Dataset
 from datetime import datetime
 from contextlib import contextmanager
 import time
-from multiprocessing import Pool
+import socket
+import uuid
+import queue
+import threading
+import zipfile
+from multiprocessing import Pool, Manager
 import re
+from f.dicoms.pacs_retry import (
+    PacsError,
+    RetryPolicy,
+    breaker_for,
+    classify_association,
+    classify_exception,
+    BREAKER_FAILURES,
+    CIRCUIT_OPEN,
+    DIMSE_TIMEOUT,
+    FATAL,
+)
+from f.dicoms.pacs_slots import PacsSlots, pacs_key
+from f.dicoms.pacs_sync import missing_columns
+from f.dicoms.series_locations import (
+    ARCHIVED,
+    DOWNLOADED,
+    directory_size,
+    ensure_locations_table,
+    locate_series,
+    record_location,
+    series_location,
+)
 
 pacs_credentials = wmill.get_resource("f/dicoms/trinidad_pacs")
 db_credentials = json.loads(wmill.get_variable("f/kobo/vultr_db"))
@@ -37,19 +64,62 @@ PACS_IP = pacs_credentials['ip']
 PACS_PORT = pacs_credentials['port']
 PACS_AET = pacs_credentials['aet']
 LOCAL_AET = pacs_credentials['local_aet']
+PACS_KEY = pacs_key(pacs_credentials)
 
 storage_dir = ''
 
-@contextmanager
-def get_db_connection():
-    """Create a fresh database connection for each process"""
-    conn = psycopg2.connect(
+# Set per worker process when C-STORE payloads are persisted asynchronously
+store_writer = None
+
+# Set per worker process when association slots and bandwidth are shared with
+# the other PACS scripts through fieldsite.pacs_limits
+pacs_slots = None
+
+# 'files' writes loose .dcm files under storage_dir, 'zip' streams each series
+# into <archive_dir>/<patient_id>/<series>.zip as it arrives
+write_mode = 'files'
+archive_dir = ''
+
+# Series archives still being written by this process, keyed by SeriesInstanceUID
+open_archives = {}
+open_archives_lock = threading.Lock()
+
+# Bytes and instances received over C-STORE by this process, and instances
+# a resumed download did not have to fetch again
+transfer_totals = {"bytes": 0, "instances": 0, "skipped": 0}
+
+# Set per worker process when autoscaling: the queue the controller reads
+# transfer progress from. Progress is reported every PROGRESS_INSTANCES
+# instances, so a long series is spread over the scaling windows it spans
+# instead of landing in the one where it finishes.
+progress_queue = None
+progress_reported = {"bytes": 0, "instances": 0}
+PROGRESS_INSTANCES = 50
+
+# Series directory (relative to storage_dir) each series received over
+# C-STORE was written to, recorded in fieldsite.series_locations once the
+# series is complete
+received_series_dirs = {}
+
+# Series directories already created by this process
+created_dirs = set()
+created_dirs_lock = threading.Lock()
+
+def open_db_connection():
+    """Open a new database connection using the shared credentials"""
+    return psycopg2.connect(
         dbname=db_credentials['dbname'],
         user=db_credentials['username'],
         password=db_credentials['password'],
         host=db_credentials['host'],
         port=db_credentials['port']
     )
+
+
+@contextmanager
+def get_db_connection():
+    """Create a fresh database connection for each process"""
+    conn = open_db_connection()
     try:
         yield conn
     finally:
@@ -60,13 +130,8 @@ def current_timestamp():
     """Return the current timestamp as a human-readable string."""
     return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
-# Define a handler for incoming C-STORE requests
-def handle_store(event):
-    """Handle a C-STORE request event."""
-    ds = event.dataset
-    ds.file_meta = event.file_meta
-    
-    # Define the filename and save the dataset
+def store_path(ds):
+    """Return the series directory and file name an incoming instance is saved under."""
     patient_id = ds.PatientID
     series_instance_uid = ds.SeriesInstanceUID
     # Split the SeriesInstanceUID by '.' and exclude the first 6 groups
@@ -78,20 +143,362 @@ def handle_store(event):
     series_name = series_name.replace(' ', '_')
 
     series_dir = os.path.join(storage_dir, patient_id, series_name + '___' + series_instance_uid)
+    filename = os.path.join(series_dir, f"{sop_instance_uid}.dcm")
+    return series_dir, filename
+
+
+def ensure_series_dir(series_dir):
+    """Create the series directory once per process instead of on every instance."""
+    if series_dir in created_dirs:
+        return
     os.makedirs(series_dir, exist_ok=True)
+    with created_dirs_lock:
+        created_dirs.add(series_dir)
 
-    filename = os.path.join(series_dir, f"{sop_instance_uid}.dcm")
-    ds.save_as(filename, write_like_original=False)
+
+class SeriesArchive:
+    """Append-only zip for one series, written under a .part name until finalized."""
+
+    def __init__(self, zip_path):
+        self.zip_path = zip_path
+        self.part_path = zip_path + '.part'
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(zip_path), exist_ok=True)
+        self.zipf = zipfile.ZipFile(self.part_path, 'w')
+
+    def add(self, arcname, data):
+        with self.lock:
+            self.zipf.writestr(arcname, data)
+
+    def finalize(self):
+        """Close the archive and move it into place under its final name."""
+        with self.lock:
+            self.zipf.close()
+            os.replace(self.part_path, self.zip_path)
+
+    def discard(self):
+        with self.lock:
+            self.zipf.close()
+            if os.path.exists(self.part_path):
+                os.remove(self.part_path)
+
+
+def persist_instance(series_instance_uid, series_dir, filename, data):
+    """Write one encoded instance either as a loose file or into its series archive."""
+    if write_mode == 'zip':
+        archive = open_archives.get(series_instance_uid)
+        if archive is None:
+            with open_archives_lock:
+                archive = open_archives.get(series_instance_uid)
+                if archive is None:
+                    zip_path = os.path.join(archive_dir, os.path.relpath(series_dir, storage_dir)) + '.zip'
+                    archive = open_archives[series_instance_uid] = SeriesArchive(zip_path)
+        # Same layout as compress_series: <patient_id>/<series>/<sop>.dcm
+        archive.add(os.path.relpath(filename, storage_dir), data)
+        return
+
+    ensure_series_dir(series_dir)
+    # Written under a .part name and renamed into place, so a crash never
+    # leaves a truncated <SOPInstanceUID>.dcm that resume would take as present
+    part_path = filename + '.part'
+    with open(part_path, 'wb') as f:
+        f.write(data)
+    os.replace(part_path, filename)
+
+
+def finalize_archive(series_instance_uid):
+    """Finalize the archive of one series and return its path, None when nothing was written for it."""
+    with open_archives_lock:
+        archive = open_archives.pop(series_instance_uid, None)
+    if archive is None:
+        return None
+    archive.finalize()
+    return archive.zip_path
+
+
+def discard_archive(series_instance_uid):
+    """Drop the partially written archive of one series, e.g. before retrying it.
+
+    With a StoreWriter, flush it first so no write still queued for the
+    series reopens the archive afterwards.
+    """
+    with open_archives_lock:
+        archive = open_archives.pop(series_instance_uid, None)
+    if archive is not None:
+        archive.discard()
+
+
+class StoreWriter:
+    """Persist received instances on background threads fed by a bounded queue.
+
+    The C-STORE handler only enqueues the encoded bytes it received, so the
+    DIMSE thread is never blocked by the disk unless the queue is full. Time
+    spent waiting on a full queue is tracked as backpressure: if it grows,
+    the disk rather than the PACS is limiting the transfer.
+    """
+
+    def __init__(self, num_threads=2, max_queue=64):
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.lock = threading.Lock()
+        self.errors = []
+        self.metrics = {
+            "files_written": 0,
+            "bytes_written": 0,
+            "write_seconds": 0.0,
+            "queue_full_waits": 0,
+            "enqueue_wait_seconds": 0.0,
+            "max_queue_depth": 0,
+        }
+        self.threads = [
+            threading.Thread(target=self._run, name=f"store-writer-{i}", daemon=True)
+            for i in range(num_threads)
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def put(self, series_instance_uid, series_dir, filename, data):
+        """Queue one encoded instance, blocking only when the writers are behind."""
+        item = (series_instance_uid, series_dir, filename, data)
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            start = time.monotonic()
+            self.queue.put(item)
+            with self.lock:
+                self.metrics["queue_full_waits"] += 1
+                self.metrics["enqueue_wait_seconds"] += time.monotonic() - start
+        depth = self.queue.qsize()
+        if depth > self.metrics["max_queue_depth"]:
+            with self.lock:
+                self.metrics["max_queue_depth"] = max(self.metrics["max_queue_depth"], depth)
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                return
+            series_instance_uid, series_dir, filename, data = item
+            try:
+                start = time.monotonic()
+                persist_instance(series_instance_uid, series_dir, filename, data)
+                with self.lock:
+                    self.metrics["files_written"] += 1
+                    self.metrics["bytes_written"] += len(data)
+                    self.metrics["write_seconds"] += time.monotonic() - start
+            except Exception as e:
+                with self.lock:
+                    self.errors.append(f"{filename}: {e}")
+            finally:
+                self.queue.task_done()
+
+    def flush(self):
+        """Wait until everything queued so far is on disk and return any write errors."""
+        self.queue.join()
+        with self.lock:
+            errors, self.errors = self.errors, []
+        return errors
+
+    def close(self):
+        """Drain the queue and stop the writer threads."""
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+
+    def report(self):
+        with self.lock:
+            report = dict(self.metrics)
+        report["enqueue_wait_seconds"] = round(report["enqueue_wait_seconds"], 3)
+        report["write_seconds"] = round(report["write_seconds"], 3)
+        return report
+
+
+# Define a handler for incoming C-STORE requests
+def handle_store(event):
+    """Handle a C-STORE request event."""
+    ds = event.dataset
+    series_dir, filename = store_path(ds)
+    received_series_dirs[ds.SeriesInstanceUID] = series_dir
+    nbytes = event.request.DataSet.getbuffer().nbytes
+    transfer_totals["bytes"] += nbytes
+    transfer_totals["instances"] += 1
+    if pacs_slots is not None:
+        pacs_slots.account_bytes(nbytes)
+    if progress_queue is not None and transfer_totals["instances"] - progress_reported["instances"] >= PROGRESS_INSTANCES:
+        report_progress()
+
+    if store_writer is not None:
+        # Fast path, hand the dataset over exactly as received without re-encoding it
+        store_writer.put(ds.SeriesInstanceUID, series_dir, filename, event.encoded_dataset())
+        return 0x0000
+
+    if write_mode == 'zip':
+        persist_instance(ds.SeriesInstanceUID, series_dir, filename, event.encoded_dataset())
+        return 0x0000
+
+    ds.file_meta = event.file_meta
+    ensure_series_dir(series_dir)
+    # Same .part and rename as persist_instance
+    ds.save_as(filename + '.part', write_like_original=False)
+    os.replace(filename + '.part', filename)
     #print(f"Saved file to {filename}")
     return 0x0000
 
+def storage_roles():
+    """SCP/SCU role selection items needed for the PACS to C-STORE back to us during a C-GET"""
+    storage_sop_classes = [CTImageStorage, MRImageStorage, SecondaryCaptureImageStorage]
+    return [build_role(sop_class, scp_role=True) for sop_class in storage_sop_classes]
+
+
+class PooledAssociation:
+    """Keep a single association to the PACS open and reuse it for successive C-GETs.
+
+    The association is re-established transparently whenever the PACS has
+    released or aborted it, or after `max_requests` C-GETs when that is set.
+    `opened` counts how many associations were negotiated over the lifetime
+    of the pool. When slot accounting is on, a PACS slot is held for as long
+    as the association is open. `last_setup_seconds` is the time the last
+    acquire() spent waiting for a slot and negotiating, 0 when it reused the
+    open association.
+    """
+
+    def __init__(self, ae, pacs_address, pacs_port, called_aet, max_requests=0):
+        self.ae = ae
+        self.pacs_address = pacs_address
+        self.pacs_port = pacs_port
+        self.called_aet = called_aet
+        self.max_requests = max_requests
+        self.handlers = [(evt.EVT_C_STORE, handle_store)]
+        self.roles = storage_roles()
+        self.assoc = None
+        self.requests = 0
+        self.opened = 0
+        self.rejected = 0
+        self.slot_holder = None
+        self.last_setup_seconds = 0.0
+
+    def acquire(self):
+        """Return an established association, opening a new one if needed."""
+        self.last_setup_seconds = 0.0
+        if self.assoc is not None and self.assoc.is_established:
+            if not self.max_requests or self.requests < self.max_requests:
+                self.requests += 1
+                return self.assoc
+        self.close()
+
+        started = time.monotonic()
+        if pacs_slots is not None:
+            self.slot_holder = pacs_slots.acquire()
+        self.assoc = self.ae.associate(self.pacs_address, self.pacs_port, ae_title=self.called_aet,
+                                       ext_neg=self.roles, evt_handlers=self.handlers)
+        self.last_setup_seconds = time.monotonic() - started
+        if self.assoc.is_established:
+            self.opened += 1
+            self.requests = 1
+        else:
+            self.rejected += 1
+            self._release_slot()
+        return self.assoc
+
+    def _release_slot(self):
+        if self.slot_holder is not None:
+            pacs_slots.release(self.slot_holder)
+            self.slot_holder = None
+
+    def close(self):
+        """Release the current association if it is still up."""
+        if self.assoc is not None and self.assoc.is_established:
+            self.assoc.release()
+        self.assoc = None
+        self.requests = 0
+        self._release_slot()
+
+
+# SOPInstanceUIDs per IMAGE-level C-GET when resuming a partial series
+RESUME_CHUNK_SIZE = 100
+
+def find_series_dir(conn, patient_id, series_instance_uid):
+    """Find the directory a series was (partially) downloaded to, if any."""
+    short_uid = '.'.join(series_instance_uid.split('.')[6:])
+    location = series_location(conn, series_instance_uid) or (None, None)
+    return locate_series(conn, storage_dir, patient_id, series_instance_uid, short_uid, *location, DOWNLOADED)
+
+
+def local_sop_instance_uids(series_dir):
+    """SOPInstanceUIDs already on disk, taken from the <SOPInstanceUID>.dcm file names."""
+    return {filename[:-4] for filename in os.listdir(series_dir) if filename.endswith('.dcm')}
+
+
+def remote_sop_instance_uids(assoc, patient_id, study_instance_uid, series_instance_uid):
+    """List the SOPInstanceUIDs the PACS holds for a series with an IMAGE-level C-FIND."""
+    ds = Dataset()
+    ds.QueryRetrieveLevel = 'IMAGE'
+    ds.PatientID = patient_id
+    ds.StudyInstanceUID = study_instance_uid
+    ds.SeriesInstanceUID = series_instance_uid
+    ds.SOPInstanceUID = ''
+
+    uids = set()
+    for (status, identifier) in assoc.send_c_find(ds, PatientRootQueryRetrieveInformationModelFind):
+        if not status:
+            raise PacsError(DIMSE_TIMEOUT, f"IMAGE-level C-FIND for {series_instance_uid} did not complete")
+        if status.Status in (0xFF00, 0xFF01) and identifier is not None and 'SOPInstanceUID' in identifier:
+            uids.add(identifier.SOPInstanceUID)
+    return uids
+
+
+def resume_requests(assoc, conn, patient_id, study_instance_uid, series_instance_uid):
+    """Build IMAGE-level C-GET identifiers for the instances of a partial series still missing.
+
+    Returns None when nothing is on disk yet, so the whole series is fetched.
+    """
+    series_dir = find_series_dir(conn, patient_id, series_instance_uid)
+    if not series_dir:
+        return None
+    present = local_sop_instance_uids(series_dir)
+    if not present:
+        return None
+
+    missing = sorted(remote_sop_instance_uids(assoc, patient_id, study_instance_uid, series_instance_uid) - present)
+    transfer_totals["skipped"] += len(present)
+    print(f"Resuming {series_instance_uid}: {len(present)} instances on disk, fetching {len(missing)}")
+
+    requests = []
+    for i in range(0, len(missing), RESUME_CHUNK_SIZE):
+        ds = Dataset()
+        ds.QueryRetrieveLevel = 'IMAGE'
+        ds.PatientID = patient_id
+        ds.StudyInstanceUID = study_instance_uid
+        ds.SeriesInstanceUID = series_instance_uid
+        ds.SOPInstanceUID = missing[i:i + RESUME_CHUNK_SIZE]
+        requests.append(ds)
+    return requests
+
+
 # Function to download series data for a given series instance UID
 def download_series(ae, pacs_address, pacs_port, called_aet, local_aet, patient_id, 
                    study_instance_uid, series_instance_uid, series_name, conn,
-                   max_retries=20, wait_time=30):
-    handlers = [(evt.EVT_C_STORE, handle_store)]
-    storage_sop_classes = [CTImageStorage, MRImageStorage, SecondaryCaptureImageStorage]
-    roles = [build_role(sop_class, scp_role=True) for sop_class in storage_sop_classes]
+                   assoc_pool=None, breaker=None, resume=False, timings=None):
+    """Make one attempt at retrieving a series with C-GET.
+
+    When `assoc_pool` is given the C-GET is issued on the pooled association,
+    otherwise a fresh association is opened and released for this series only.
+    With `resume` a series that is already partially on disk only has its
+    missing instances retrieved (loose file downloads only).
+    Failures are raised as PacsError (see pacs_retry) and retries are left to
+    the caller, so a worker can move on to other series in the meantime.
+    When a `timings` dict is given, the seconds spent setting up the
+    association, in C-GETs and flushing queued writes are stored in it, also
+    for a failed attempt.
+    """
+    timings = timings if timings is not None else {}
+    if breaker is not None and not breaker.allow():
+        raise PacsError(CIRCUIT_OPEN, f"not retrieving {series_instance_uid}")
+
+    owns_pool = assoc_pool is None
+    if owns_pool:
+        assoc_pool = PooledAssociation(ae, pacs_address, pacs_port, called_aet, max_requests=1)
     
     ds = Dataset()
     ds.QueryRetrieveLevel = 'SERIES'
@@ -99,39 +506,87 @@ def download_series(ae, pacs_address, pacs_port, called_aet, local_aet, patient_
     ds.StudyInstanceUID = study_instance_uid
     ds.SeriesInstanceUID = series_instance_uid
 
-    retries = 0
-    while retries < max_retries:
-        try:
-            assoc = ae.associate(pacs_address, pacs_port, ae_title=called_aet, 
-                               ext_neg=roles, evt_handlers=handlers)
+    try:
+        assoc = assoc_pool.acquire()
+        timings["association_setup_seconds"] = assoc_pool.last_setup_seconds
 
-            if assoc.is_established:
-                update_download_status(conn, series_instance_uid, 'in_progress')
+        if not assoc.is_established:
+            raise PacsError(classify_association(assoc),
+                            f"association rejected, aborted or never connected for SeriesInstanceUID: {series_instance_uid}")
 
-                responses = assoc.send_c_get(ds, PatientRootQueryRetrieveInformationModelGet)
-                
-                for (status, identifier) in responses:
-                    if status and hasattr(status, 'Status') and status.Status == 0x0000:
-                        break
-                    elif status and hasattr(status, 'Status') and status.Status not in (0xFF00, 0xFF01):
-                        print(f"Failed to retrieve series {patient_id} {series_name} {series_instance_uid}: 0x{status.Status:04X}")
+        update_download_status(conn, series_instance_uid, 'in_progress')
 
-                assoc.release()
-                update_download_status(conn, series_instance_uid, 'complete')
-                break
+        get_requests = None
+        if resume and write_mode == 'files':
+            get_requests = resume_requests(assoc, conn, patient_id, study_instance_uid, series_instance_uid)
+        if get_requests is None:
+            get_requests = [ds]
+
+        c_get_started = time.monotonic()
+        for get_request in get_requests:
+            responses = assoc.send_c_get(get_request, PatientRootQueryRetrieveInformationModelGet)
+            
+            for (status, identifier) in responses:
+                if status and hasattr(status, 'Status') and status.Status == 0x0000:
+                    break
+                elif status and hasattr(status, 'Status') and status.Status not in (0xFF00, 0xFF01):
+                    print(f"Failed to retrieve series {patient_id} {series_name} {series_instance_uid}: 0x{status.Status:04X}")
+        timings["c_get_seconds"] = time.monotonic() - c_get_started
+
+        if store_writer is not None:
+            flush_started = time.monotonic()
+            write_errors = store_writer.flush()
+            timings["write_flush_seconds"] = time.monotonic() - flush_started
+            if write_errors:
+                raise PacsError(FATAL, f"{len(write_errors)} instances failed to write, first: {write_errors[0]}")
+
+        if not assoc.is_established:
+            # The PACS aborted mid-transfer (usually a DIMSE timeout), the next attempt reconnects
+            raise PacsError(DIMSE_TIMEOUT, f"association aborted while retrieving {series_instance_uid}")
+
+        if write_mode == 'zip':
+            zip_path = finalize_archive(series_instance_uid)
+            if zip_path:
+                print(f"Finalized {zip_path}")
+
+        update_download_status(conn, series_instance_uid, 'complete')
+        record_series_location(conn, series_instance_uid)
+
+    except Exception as e:
+        if write_mode == 'zip':
+            if store_writer is not None:
+                # Instances still queued for this series would otherwise land after the discard
+                store_writer.flush()
+            discard_archive(series_instance_uid)
+        if breaker is not None and classify_exception(e, assoc_pool.assoc) in BREAKER_FAILURES:
+            breaker.record_failure()
+        raise
+    else:
+        if breaker is not None:
+            breaker.record_success()
+    finally:
+        if owns_pool:
+            assoc_pool.close()
+
+def record_series_location(conn, series_instance_uid):
+    """Index where a completed series was written, so later stages do not have to search for it."""
+    series_dir = received_series_dirs.pop(series_instance_uid, None)
+    if series_dir is None:
+        # Nothing new received, e.g. a resumed series that was already complete on disk
+        return
+    relpath = os.path.relpath(series_dir, storage_dir)
+    if write_mode == 'zip':
+        zip_path = os.path.join(archive_dir, relpath) + '.zip'
+        record_location(conn, series_instance_uid, relpath, ARCHIVED, os.path.getsize(zip_path))
+    else:
+        record_location(conn, series_instance_uid, relpath, DOWNLOADED, directory_size(series_dir))
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of a list of numbers."""
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
 
-            else:
-                print(f"Association rejected, aborted or never connected for SeriesInstanceUID: {series_instance_uid}")
-
-        except AttributeError as e:
-            print(f"AttributeError: {e}")
-            retries += 1
-            if retries < max_retries:
-                print(f"Retrying in {wait_time} seconds... (Attempt {retries}/{max_retries})")
-                time.sleep(wait_time)
-            else:
-                print(f"Failed to download series {series_instance_uid} after {max_retries} attempts")
-                break
 
 def setup_ae():
     """Initialize and setup the Application Entity"""
@@ -148,79 +603,549 @@ def setup_ae():
     
     return ae
 
-def worker_process():
-    """Worker function for each process with improved error handling and retries"""
+def report_progress(rejections=0):
+    """Send the bytes and instances received since the last report, and any rejections, to the autoscaler."""
+    progress_queue.put({
+        "bytes": transfer_totals["bytes"] - progress_reported["bytes"],
+        "instances": transfer_totals["instances"] - progress_reported["instances"],
+        "rejections": rejections,
+    })
+    progress_reported["bytes"] = transfer_totals["bytes"]
+    progress_reported["instances"] = transfer_totals["instances"]
+
+
+class ConcurrencyController:
+    """Choose how many download workers should be active, between min and max.
+
+    Every scaling window the controller is fed the aggregate MB/s and the
+    number of association rejections seen. Rejections mean the PACS is at
+    its association limit, so a worker is parked. Otherwise it adds one
+    worker at a time and keeps it only if throughput improved by at least
+    `gain_threshold`; after backing off it holds for `hold_windows` windows.
+    """
+
+    def __init__(self, min_workers, max_workers, initial, gain_threshold=0.05, hold_windows=3):
+        self.min_workers = min_workers
+        self.max_workers = max_workers
+        self.target = max(min_workers, min(max_workers, initial))
+        self.gain_threshold = gain_threshold
+        self.hold_windows = hold_windows
+        self.hold = 0
+        self.grew = False
+        self.last_mb_per_s = None
+        self.history = []
+
+    def update(self, mb_per_s, images_per_s, rejections):
+        """Record one window of measurements and return the new target."""
+        previous = self.target
+        if rejections:
+            self.target = max(self.min_workers, self.target - 1)
+            self.grew = False
+            self.hold = self.hold_windows
+            reason = "association_rejections"
+        elif self.grew and self.last_mb_per_s is not None and mb_per_s < self.last_mb_per_s * (1 + self.gain_threshold):
+            self.target = max(self.min_workers, self.target - 1)
+            self.grew = False
+            self.hold = self.hold_windows
+            reason = "no_throughput_gain"
+        elif self.hold > 0:
+            self.hold -= 1
+            self.grew = False
+            reason = "holding"
+        elif self.target < self.max_workers:
+            self.target += 1
+            self.grew = True
+            reason = "probing"
+        else:
+            self.grew = False
+            reason = "at_max"
+
+        # The window just measured ran at `previous` workers, the baseline for the next probe
+        self.last_mb_per_s = mb_per_s
+        self.history.append({
+            "time": current_timestamp(),
+            "workers": previous,
+            "mb_per_s": round(mb_per_s, 2),
+            "images_per_s": round(images_per_s, 2),
+            "rejections": rejections,
+            "next_workers": self.target,
+            "reason": reason,
+        })
+        return self.target
+
+
+def worker_process(claim_batch_size=1, lease_minutes=60, reuse_association=False,
+                   max_requests_per_association=0, async_writes=False, writer_threads=2,
+                   write_queue_size=64, slot=0, control=None, retry_policy=None,
+                   breaker_threshold=5, breaker_reset_seconds=120, resume_partial=False,
+                   scheduling_policy='uid', slot_accounting=False, pacs_max_associations=4,
+                   pacs_bandwidth_mb_s=0, run_id=''):
+    """Worker function for each process with improved error handling and retries.
+
+    Each worker keeps a single database connection open for its lifetime and
+    leases up to `claim_batch_size` series per round trip, in the order given
+    by `scheduling_policy`. With
+    `reuse_association` the worker also keeps one PACS association open and
+    issues all of its C-GETs on it. With `async_writes` received instances
+    are persisted by a StoreWriter instead of inside the C-STORE handler.
+
+    When `control` is given (autoscaling), the worker only claims work while
+    its `slot` is below the controller's target, and reports its throughput
+    every PROGRESS_INSTANCES instances and at the end of every series.
+
+    A series that fails with a retryable error is set aside until its
+    backoff from `retry_policy` has passed, and the worker carries on with
+    the rest of its leased series. While the PACS circuit breaker is open
+    no new work is claimed. With `resume_partial` series that are partly on
+    disk only have their missing instances retrieved. With `slot_accounting`
+    every association holds one of the PACS slots shared with the other
+    scripts, and received bytes are charged against the shared bandwidth
+    budget. Every attempt at a series is recorded in
+    fieldsite.series_download_telemetry under `run_id`. Returns a summary of
+    the work done.
+    """
+    global store_writer, pacs_slots, progress_queue
+    if control is not None:
+        progress_queue = control["stats"]
+        progress_reported.update(bytes=transfer_totals["bytes"], instances=transfer_totals["instances"])
+    if async_writes:
+        store_writer = StoreWriter(num_threads=writer_threads, max_queue=write_queue_size)
+    if slot_accounting:
+        pacs_slots = PacsSlots(db_credentials, PACS_KEY, 'download_series',
+                               max_associations=pacs_max_associations,
+                               bandwidth_mb_s=pacs_bandwidth_mb_s)
+
     ae = setup_ae()
     worker_id = os.getpid()
+    lease_owner = f"{socket.gethostname()}:{worker_id}"
     print(f"Starting worker with pid: {worker_id}")
-    
-    while True:
-        try:
-            with get_db_connection() as conn:
-                series_info = fetch_next_series(conn)
-                
-                if not series_info:
-                    print(f"Worker {worker_id} found no more work, exiting...")
-                    return
-                
-                series_instance_uid, series_name, patient_id, study_instance_uid, numimages = series_info
-                print(f"{current_timestamp()} Worker {worker_id} START: {patient_id} - {series_name} - {numimages}")
-                
-                try:
-                    download_series(
-                        ae, PACS_IP, PACS_PORT, PACS_AET, LOCAL_AET,
-                        patient_id, study_instance_uid, series_instance_uid, 
-                        series_name, conn
-                    )
-                except Exception as e:
-                    print(f"Error downloading series {series_instance_uid}: {e}")
-                    # Update status to failed so it can be retried later
-                    update_download_status(conn, series_instance_uid, 'failed')
+
+    assoc_pool = PooledAssociation(
+        ae, PACS_IP, PACS_PORT, PACS_AET,
+        max_requests=max_requests_per_association if reuse_association else 1
+    )
+    retry_policy = retry_policy or RetryPolicy()
+    breaker = breaker_for(PACS_IP, PACS_PORT, PACS_AET, breaker_threshold, breaker_reset_seconds)
+    # (ready_at, attempts, series_info) for series waiting out their backoff
+    deferred = []
+    series_count = 0
+    failed_count = 0
+    busy_seconds = 0.0
+    # Seconds spent on each completed series, for the latency percentiles
+    series_latencies = []
+
+    def build_report():
+        report = {
+            "worker": worker_id,
+            "series": series_count,
+            "series_failed": failed_count,
+            "circuit_breaker_opened": breaker.times_opened,
+            "associations_opened": assoc_pool.opened,
+            "association_rejections": assoc_pool.rejected,
+            "bytes_received": transfer_totals["bytes"],
+            "instances_received": transfer_totals["instances"],
+            "instances_already_on_disk": transfer_totals["skipped"],
+            "busy_seconds": round(busy_seconds, 1),
+            "mb_per_s": round(transfer_totals["bytes"] / 1e6 / busy_seconds, 2) if busy_seconds else 0.0,
+            "images_per_s": round(transfer_totals["instances"] / busy_seconds, 2) if busy_seconds else 0.0,
+            "series_latency_p50_s": round(percentile(series_latencies, 0.5), 1) if series_latencies else None,
+            "series_latency_p95_s": round(percentile(series_latencies, 0.95), 1) if series_latencies else None,
+        }
+        if store_writer is not None:
+            report["store_writer"] = store_writer.report()
+        if pacs_slots is not None:
+            report["pacs_slot_waits"] = pacs_slots.summary()
+        return report
+
+    conn = None
+    reconnected = False
+    try:
+        while True:
+            try:
+                if control is not None and slot >= control["target"].value and not deferred:
+                    # Parked by the autoscaler, wait until more workers are wanted
+                    if control["drained"].is_set():
+                        return build_report()
+                    time.sleep(5)
                     continue
-                
-                print(f"{current_timestamp()} Worker {worker_id} END: {patient_id} - {series_name} - {numimages}")
-                
-        except Exception as e:
-            print(f"Critical error in worker {worker_id}: {str(e)}")
-            time.sleep(5)  # Add delay before retry
-            continue
+
+                if conn is None or conn.closed:
+                    conn = open_db_connection()
+                    if reconnected:
+                        # Series claimed before the connection dropped and not set aside
+                        # for a retry go back to the queue instead of being renewed forever
+                        released = release_leases(conn, lease_owner, [item[2][0] for item in deferred])
+                        print(f"Worker {worker_id} reconnected, released {released} leased series")
+                        reconnected = False
+
+                now = time.monotonic()
+                work = [(attempts, info) for ready_at, attempts, info in deferred if ready_at <= now]
+                deferred = [item for item in deferred if item[0] > now]
+
+                if not work:
+                    if breaker.retry_after() > 0:
+                        # The PACS is failing, don't lease more series we can't download
+                        renew_lease(conn, lease_owner, lease_minutes)
+                        time.sleep(min(breaker.retry_after(), 5))
+                        continue
+
+                    claimed = fetch_next_series_batch(conn, lease_owner, claim_batch_size, lease_minutes,
+                                                      scheduling_policy)
+                    work = [(0, info) for info in claimed]
+
+                if not work:
+                    if deferred:
+                        renew_lease(conn, lease_owner, lease_minutes)
+                        time.sleep(min(max(min(item[0] for item in deferred) - now, 0), 5))
+                        continue
+                    print(f"Worker {worker_id} found no more work, exiting...")
+                    if control is not None:
+                        control["drained"].set()
+                    return build_report()
+
+                for attempts, series_info in work:
+                    series_instance_uid, series_name, patient_id, study_instance_uid, numimages = series_info
+                    renew_lease(conn, lease_owner, lease_minutes)
+                    print(f"{current_timestamp()} Worker {worker_id} START: {patient_id} - {series_name} - {numimages}")
+                    started = time.monotonic()
+                    bytes_before = transfer_totals["bytes"]
+                    instances_before = transfer_totals["instances"]
+                    rejected_before = assoc_pool.rejected
+                    timings = {}
+                    outcome, error_kind = 'complete', None
+                    # Failed attempts before this one
+                    retries = attempts
+
+                    try:
+                        download_series(
+                            ae, PACS_IP, PACS_PORT, PACS_AET, LOCAL_AET,
+                            patient_id, study_instance_uid, series_instance_uid,
+                            series_name, conn, assoc_pool=assoc_pool, breaker=breaker,
+                            resume=resume_partial, timings=timings
+                        )
+                    except psycopg2.OperationalError:
+                        outcome = None
+                        raise
+                    except Exception as e:
+                        kind = error_kind = classify_exception(e, assoc_pool.assoc)
+                        assoc_pool.close()
+                        if kind == CIRCUIT_OPEN:
+                            # Refused before reaching the PACS, so it doesn't use up an attempt
+                            outcome = 'deferred'
+                            delay = breaker.retry_after()
+                            deferred.append((time.monotonic() + delay, attempts, series_info))
+                            print(f"Deferring series {series_instance_uid} while the circuit is open, retrying in {delay:.0f}s")
+                            continue
+                        attempts += 1
+                        if retry_policy.should_retry(kind, attempts):
+                            outcome = 'deferred'
+                            delay = retry_policy.delay(attempts)
+                            deferred.append((time.monotonic() + delay, attempts, series_info))
+                            print(f"Deferring series {series_instance_uid} after {kind} (attempt {attempts}/{retry_policy.max_attempts}), retrying in {delay:.0f}s")
+                            continue
+                        outcome = 'failed'
+                        print(f"Error downloading series {series_instance_uid}: {e}")
+                        # Update status to failed so it can be retried later
+                        update_download_status(conn, series_instance_uid, 'failed')
+                        failed_count += 1
+                        continue
+                    finally:
+                        if not reuse_association:
+                            assoc_pool.close()
+                        elapsed = time.monotonic() - started
+                        busy_seconds += elapsed
+                        series_bytes = transfer_totals["bytes"] - bytes_before
+                        series_instances = transfer_totals["instances"] - instances_before
+                        if control is not None:
+                            # The rest of the series since the last progress report
+                            report_progress(assoc_pool.rejected - rejected_before)
+                        if outcome is not None:
+                            record_series_telemetry(conn, run_id, {
+                                "seriesinstanceuid": series_instance_uid,
+                                "worker_pid": worker_id,
+                                "outcome": outcome,
+                                "error_kind": error_kind,
+                                "retries": retries,
+                                "association_setup_seconds": timings.get("association_setup_seconds"),
+                                "c_get_seconds": timings.get("c_get_seconds"),
+                                "write_flush_seconds": timings.get("write_flush_seconds"),
+                                "total_seconds": elapsed,
+                                "bytes_received": series_bytes,
+                                "instances_received": series_instances,
+                            })
+
+                    series_count += 1
+                    series_latencies.append(elapsed)
+                    print(f"{current_timestamp()} Worker {worker_id} END: {patient_id} - {series_name} - {numimages}")
+
+            except psycopg2.OperationalError as e:
+                # Connection dropped, the rest of `work` is released once reconnected
+                print(f"Database connection lost in worker {worker_id}: {str(e)}")
+                conn = None
+                reconnected = True
+                time.sleep(5)
+                continue
+            except Exception as e:
+                print(f"Critical error in worker {worker_id}: {str(e)}")
+                time.sleep(5)  # Add delay before retry
+                continue
+    finally:
+        assoc_pool.close()
+        if store_writer is not None:
+            store_writer.close()
+            store_writer = None
+        if pacs_slots is not None:
+            pacs_slots.close()
+            pacs_slots = None
+        if conn is not None and not conn.closed:
+            conn.close()
 
 
 def update_download_status(conn, series_instance_uid, status):
-    """Update the download status in the database."""
+    """Update the download status in the database, releasing the lease once the series is settled."""
     with conn.cursor() as cur:
         cur.execute("""
             UPDATE fieldsite.series
-            SET download_status = %s, date_modified = CURRENT_TIMESTAMP
+            SET download_status = %s,
+                date_modified = CURRENT_TIMESTAMP,
+                lease_owner = CASE WHEN %s IN ('complete', 'failed') THEN NULL ELSE lease_owner END,
+                lease_expires_at = CASE WHEN %s IN ('complete', 'failed') THEN NULL ELSE lease_expires_at END
             WHERE seriesinstanceuid = %s
-        """, (status, series_instance_uid))
+        """, (status, status, status, series_instance_uid))
+        conn.commit()
+
+
+# Columns of fieldsite.series used by the download queue, with their definitions
+QUEUE_COLUMNS = {
+    "lease_owner": "TEXT",
+    "lease_expires_at": "TIMESTAMPTZ",
+    "download_priority": "INTEGER NOT NULL DEFAULT 0",
+}
+
+
+def ensure_queue_columns(conn):
+    """Add the lease and priority columns used by the download queue if they are missing.
+
+    The ALTER only runs for missing columns, as it would lock the queue
+    table against every worker even when there is nothing to add.
+    """
+    missing = missing_columns(conn, 'series', list(QUEUE_COLUMNS))
+    if not missing:
+        return
+    with conn.cursor() as cur:
+        cur.execute(sql.SQL("ALTER TABLE fieldsite.series {}").format(sql.SQL(', ').join(
+            sql.SQL("ADD COLUMN IF NOT EXISTS {} {}").format(sql.Identifier(column), sql.SQL(QUEUE_COLUMNS[column]))
+            for column in missing
+        )))
         conn.commit()
 
 
-def fetch_next_series(conn):
-    """Fetch the next available series from the database with proper transaction handling"""
+def renew_lease(conn, lease_owner, lease_minutes):
+    """Push the lease expiry forward for every series this worker still holds."""
+    with conn.cursor() as cur:
+        cur.execute("""
+            UPDATE fieldsite.series
+            SET lease_expires_at = CURRENT_TIMESTAMP + make_interval(mins => %s)
+            WHERE lease_owner = %s
+              AND download_status IN ('pending', 'in_progress')
+        """, (lease_minutes, lease_owner))
+        conn.commit()
+
+
+def release_leases(conn, lease_owner, keep=()):
+    """Hand the series leased by this worker back to the queue, except those in `keep`.
+
+    Their lease is expired rather than waited out, so any worker can claim
+    them again right away. Returns the number of series released.
+    """
+    with conn.cursor() as cur:
+        cur.execute("""
+            UPDATE fieldsite.series
+            SET lease_owner = NULL,
+                lease_expires_at = CURRENT_TIMESTAMP,
+                date_modified = CURRENT_TIMESTAMP
+            WHERE lease_owner = %s
+              AND download_status IN ('pending', 'in_progress')
+              AND NOT seriesinstanceuid = ANY(%s)
+        """, (lease_owner, list(keep)))
+        released = cur.rowcount
+        conn.commit()
+    return released
+
+
+def ensure_telemetry_table(conn):
+    """Create the per-series download telemetry table if it is missing."""
+    with conn.cursor() as cur:
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS fieldsite.series_download_telemetry (
+                id BIGSERIAL PRIMARY KEY,
+                run_id TEXT NOT NULL,
+                seriesinstanceuid TEXT NOT NULL,
+                worker_pid INTEGER NOT NULL,
+                outcome TEXT NOT NULL,
+                error_kind TEXT,
+                retries INTEGER NOT NULL,
+                association_setup_seconds DOUBLE PRECISION,
+                c_get_seconds DOUBLE PRECISION,
+                write_flush_seconds DOUBLE PRECISION,
+                total_seconds DOUBLE PRECISION NOT NULL,
+                bytes_received BIGINT NOT NULL,
+                instances_received INTEGER NOT NULL,
+                created_at TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP
+            );
+            CREATE INDEX IF NOT EXISTS series_download_telemetry_run_id_idx
+                ON fieldsite.series_download_telemetry (run_id);
+        """)
+        conn.commit()
+
+
+TELEMETRY_COLUMNS = (
+    "seriesinstanceuid", "worker_pid", "outcome", "error_kind", "retries",
+    "association_setup_seconds", "c_get_seconds", "write_flush_seconds",
+    "total_seconds", "bytes_received", "instances_received",
+)
+
+
+def record_series_telemetry(conn, run_id, row):
+    """Store the timings of one attempt at a series. Telemetry never fails a download."""
+    try:
+        with conn.cursor() as cur:
+            cur.execute(
+                sql.SQL("INSERT INTO fieldsite.series_download_telemetry (run_id, {}) VALUES (%s, {})").format(
+                    sql.SQL(', ').join(map(sql.Identifier, TELEMETRY_COLUMNS)),
+                    sql.SQL(', ').join(sql.Placeholder() * len(TELEMETRY_COLUMNS)),
+                ),
+                [run_id] + [row[column] for column in TELEMETRY_COLUMNS]
+            )
+        conn.commit()
+    except psycopg2.Error as e:
+        print(f"Could not record telemetry for {row['seriesinstanceuid']}: {e}")
+        if not conn.closed:
+            conn.rollback()
+
+
+def telemetry_summary(conn, run_id, wall_seconds):
+    """Latency percentiles, phase totals and aggregate throughput of one run."""
+    with conn.cursor() as cur:
+        cur.execute("""
+            SELECT
+                count(*) FILTER (WHERE outcome = 'complete'),
+                count(*) FILTER (WHERE outcome = 'failed'),
+                count(*) FILTER (WHERE outcome = 'deferred'),
+                percentile_cont(0.5) WITHIN GROUP (ORDER BY total_seconds) FILTER (WHERE outcome = 'complete'),
+                percentile_cont(0.95) WITHIN GROUP (ORDER BY total_seconds) FILTER (WHERE outcome = 'complete'),
+                COALESCE(sum(association_setup_seconds), 0),
+                COALESCE(sum(c_get_seconds), 0),
+                COALESCE(sum(write_flush_seconds), 0),
+                COALESCE(sum(total_seconds), 0),
+                COALESCE(sum(bytes_received), 0)
+            FROM fieldsite.series_download_telemetry
+            WHERE run_id = %s
+        """, (run_id,))
+        (complete, failed, deferred, p50, p95, setup_seconds, c_get_seconds,
+         flush_seconds, total_seconds, total_bytes) = cur.fetchone()
+
+    seconds = lambda value: round(float(value), 1) if value is not None else None
+    return {
+        "run_id": run_id,
+        "series_complete": complete,
+        "series_failed": failed,
+        "attempts_deferred": deferred,
+        "series_latency_p50_s": seconds(p50),
+        "series_latency_p95_s": seconds(p95),
+        # Where the workers spent their time, summed over all workers
+        "association_setup_seconds": seconds(setup_seconds),
+        "c_get_seconds": seconds(c_get_seconds),
+        "write_flush_seconds": seconds(flush_seconds),
+        "worker_busy_seconds": seconds(total_seconds),
+        "bytes_received": int(total_bytes),
+        "aggregate_mb_per_s": round(int(total_bytes) / 1e6 / wall_seconds, 2) if wall_seconds else 0.0,
+    }
+
+
+# ORDER BY clauses for the download queue, over the series row `s` in fetch_next_series_batch
+SCHEDULING_POLICIES = {
+    # Historical behaviour, effectively random with respect to date and size
+    'uid': 's.seriesinstanceuid',
+    # Most recently acquired series first so new scans land quickly
+    'newest_first': 's.series_datetime DESC NULLS LAST, s.seriesinstanceuid',
+    # Fewest images first so one huge series can't hold up everything behind it
+    'smallest_first': 's.numberofimages ASC NULLS LAST, s.seriesinstanceuid',
+    # Newest series of every patient, then the second newest of every patient, ...
+    'patient_round_robin': 'c.patient_rank, s.series_datetime DESC NULLS LAST, s.seriesinstanceuid',
+    # Explicit fieldsite.series.download_priority, newest first within a priority
+    'priority': 's.download_priority DESC, s.series_datetime DESC NULLS LAST, s.seriesinstanceuid',
+}
+
+# Policies ordering by the per-patient rank, which needs the whole claimable set ranked first
+RANKED_POLICIES = {'patient_round_robin'}
+
+
+def fetch_next_series_batch(conn, lease_owner, batch_size, lease_minutes, policy='uid'):
+    """Lease up to `batch_size` series for this worker in a single round trip.
+
+    Series whose lease has expired (e.g. the worker holding them crashed) are
+    picked up again alongside new and failed ones. `policy` picks the order
+    in which series are handed out, see SCHEDULING_POLICIES.
+    """
+    order_by = sql.SQL(SCHEDULING_POLICIES[policy])
+    claimable = sql.SQL("""
+        ((s.download_status IS NULL OR s.download_status = '' OR s.download_status = 'failed')
+         OR (s.download_status IN ('pending', 'in_progress')
+             AND s.lease_expires_at < CURRENT_TIMESTAMP))
+    """)
+    if policy in RANKED_POLICIES:
+        # Candidates are ranked without locks (window functions can't be combined
+        # with FOR UPDATE), then locked with SKIP LOCKED
+        next_series = sql.SQL("""
+            WITH candidates AS (
+                SELECT
+                    s.seriesinstanceuid,
+                    p.patient_id,
+                    st.studyinstanceuid,
+                    row_number() OVER (
+                        PARTITION BY p.patient_id
+                        ORDER BY s.series_datetime DESC NULLS LAST
+                    ) AS patient_rank
+                FROM fieldsite.series s
+                JOIN fieldsite.studies st ON s.studyinstanceuid = st.studyinstanceuid
+                JOIN fieldsite.patients p ON st.patient_id = p.patient_id
+                WHERE {claimable}
+            ),
+            next_series AS (
+                SELECT s.seriesinstanceuid, s.seriesdescription, c.patient_id, c.studyinstanceuid, s.numberofimages
+                FROM candidates c
+                JOIN fieldsite.series s ON s.seriesinstanceuid = c.seriesinstanceuid
+                WHERE {claimable}
+                ORDER BY {order_by}
+                FOR UPDATE OF s SKIP LOCKED
+                LIMIT %s
+            )
+        """)
+    else:
+        # Plain indexed ORDER BY ... LIMIT, no pass over the whole queue per lease
+        next_series = sql.SQL("""
+            WITH next_series AS (
+                SELECT s.seriesinstanceuid, s.seriesdescription, p.patient_id, st.studyinstanceuid, s.numberofimages
+                FROM fieldsite.series s
+                JOIN fieldsite.studies st ON s.studyinstanceuid = st.studyinstanceuid
+                JOIN fieldsite.patients p ON st.patient_id = p.patient_id
+                WHERE {claimable}
+                ORDER BY {order_by}
+                FOR UPDATE OF s SKIP LOCKED
+                LIMIT %s
+            )
+        """)
     with conn.cursor() as cur:
         try:
-            # Use SKIP LOCKED to allow multiple workers to fetch different rows
-            cur.execute("""
-                WITH next_series AS (
-                    SELECT 
-                        s.seriesinstanceuid,
-                        s.seriesdescription,
-                        p.patient_id,
-                        st.studyinstanceuid,
-                        s.numberofimages
-                    FROM fieldsite.series s
-                    JOIN fieldsite.studies st ON s.studyinstanceuid = st.studyinstanceuid
-                    JOIN fieldsite.patients p ON st.patient_id = p.patient_id
-                    WHERE (s.download_status IS NULL OR s.download_status = '' OR s.download_status = 'failed')
-                    ORDER BY s.seriesinstanceuid
-                    FOR UPDATE SKIP LOCKED
-                    LIMIT 1
-                )
+            # SKIP LOCKED so multiple workers fetch different rows
+            cur.execute(sql.SQL("""
+                {next_series}
                 UPDATE fieldsite.series s
                 SET 
                     download_status = 'pending',
+                    lease_owner = %s,
+                    lease_expires_at = CURRENT_TIMESTAMP + make_interval(mins => %s),
                     date_modified = CURRENT_TIMESTAMP
                 FROM next_series ns
                 WHERE s.seriesinstanceuid = ns.seriesinstanceuid
@@ -230,34 +1155,140 @@ def fetch_next_series(conn):
                     ns.patient_id,
                     ns.studyinstanceuid,
                     ns.numberofimages;
-            """)
-            
-            result = cur.fetchone()
+            """).format(next_series=next_series.format(claimable=claimable, order_by=order_by)),
+                (batch_size, lease_owner, lease_minutes))
+
+            result = cur.fetchall()
             conn.commit()
             return result
-            
+
+        except psycopg2.OperationalError:
+            raise
         except Exception as e:
             conn.rollback()
-            print(f"Error in fetch_next_series: {e}")
-            return None
+            print(f"Error in fetch_next_series_batch: {e}")
+            return []
+
 
 def main(
         storage_path = '/mnt/blockstorage/debug',
         num_threads = 3,
+        claim_batch_size = 1,
+        lease_minutes = 60,
+        reuse_association = False,
+        max_requests_per_association = 0,
+        async_writes = False,
+        writer_threads = 2,
+        write_queue_size = 64,
+        download_mode = 'files',
+        archive_path = '/blockstorage/dicoms_complete',
+        autoscale = False,
+        min_workers = 1,
+        max_workers = 6,
+        scale_interval_seconds = 60,
+        max_attempts = 8,
+        retry_base_seconds = 5,
+        retry_max_seconds = 300,
+        breaker_threshold = 5,
+        breaker_reset_seconds = 120,
+        resume_partial = False,
+        scheduling_policy = 'uid',
+        slot_accounting = False,
+        pacs_max_associations = 4,
+        pacs_bandwidth_mb_s = 0,
 ):
-    global storage_dir
+    global storage_dir, write_mode, archive_dir
     storage_dir = storage_path
+    write_mode = download_mode
+    archive_dir = archive_path
+
+    if write_mode not in ('files', 'zip'):
+        raise ValueError(f"Unknown download_mode: {download_mode}")
+    if scheduling_policy not in SCHEDULING_POLICIES:
+        raise ValueError(f"Unknown scheduling_policy: {scheduling_policy}")
+    if resume_partial and write_mode == 'zip':
+        print("resume_partial only applies to loose file downloads, series will be fetched in full")
+
+    with get_db_connection() as conn:
+        ensure_queue_columns(conn)
+        ensure_telemetry_table(conn)
+        ensure_locations_table(conn)
+
+    run_id = f"{socket.gethostname()}:{datetime.now().strftime('%Y%m%d%H%M%S')}:{uuid.uuid4().hex[:8]}"
+    run_started = time.monotonic()
 
-    print(f"Starting download process with {num_threads} workers...")
+    print(f"Starting download process with {num_threads} workers (claiming {claim_batch_size} series per lease)...")
+
+    worker_reports = []
+    controller = None
+    pool_size = num_threads
+    manager = None
+    if autoscale:
+        controller = ConcurrencyController(min_workers, max_workers, num_threads)
+        pool_size = max_workers
+        manager = Manager()
+        control = {
+            "target": manager.Value('i', controller.target),
+            "drained": manager.Event(),
+            "stats": manager.Queue(),
+        }
+        print(f"Autoscaling between {min_workers} and {max_workers} workers, starting at {controller.target}")
     
-    with Pool(processes=num_threads) as pool:
+    with Pool(processes=pool_size) as pool:
         try:
-            results = [pool.apply_async(worker_process) for _ in range(num_threads)]
+            worker_options = {
+                "claim_batch_size": claim_batch_size,
+                "lease_minutes": lease_minutes,
+                "reuse_association": reuse_association,
+                "max_requests_per_association": max_requests_per_association,
+                "async_writes": async_writes,
+                "writer_threads": writer_threads,
+                "write_queue_size": write_queue_size,
+                "retry_policy": RetryPolicy(max_attempts, retry_base_seconds, retry_max_seconds),
+                "breaker_threshold": breaker_threshold,
+                "breaker_reset_seconds": breaker_reset_seconds,
+                "resume_partial": resume_partial,
+                "scheduling_policy": scheduling_policy,
+                "slot_accounting": slot_accounting,
+                "pacs_max_associations": pacs_max_associations,
+                "pacs_bandwidth_mb_s": pacs_bandwidth_mb_s,
+                "run_id": run_id,
+            }
+            if autoscale:
+                results = [
+                    pool.apply_async(worker_process, kwds={**worker_options, "slot": slot, "control": control})
+                    for slot in range(pool_size)
+                ]
+                while not all(result.ready() for result in results):
+                    window_start = time.monotonic()
+                    while time.monotonic() - window_start < scale_interval_seconds:
+                        if all(result.ready() for result in results):
+                            break
+                        time.sleep(1)
+                    window = time.monotonic() - window_start
+
+                    window_bytes, window_instances, window_rejections = 0, 0, 0
+                    while True:
+                        try:
+                            stat = control["stats"].get_nowait()
+                        except queue.Empty:
+                            break
+                        window_bytes += stat["bytes"]
+                        window_instances += stat["instances"]
+                        window_rejections += stat["rejections"]
+
+                    target = controller.update(window_bytes / 1e6 / window, window_instances / window, window_rejections)
+                    control["target"].value = target
+                    print(f"{current_timestamp()} Autoscaler: {controller.history[-1]}")
+            else:
+                results = [pool.apply_async(worker_process, kwds=worker_options) for _ in range(pool_size)]
             
             # Wait for all workers to complete
             for result in results:
                 try:
-                    result.get()
+                    report = result.get()
+                    if report:
+                        worker_reports.append(report)
                 except Exception as e:
                     print(f"Worker failed with error: {e}")
                     
@@ -267,5 +1298,24 @@ def main(
         finally:
             pool.close()
             pool.join()
+            if manager is not None:
+                manager.shutdown()
+
+    associations_opened = sum(report["associations_opened"] for report in worker_reports)
+    series_downloaded = sum(report["series"] for report in worker_reports)
+    print(f"All workers completed! {series_downloaded} series over {associations_opened} associations")
+
+    with get_db_connection() as conn:
+        telemetry = telemetry_summary(conn, run_id, time.monotonic() - run_started)
+    print(f"Telemetry: {telemetry}")
 
-    print("All workers completed!")
\ No newline at end of file
+    result = {
+        "series_downloaded": series_downloaded,
+        "associations_opened": associations_opened,
+        "concurrency": controller.target if controller else num_threads,
+        "telemetry": telemetry,
+        "workers": worker_reports,
+    }
+    if controller:
+        result["concurrency_history"] = controller.history
+    return result
\ No newline at end of file
@@ -0,0 +1,69 @@
+import json
+from decimal import Decimal
+import psycopg2
+import wmill
+
+db_credentials = json.loads(wmill.get_variable("f/kobo/vultr_db"))
+db_credentials = db_credentials["db_settings"]
+
+
+def main(
+        hours: int = 168,
+):
+    """Throughput of recent download_series runs from fieldsite.series_download_telemetry.
+
+    One row per run. A large share of time in association setup points at
+    the PACS refusing or queueing associations, a low MB/s during C-GET at
+    the PACS or the network, and time spent flushing writes at our disk.
+    """
+    conn = psycopg2.connect(
+        dbname=db_credentials['dbname'],
+        user=db_credentials['username'],
+        password=db_credentials['password'],
+        host=db_credentials['host'],
+        port=db_credentials['port']
+    )
+    try:
+        with conn.cursor() as cur:
+            cur.execute("""
+                SELECT
+                    run_id,
+                    min(created_at - make_interval(secs => total_seconds)) AS started_at,
+                    max(created_at) AS finished_at,
+                    count(DISTINCT worker_pid) AS workers,
+                    count(*) FILTER (WHERE outcome = 'complete') AS series_complete,
+                    count(*) FILTER (WHERE outcome = 'failed') AS series_failed,
+                    count(*) FILTER (WHERE outcome = 'deferred') AS attempts_deferred,
+                    round((percentile_cont(0.5) WITHIN GROUP (ORDER BY total_seconds)
+                        FILTER (WHERE outcome = 'complete'))::numeric, 1) AS p50_series_s,
+                    round((percentile_cont(0.95) WITHIN GROUP (ORDER BY total_seconds)
+                        FILTER (WHERE outcome = 'complete'))::numeric, 1) AS p95_series_s,
+                    round((sum(bytes_received) / 1e6 / NULLIF(EXTRACT(EPOCH FROM
+                        max(created_at) - min(created_at - make_interval(secs => total_seconds))), 0))::numeric, 2)
+                        AS aggregate_mb_per_s,
+                    round((sum(bytes_received) / 1e6 / NULLIF(sum(c_get_seconds), 0))::numeric, 2)
+                        AS c_get_mb_per_s_per_worker,
+                    round((100 * sum(association_setup_seconds) / NULLIF(sum(total_seconds), 0))::numeric, 1)
+                        AS association_setup_pct,
+                    round((100 * sum(c_get_seconds) / NULLIF(sum(total_seconds), 0))::numeric, 1) AS c_get_pct,
+                    round((100 * sum(write_flush_seconds) / NULLIF(sum(total_seconds), 0))::numeric, 1)
+                        AS write_flush_pct
+                FROM fieldsite.series_download_telemetry
+                WHERE created_at >= CURRENT_TIMESTAMP - make_interval(hours => %s)
+                GROUP BY run_id
+                ORDER BY started_at DESC
+            """, (hours,))
+            columns = [column.name for column in cur.description]
+            runs = []
+            for row in cur.fetchall():
+                run = {}
+                for column, value in zip(columns, row):
+                    if isinstance(value, Decimal):
+                        value = float(value)
+                    elif column in ("started_at", "finished_at"):
+                        value = str(value)
+                    run[column] = value
+                runs.append(run)
+        return runs
+    finally:
+        conn.close()
@@ -1,4 +1,3 @@
-import os
 import zipfile
 import json
 from typing import Optional, Tuple
@@ -6,7 +5,7 @@ import pydicom
 import io
 import psycopg2
 import wmill
-import glob
+from f.dicoms.series_locations import ARCHIVED, ensure_locations_table, ensure_short_uid_column, locate_series
 
 db_credentials = json.loads(wmill.get_variable("f/kobo/vultr_db"))
 db_credentials = db_credentials["db_settings"]
@@ -20,6 +19,8 @@ conn = psycopg2.connect(
     port=db_credentials['port']
 )
 cur = conn.cursor()
+ensure_locations_table(conn)
+ensure_short_uid_column(conn)
 
 def read_random_dicom_from_zip(zip_path: str) -> Optional[Tuple[pydicom.dataset.FileDataset, str, str]]:
     """Read a random DICOM file directly from the zip archive without extracting and return its SeriesInstanceUID."""
@@ -112,15 +113,15 @@ def main(
         select
             st.patient_id,
             s.seriesinstanceuid,
-            (
-                select string_agg(value, '.' order by idx)
-                from unnest(string_to_array(s.seriesinstanceuid, '.')) with ordinality as t(value, idx)
-                where idx > 6
-            ) as seriesuid
+            s.short_uid as seriesuid,
+            sl.relpath,
+            sl.state
         from
             fieldsite.series s
         join fieldsite.studies st on
             s.studyid = st.studyid
+        left join fieldsite.series_locations sl on
+            sl.seriesinstanceuid = s.seriesinstanceuid
         where
             s.file_metadata is null
         order by random() limit %s;
@@ -135,13 +136,13 @@ def main(
         wmill.set_progress(int(index / total_loop * 100))
         index += 1
 
-        patient_id, fullseriesuid, seriesuid = series_info
+        patient_id, fullseriesuid, seriesuid, relpath, state = series_info
 
         resultant = {'seriesuid': seriesuid, 'status': 'failed'}
         print(f"Working on: {series_info}")
-        # Use glob to find directories that end with the series name
-        pattern = os.path.join(dicoms_dir, patient_id, f'*___{seriesuid}.zip')
-        matching_dirs = glob.glob(pattern)
+        # Resolved from fieldsite.series_locations, series not indexed yet are searched for once
+        series_zip = locate_series(conn, dicoms_dir, patient_id, fullseriesuid, seriesuid, relpath, state, ARCHIVED)
+        matching_dirs = [series_zip] if series_zip else []
         print(f"Matching dirs: {matching_dirs}")
 
         if matching_dirs:
@@ -11,6 +11,7 @@ import glob
 import logging
 import tempfile
 import shutil
+from f.dicoms.series_locations import ARCHIVED, ensure_locations_table, ensure_short_uid_column, locate_series
 
 db_credentials = json.loads(wmill.get_variable("f/kobo/vultr_db"))
 db_credentials = db_credentials["db_settings"]
@@ -28,32 +29,26 @@ conn = psycopg2.connect(
     port=db_credentials['port']
 )
 cur = conn.cursor()
+ensure_locations_table(conn)
+ensure_short_uid_column(conn)
 
 # Query all series with download status 'complete' grouped by seriesdescription
 cur.execute("""
 select
 	s2.patient_id,
 	s.seriesinstanceuid,
-	(
-	select
-		string_agg(value,
-		'.'
-	order by
-		idx)
-	from
-		unnest(string_to_array(s.seriesinstanceuid,
-		'.')) with ordinality as t(value,
-		idx)
-	where
-		idx > 6
-        ) as seriesuid,
+	s.short_uid as seriesuid,
 	pc.corrected_patient_id,
 	pc.correct_patient_sex,
-	pc.corrected_patient_name
+	pc.corrected_patient_name,
+	sl.relpath,
+	sl.state
 from
 	fieldsite.series s
 left join fieldsite.studies s2 on
 	s.studyinstanceuid = s2.studyinstanceuid
+left join fieldsite.series_locations sl on
+	sl.seriesinstanceuid = s.seriesinstanceuid
 inner join fieldsite.patientid_corrections pc on
 	s2.patient_id = pc.original_patient
 where
@@ -128,14 +123,14 @@ def main(
         wmill.set_progress(int(index / total_loop * 100))
         index +=1
 
-        patient_id, fullseriesuid, seriesuid, corrected_patient_id, corrected_patient_sex, corrected_patient_name = series_info
+        patient_id, fullseriesuid, seriesuid, corrected_patient_id, corrected_patient_sex, corrected_patient_name, relpath, state = series_info
 
         resultant = {'seriesuid': seriesuid, 'status': 'failed'}
         logger.info(f"Working on: {series_info}")
         
-        # Use glob to find directories that end with the series name
-        pattern = os.path.join(dicoms_dir, patient_id, f'*___{seriesuid}.zip')
-        matching_dirs = glob.glob(pattern)
+        # Resolved from fieldsite.series_locations, series not indexed yet are searched for once
+        series_zip = locate_series(conn, dicoms_dir, patient_id, fullseriesuid, seriesuid, relpath, state, ARCHIVED)
+        matching_dirs = [series_zip] if series_zip else []
         logger.info(f"Matching dirs: {matching_dirs}")
 
         if matching_dirs:
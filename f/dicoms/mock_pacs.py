@@ -0,0 +1,242 @@
+import os
+import socket
+import time
+from datetime import date, timedelta
+from fnmatch import fnmatchcase
+from multiprocessing import Process
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.multival import MultiValue
+from pydicom.uid import ImplicitVRLittleEndian, PYDICOM_ROOT_UID
+from pynetdicom import AE, evt
+from pynetdicom.sop_class import (
+    PatientRootQueryRetrieveInformationModelFind,
+    PatientRootQueryRetrieveInformationModelGet,
+    StudyRootQueryRetrieveInformationModelFind,
+    StudyRootQueryRetrieveInformationModelGet,
+    CTImageStorage,
+    MRImageStorage,
+)
+
+# A local C-FIND/C-GET SCP serving a synthetic catalog of CT and MR series,
+# so the PACS scripts can be measured without the production PACS. Used by
+# benchmark_pacs. Imported with `from f.dicoms.mock_pacs import ...`.
+#
+# The catalog is rebuilt from its parameters wherever it is needed, so the
+# server process and the benchmark agree on every UID without sharing state.
+# Patient IDs follow the THLHP format and UIDs have enough components for
+# the short series UID used in on-disk names.
+
+MOCK_AET = 'MOCKPACS'
+MOCK_UID_ROOT = f"{PYDICOM_ROOT_UID}99"
+
+SOP_CLASSES = {'CT': CTImageStorage, 'MR': MRImageStorage}
+
+
+def build_catalog(num_patients=20, studies_per_patient=2, series_per_study=4, images_per_series=100,
+                  modalities=('CT', 'MR'), days=60):
+    """Patient, study and series records of the synthetic PACS, flattened so each carries its parents' keys."""
+    today = date.today()
+    patients, studies, series = [], [], []
+    for p in range(num_patients):
+        patient = {
+            "PatientID": f"{p + 1:04d}-BM",
+            "PatientName": f"Benchmark^{p + 1:04d}",
+            "PatientSex": 'F' if p % 2 else 'M',
+        }
+        patients.append(patient)
+        for s in range(studies_per_patient):
+            study_date = (today - timedelta(days=(p * studies_per_patient + s) % days)).strftime('%Y%m%d')
+            study = dict(
+                patient,
+                StudyInstanceUID=f"{MOCK_UID_ROOT}.{p + 1}.{s + 1}",
+                StudyID=str(s + 1),
+                StudyDate=study_date,
+                StudyTime='120000',
+                AccessionNumber=f"BM{p + 1:04d}{s + 1:02d}",
+            )
+            studies.append(study)
+            for n in range(series_per_study):
+                modality = modalities[n % len(modalities)]
+                series.append(dict(
+                    study,
+                    SeriesInstanceUID=f"{study['StudyInstanceUID']}.{n + 1}",
+                    SeriesNumber=str(n + 1),
+                    Modality=modality,
+                    SeriesDescription=f"Benchmark {modality} {n + 1}",
+                    SeriesDate=study_date,
+                    SeriesTime=f"12{n % 60:02d}00",
+                    BodyPartExamined='CHEST',
+                    SliceThickness='1.0',
+                    NumberOfSeriesRelatedInstances=str(images_per_series),
+                ))
+    return {"patients": patients, "studies": studies, "series": series, "images_per_series": images_per_series}
+
+
+def series_images(series_record, images_per_series):
+    """IMAGE-level records of one series."""
+    return [
+        dict(series_record, SOPInstanceUID=f"{series_record['SeriesInstanceUID']}.{i + 1}", InstanceNumber=str(i + 1))
+        for i in range(images_per_series)
+    ]
+
+
+def _matches(keyword, value, pattern):
+    """DICOM attribute matching: UID lists, wildcards and DA/TM ranges, universal match when empty."""
+    if isinstance(pattern, (list, tuple, MultiValue)):
+        return not pattern or value in pattern
+    pattern = str(pattern) if pattern is not None else ''
+    if not pattern or pattern == '*':
+        return True
+    value = value or ''
+    if keyword.endswith(('Date', 'Time')) and '-' in pattern:
+        low, high = pattern.split('-', 1)
+        return (not low or value >= low) and (not high or value <= high)
+    if '*' in pattern or '?' in pattern:
+        return fnmatchcase(value, pattern)
+    return value == pattern
+
+
+class MockPacs:
+    """The request handlers of the mock SCP over one catalog."""
+
+    def __init__(self, catalog, latency_ms=0, rows=512, columns=512):
+        self.catalog = catalog
+        self.latency = latency_ms / 1000
+        self.rows = rows
+        self.columns = columns
+        # One 12-bit frame shared by every instance, so serving an image costs no CPU
+        noise = bytearray(os.urandom(rows * columns * 2))
+        noise[1::2] = bytes(byte & 0x0F for byte in noise[1::2])
+        self.pixel_data = bytes(noise)
+
+    def records(self, identifier, level=None):
+        """Catalog records at the identifier's level (or `level`) matching its keys."""
+        level = level or (identifier.QueryRetrieveLevel if 'QueryRetrieveLevel' in identifier else 'PATIENT')
+        keys = [
+            (element.keyword, element.value) for element in identifier
+            if element.keyword and element.keyword not in ('QueryRetrieveLevel', 'SpecificCharacterSet')
+        ]
+        if level == 'IMAGE':
+            series_keys = [(keyword, value) for keyword, value in keys
+                           if keyword not in ('SOPInstanceUID', 'InstanceNumber')]
+            candidates = [
+                image
+                for record in self.catalog["series"]
+                if all(_matches(keyword, record.get(keyword), value) for keyword, value in series_keys)
+                for image in series_images(record, self.catalog["images_per_series"])
+            ]
+        else:
+            candidates = self.catalog[{'PATIENT': 'patients', 'STUDY': 'studies'}.get(level, 'series')]
+        return [record for record in candidates
+                if all(_matches(keyword, record.get(keyword), value) for keyword, value in keys)]
+
+    def response(self, identifier, record):
+        response = Dataset()
+        for element in identifier:
+            if element.keyword in record:
+                response.add_new(element.tag, element.VR, record[element.keyword])
+            else:
+                response.add(element)
+        return response
+
+    def instance(self, record):
+        ds = Dataset()
+        ds.file_meta = FileMetaDataset()
+        ds.file_meta.TransferSyntaxUID = ImplicitVRLittleEndian
+        ds.file_meta.MediaStorageSOPClassUID = SOP_CLASSES.get(record["Modality"], CTImageStorage)
+        ds.file_meta.MediaStorageSOPInstanceUID = record["SOPInstanceUID"]
+        ds.SOPClassUID = ds.file_meta.MediaStorageSOPClassUID
+        ds.SOPInstanceUID = record["SOPInstanceUID"]
+        for keyword in ('PatientID', 'PatientName', 'PatientSex', 'StudyInstanceUID', 'StudyID', 'StudyDate',
+                        'StudyTime', 'AccessionNumber', 'SeriesInstanceUID', 'SeriesNumber', 'Modality',
+                        'SeriesDescription', 'SeriesDate', 'SeriesTime', 'BodyPartExamined', 'SliceThickness',
+                        'InstanceNumber'):
+            setattr(ds, keyword, record[keyword])
+        ds.ImagePositionPatient = [0, 0, float(record["InstanceNumber"])]
+        ds.Rows = self.rows
+        ds.Columns = self.columns
+        ds.SamplesPerPixel = 1
+        ds.PhotometricInterpretation = 'MONOCHROME2'
+        ds.BitsAllocated = 16
+        ds.BitsStored = 12
+        ds.HighBit = 11
+        ds.PixelRepresentation = 0
+        ds.PixelData = self.pixel_data
+        return ds
+
+    def handle_find(self, event):
+        time.sleep(self.latency)
+        identifier = event.identifier
+        for record in self.records(identifier):
+            if event.is_cancelled:
+                yield (0xFE00, None)
+                return
+            yield (0xFF00, self.response(identifier, record))
+
+    def handle_get(self, event):
+        time.sleep(self.latency)
+        identifier = event.identifier
+        if 'QueryRetrieveLevel' in identifier and identifier.QueryRetrieveLevel == 'IMAGE':
+            images = self.records(identifier)
+        else:
+            # Whole series, also for PATIENT and STUDY level retrieves
+            images = [
+                image
+                for record in self.records(identifier, 'SERIES')
+                for image in series_images(record, self.catalog["images_per_series"])
+            ]
+        yield len(images)
+        for record in images:
+            if event.is_cancelled:
+                yield (0xFE00, None)
+                return
+            yield (0xFF00, self.instance(record))
+
+
+def serve(port, catalog_options, latency_ms=0, rows=512, columns=512, max_associations=32):
+    """Run the mock SCP on localhost:`port` until the process is stopped."""
+    pacs = MockPacs(build_catalog(**catalog_options), latency_ms, rows, columns)
+    ae = AE(ae_title=MOCK_AET)
+    ae.maximum_associations = max_associations
+    ae.add_supported_context(PatientRootQueryRetrieveInformationModelFind)
+    ae.add_supported_context(StudyRootQueryRetrieveInformationModelFind)
+    ae.add_supported_context(PatientRootQueryRetrieveInformationModelGet)
+    ae.add_supported_context(StudyRootQueryRetrieveInformationModelGet)
+    # C-GET sends the instances back over the requestor's association
+    for sop_class in SOP_CLASSES.values():
+        ae.add_supported_context(sop_class, scu_role=True, scp_role=True)
+    ae.start_server(('127.0.0.1', port), block=True, evt_handlers=[
+        (evt.EVT_C_FIND, pacs.handle_find),
+        (evt.EVT_C_GET, pacs.handle_get),
+    ])
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_mock_pacs(catalog_options, latency_ms=0, rows=512, columns=512, port=0, timeout=30):
+    """Start the mock SCP in its own process, so it does not compete with the client for the GIL.
+
+    Returns (process, port) once the server accepts connections.
+    """
+    port = port or free_port()
+    process = Process(target=serve, args=(port, catalog_options, latency_ms, rows, columns), daemon=True)
+    process.start()
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=1):
+                return process, port
+        except OSError:
+            if not process.is_alive() or time.monotonic() > deadline:
+                process.terminate()
+                raise RuntimeError(f"Mock PACS did not start on port {port}")
+            time.sleep(0.2)
+
+
+def stop_mock_pacs(process):
+    process.terminate()
+    process.join(timeout=10)
@@ -0,0 +1,155 @@
+import json
+from datetime import datetime, timedelta
+from psycopg2 import extras
+
+# Postgres-backed cache of C-FIND responses, shared by db_insert_studies and
+# db_insert_series. Imported with `from f.dicoms.pacs_cache import CFindCache`.
+#
+# fieldsite.pacs_cfind_cache holds one row per PACS, query level and query
+# key with the rows the PACS answered and when they expire. Answers about
+# studies acquired more than `stable_after_days` ago rarely change and are
+# kept for `stable_ttl_days`; everything else for `ttl_hours`. Rows are
+# stored as JSON with the same serialisation content_hash uses, so a cached
+# row hashes like the original and its upsert is skipped.
+#
+# Expected hit rate: close to 0% on the nightly incremental runs and on full
+# runs, which bypass the cache. An incremental run asks about studies from
+# the last day or so, whose answers it cached itself a day earlier with
+# `ttl_hours`. Those answers are stale by design, as the overlap window is
+# there to catch late series. Hits come from two other cases:
+#  - A rerun within `ttl_hours`, e.g. after a run that failed part way. It
+#    keeps its watermark and asks the same queries again, and only the ones
+#    that failed reach the PACS.
+#  - Studies older than `stable_after_days` that an incremental run picks up
+#    because they were added or changed. These are kept for
+#    `stable_ttl_days`.
+# summary() reports the hits, misses and hit rate of every run.
+
+
+def ensure_cache_table(conn):
+    """Create the C-FIND cache table if it is missing."""
+    with conn.cursor() as cur:
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS fieldsite.pacs_cfind_cache (
+                pacs TEXT NOT NULL,
+                level TEXT NOT NULL,
+                query_key TEXT NOT NULL,
+                rows JSONB NOT NULL,
+                cached_at TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                expires_at TIMESTAMPTZ NOT NULL,
+                PRIMARY KEY (pacs, level, query_key)
+            )
+        """)
+    conn.commit()
+
+
+def invalidate(conn, pacs, level=None, keys=None):
+    """Drop cached responses of one PACS, optionally only for one level and some query keys.
+
+    Returns the number of entries dropped.
+    """
+    query = "DELETE FROM fieldsite.pacs_cfind_cache WHERE pacs = %s"
+    params = [pacs]
+    if level:
+        query += " AND level = %s"
+        params.append(level)
+    if keys is not None:
+        query += " AND query_key = ANY(%s)"
+        params.append([_query_key(key) for key in keys])
+    with conn.cursor() as cur:
+        cur.execute(query, params)
+        dropped = cur.rowcount
+    conn.commit()
+    return dropped
+
+
+def _query_key(key):
+    return json.dumps(list(key) if isinstance(key, tuple) else key)
+
+
+class CFindCache:
+    """Read and write cached C-FIND responses for one PACS.
+
+    Lookups are done in one query per batch of keys. New responses are
+    buffered and written every `write_batch_size` entries and on flush(),
+    which the caller runs once at the end. With `refresh` cached responses
+    are ignored but fresh ones are still stored.
+    """
+
+    def __init__(self, conn, pacs, ttl_hours=24, stable_ttl_days=30, stable_after_days=30,
+                 refresh=False, write_batch_size=500):
+        self.conn = conn
+        self.pacs = pacs
+        self.ttl = timedelta(hours=ttl_hours)
+        self.stable_ttl = timedelta(days=stable_ttl_days)
+        self.stable_before = (datetime.now() - timedelta(days=stable_after_days)).strftime('%Y%m%d')
+        self.refresh = refresh
+        self.write_batch_size = write_batch_size
+        # Keyed by (level, query_key), one upsert cannot touch the same row twice
+        self.pending = {}
+        self.hits = 0
+        self.misses = 0
+        ensure_cache_table(conn)
+
+    def ttl_for(self, study_date=None):
+        """How long to keep the answer to a query about studies from `study_date` (YYYYMMDD)."""
+        if study_date and study_date[:8] < self.stable_before:
+            return self.stable_ttl
+        return self.ttl
+
+    def lookup(self, level, keys):
+        """Split `keys` into ({key: cached rows}, [keys to ask the PACS])."""
+        keys = list(keys)
+        cached = {}
+        if not self.refresh and keys:
+            by_query_key = {_query_key(key): key for key in keys}
+            with self.conn.cursor() as cur:
+                cur.execute("""
+                    SELECT query_key, rows
+                    FROM fieldsite.pacs_cfind_cache
+                    WHERE pacs = %s AND level = %s AND query_key = ANY(%s) AND expires_at > CURRENT_TIMESTAMP
+                """, (self.pacs, level, list(by_query_key)))
+                for query_key, rows in cur.fetchall():
+                    cached[by_query_key[query_key]] = [tuple(row) for row in rows]
+            self.conn.commit()
+        missing = [key for key in keys if key not in cached]
+        self.hits += len(cached)
+        self.misses += len(missing)
+        return cached, missing
+
+    def store(self, level, key, rows, ttl):
+        """Cache the rows the PACS answered for one query."""
+        if ttl <= timedelta(0):
+            return
+        query_key = _query_key(key)
+        self.pending[(level, query_key)] = (self.pacs, level, query_key,
+                                            json.dumps([list(row) for row in rows], default=str), ttl.total_seconds())
+        if len(self.pending) >= self.write_batch_size:
+            self.flush()
+
+    def flush(self):
+        """Write buffered responses and drop expired ones."""
+        with self.conn.cursor() as cur:
+            if self.pending:
+                extras.execute_values(cur, """
+                    INSERT INTO fieldsite.pacs_cfind_cache (pacs, level, query_key, rows, expires_at)
+                    SELECT pacs, level, query_key, rows::jsonb, CURRENT_TIMESTAMP + make_interval(secs => ttl)
+                    FROM (VALUES %s) AS v (pacs, level, query_key, rows, ttl)
+                    ON CONFLICT (pacs, level, query_key) DO UPDATE
+                    SET rows = EXCLUDED.rows,
+                        cached_at = CURRENT_TIMESTAMP,
+                        expires_at = EXCLUDED.expires_at
+                """, list(self.pending.values()))
+                self.pending = {}
+            cur.execute("DELETE FROM fieldsite.pacs_cfind_cache WHERE pacs = %s AND expires_at <= CURRENT_TIMESTAMP",
+                        (self.pacs,))
+        self.conn.commit()
+
+    def summary(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else None,
+            "refresh": self.refresh,
+        }
@@ -0,0 +1,51 @@
+import json
+import psycopg2
+import wmill
+from f.dicoms.pacs_cache import ensure_cache_table, invalidate
+from f.dicoms.pacs_slots import pacs_key
+
+pacs_credentials = wmill.get_resource("f/dicoms/trinidad_pacs")
+db_credentials = json.loads(wmill.get_variable("f/kobo/vultr_db"))
+db_credentials = db_credentials["db_settings"]
+
+
+def main(
+        level: str = '',
+        patient_ids: list = [],
+        study_instance_uids: list = [],
+):
+    """Drop cached C-FIND answers so the next db_insert_studies or db_insert_series run asks the PACS again.
+
+    Without arguments every cached answer of `level` ('studies' or
+    'series'), or of both levels, is dropped. `patient_ids` only drops the
+    study queries of those patients, `study_instance_uids` only the series
+    queries of those studies.
+    """
+    pacs = pacs_key(pacs_credentials)
+    conn = psycopg2.connect(
+        dbname=db_credentials['dbname'],
+        user=db_credentials['username'],
+        password=db_credentials['password'],
+        host=db_credentials['host'],
+        port=db_credentials['port']
+    )
+    try:
+        ensure_cache_table(conn)
+        if not patient_ids and not study_instance_uids:
+            return {"dropped": invalidate(conn, pacs, level or None)}
+
+        dropped = 0
+        if patient_ids:
+            dropped += invalidate(conn, pacs, 'studies', [(patient_id, '') for patient_id in patient_ids])
+        if study_instance_uids:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    SELECT studyinstanceuid, studyid
+                    FROM fieldsite.studies
+                    WHERE studyinstanceuid = ANY(%s)
+                """, (list(study_instance_uids),))
+                keys = cur.fetchall()
+            dropped += invalidate(conn, pacs, 'series', keys)
+        return {"dropped": dropped}
+    finally:
+        conn.close()
@@ -0,0 +1,180 @@
+import json
+import time
+import psycopg2
+from pynetdicom import AE
+from pynetdicom.sop_class import (
+    PatientRootQueryRetrieveInformationModelFind,
+    StudyRootQueryRetrieveInformationModelFind
+)
+import wmill
+from f.dicoms.pacs_retry import RetryPolicy, breaker_for
+from f.dicoms.cfind_engine import CFindEngine
+from f.dicoms.pacs_slots import PacsSlots, pacs_key
+from f.dicoms.pacs_sync import INCREMENTAL, advance_watermark, ensure_content_hash_column, plan_sync, study_dates
+from f.dicoms.pacs_queries import (
+    BatchWriter,
+    detect_thlhp_patient,
+    ensure_series_columns,
+    plan_patient_queries,
+    query_patients,
+    query_studies,
+    query_study_series,
+)
+
+pacs_credentials = wmill.get_resource("f/dicoms/trinidad_pacs")
+db_credentials = json.loads(wmill.get_variable("f/kobo/vultr_db"))
+db_credentials = db_credentials["db_settings"]
+
+# Define the PACS server details
+PACS_IP = pacs_credentials['ip']
+PACS_PORT = pacs_credentials['port']
+PACS_AET = pacs_credentials['aet']
+
+# Queries are tuples whose first element is the level:
+#   ('patients', study_date, patient_id)
+#   ('studies', patient_id, study_date)
+#   ('series', studyinstanceuid, studyid)
+
+
+def run_query(assoc, query):
+    level = query[0]
+    if level == 'patients':
+        return query_patients(assoc, study_date=query[1], patient_id=query[2])
+    if level == 'studies':
+        return query_studies(assoc, patient_id=query[1], study_date=query[2])
+    return query_study_series(assoc, query[1], query[2])
+
+
+def describe_query(query):
+    level = query[0]
+    if level == 'patients':
+        return f"patients {query[2] or '*'} {query[1]}".strip()
+    if level == 'studies':
+        return f"studies of PatientID {query[1]}"
+    return f"series of StudyInstanceUID {query[1]}"
+
+
+def main(
+        custom_patient_ids = [],
+        concurrency = 4,
+        upsert_batch_size = 500,
+        full_sync = False,
+        full_sync_every_days = 7,
+        overlap_days = 1,
+        max_attempts = 5,
+        retry_base_seconds = 5,
+        slot_accounting = False,
+        query_prefix_digits = 1,
+):
+    """Crawl patients, their studies and their series from the PACS in one pipelined pass.
+
+    The study query of a patient is queued as soon as the patient is seen
+    and the series query of a study as soon as the study is seen, all on
+    the same pool of `concurrency` associations. Rows go through one
+    BatchWriter, which writes parents before children.
+
+    Incremental and full runs follow the same watermark rules as the
+    db_insert_* scripts, under their own 'crawler' watermark. An
+    incremental run only asks for studies since the last crawl, except for
+    patients not in the database yet, whose whole history is fetched.
+    """
+    started = time.monotonic()
+    pacs = pacs_key(pacs_credentials)
+    conn = psycopg2.connect(
+        dbname=db_credentials['dbname'],
+        user=db_credentials['username'],
+        password=db_credentials['password'],
+        host=db_credentials['host'],
+        port=db_credentials['port']
+    )
+    pacs_slots = PacsSlots(db_credentials, pacs, 'pacs_crawler') if slot_accounting else None
+
+    try:
+        for table in ('patients', 'studies', 'series'):
+            ensure_content_hash_column(conn, table)
+        ensure_series_columns(conn)
+        plan = plan_sync(conn, pacs, 'crawler', full_sync, full_sync_every_days, overlap_days)
+        with conn.cursor() as cur:
+            cur.execute("SELECT patient_id FROM fieldsite.patients")
+            known_patients = {patient[0] for patient in cur.fetchall()}
+        conn.commit()
+
+        incremental = plan["mode"] == INCREMENTAL
+        queries = [
+            ('patients',) + query
+            for query in plan_patient_queries(custom_patient_ids, study_dates(plan) if incremental else None,
+                                              query_prefix_digits)
+        ]
+        study_range = f"{plan['since'].strftime('%Y%m%d')}-" if incremental else ''
+        print(f"{plan['mode'].capitalize()} crawl since {plan['since'] or 'the beginning'} "
+              f"over {concurrency} associations")
+
+        ae = AE()
+        ae.add_requested_context(PatientRootQueryRetrieveInformationModelFind)
+        ae.add_requested_context(StudyRootQueryRetrieveInformationModelFind)
+        engine = CFindEngine(ae, PACS_IP, PACS_PORT, PACS_AET, concurrency=concurrency,
+                             retry_policy=RetryPolicy(max_attempts, retry_base_seconds),
+                             breaker=breaker_for(PACS_IP, PACS_PORT, PACS_AET), pacs_slots=pacs_slots)
+        writer = BatchWriter(conn, upsert_batch_size)
+
+        seen_patients = set()
+        seen_studies = set()
+        queries_failed = {"patients": 0, "studies": 0, "series": 0}
+
+        for query, rows, error in engine.run(queries, run_query, describe=describe_query):
+            level = query[0]
+            if error is not None:
+                print(f"Giving up on {describe_query(query)}: {error}")
+                queries_failed[level] += 1
+                continue
+
+            if level == 'patients':
+                for row in rows:
+                    patient_id = row[0]
+                    if not patient_id or patient_id in seen_patients:
+                        continue
+                    if not detect_thlhp_patient(patient_id, custom_patient_ids):
+                        continue
+                    seen_patients.add(patient_id)
+                    writer.add('patients', patient_id, row)
+                    # Patients new to the database get their whole history
+                    engine.submit(('studies', patient_id, study_range if patient_id in known_patients else ''))
+
+            elif level == 'studies':
+                for row in rows:
+                    study_instance_uid = row[3]
+                    if study_instance_uid in seen_studies:
+                        continue
+                    seen_studies.add(study_instance_uid)
+                    writer.add('studies', study_instance_uid, row)
+                    engine.submit(('series', study_instance_uid, row[0]))
+
+            else:
+                for row in rows:
+                    writer.add('series', row[1], row)
+
+        writer.flush()
+
+        cfind_report = engine.report()
+        print(f"C-FIND latency: {cfind_report}")
+        for level, counts in writer.counts.items():
+            print(f"{level.capitalize()}: {counts['inserted']} inserted, {counts['updated']} updated, "
+                  f"{counts['unchanged']} unchanged")
+
+        if any(queries_failed.values()):
+            print(f"Failed queries {queries_failed}, keeping the previous watermark so the next run covers them again")
+        advance_watermark(conn, pacs, plan, complete=not any(queries_failed.values()))
+
+        return {
+            "mode": plan["mode"],
+            "since": str(plan["since"]) if plan["since"] else None,
+            "seconds": round(time.monotonic() - started, 1),
+            "queries_failed": queries_failed,
+            "rows": writer.counts,
+            "cfind": cfind_report,
+        }
+    finally:
+        if pacs_slots is not None:
+            print(f"PACS slot waits: {pacs_slots.summary()}")
+            pacs_slots.close()
+        conn.close()
@@ -0,0 +1,353 @@
+from psycopg2 import sql, extras
+from pydicom.dataset import Dataset
+from pynetdicom.sop_class import (
+    PatientRootQueryRetrieveInformationModelFind,
+    StudyRootQueryRetrieveInformationModelFind
+)
+from f.dicoms.pacs_retry import PacsError, DIMSE_TIMEOUT
+from f.dicoms.pacs_sync import content_hash, count_upserts, missing_columns, new_upsert_counts
+
+# C-FIND queries and upserts for the patient, study and series metadata,
+# shared by db_insert_patients, db_insert_studies, db_insert_series and
+# pacs_crawler. Imported with `from f.dicoms.pacs_queries import ...`.
+# Nothing here connects to the PACS or the database at import time.
+
+
+# One above the highest 4-digit THLHP prefix
+THLHP_PREFIX_LIMIT = 5000
+
+
+# Super complex script for detecting patients that are in THLHP cohort
+def detect_thlhp_patient(patient, custom_id):
+    if len(patient) > 5 and patient[4] == '-' and patient[:4].isdigit() and int(patient[:4]) < THLHP_PREFIX_LIMIT:
+        return True
+    if patient in custom_id:
+        print("Adding custom patient:", patient)
+        return True
+    return False
+
+
+def plan_patient_queries(custom_patient_ids, study_dates=None, prefix_digits=1):
+    """Turn the THLHP cohort rule into PatientID matching keys so the PACS does the filtering.
+
+    The 4-digit prefixes below 5000 are covered by wildcard keys fixing the
+    first `prefix_digits` digits ('3???-?*' for 1, '37??-?*' for 2), custom
+    patients are looked up by their exact ID. '?' also matches non-digits,
+    so results still go through detect_thlhp_patient. With `study_dates`
+    every wildcard key is combined with every date; custom patients are
+    looked up without a date as they may have no recent study.
+    Returns (study_date, patient_id) queries for query_patients.
+    """
+    prefix_digits = max(1, min(4, prefix_digits))
+    step = 10 ** (4 - prefix_digits)
+    keys = [
+        f"{prefix:0{prefix_digits}d}" + '?' * (4 - prefix_digits) + '-?*'
+        for prefix in range(THLHP_PREFIX_LIMIT // step)
+    ]
+    queries = [(study_date, key) for study_date in (study_dates or ['']) for key in keys]
+    queries += [('', patient_id) for patient_id in custom_patient_ids]
+    return queries
+
+
+def query_patients(assoc, study_date='', patient_id=''):
+    """C-FIND the patients in the PACS, or only those with a study on `study_date`.
+
+    Without a date this is a PATIENT-level query over the whole PACS, or
+    over the patients matching `patient_id` when given, which may contain
+    wildcards. With a date it is a STUDY-level query returning the patient
+    attributes of that day's studies. Returns (patient_id, patient_name,
+    patient_sex) rows.
+    """
+    # Define the query dataset
+    ds = Dataset()
+    ds.PatientID = patient_id
+    ds.PatientName = ''
+    ds.PatientSex = ''
+    if study_date:
+        ds.QueryRetrieveLevel = 'STUDY'
+        ds.StudyDate = study_date
+        ds.StudyInstanceUID = ''
+        model = StudyRootQueryRetrieveInformationModelFind
+    else:
+        ds.QueryRetrieveLevel = 'PATIENT'
+        model = PatientRootQueryRetrieveInformationModelFind
+
+    rows = []
+    # Send the C-FIND request
+    responses = assoc.send_c_find(ds, model)
+
+    for (status, identifier) in responses:
+        if not status:
+            # An empty status means the association was aborted or timed out
+            raise PacsError(DIMSE_TIMEOUT, f"patient C-FIND for {patient_id or '*'} {study_date} did not complete")
+        if status.Status in (0xFF00, 0xFF01):
+            found_patient_id = identifier.PatientID if 'PatientID' in identifier else None
+            patient_name = str(identifier.PatientName) if 'PatientName' in identifier else None
+            patient_sex = identifier.PatientSex if 'PatientSex' in identifier else None
+            rows.append((found_patient_id, patient_name, patient_sex))
+    return rows
+
+
+def query_studies(assoc, patient_id='', study_date=''):
+    """Run one study-level C-FIND on `assoc` for a patient and/or a StudyDate (or range) and return the study rows found."""
+    # Define the query dataset
+    ds = Dataset()
+    ds.QueryRetrieveLevel = 'STUDY'
+    ds.PatientID = patient_id
+    ds.StudyInstanceUID = ''
+    ds.StudyDate = study_date
+    ds.StudyTime = ''
+    ds.StudyID = ''
+    ds.AccessionNumber = ''
+
+    rows = []
+    # Send the C-FIND request
+    responses = assoc.send_c_find(ds, StudyRootQueryRetrieveInformationModelFind)
+
+    for (status, identifier) in responses:
+        if not status:
+            # An empty status means the association was aborted or timed out
+            raise PacsError(DIMSE_TIMEOUT, f"study C-FIND for {patient_id or study_date} did not complete")
+        if status.Status in (0xFF00, 0xFF01):
+            study_patient_id = identifier.PatientID if 'PatientID' in identifier else patient_id
+            study_id = identifier.StudyID if 'StudyID' in identifier else None
+            study_instance_uid = identifier.StudyInstanceUID if 'StudyInstanceUID' in identifier else None
+            accession_number = identifier.AccessionNumber if 'AccessionNumber' in identifier else None
+            study_date = identifier.StudyDate if 'StudyDate' in identifier else None
+            study_time = identifier.StudyTime if 'StudyTime' in identifier else None
+
+            if study_date and study_time:
+                study_datetime = f"{study_date} {study_time}"
+            elif study_date:
+                study_datetime = study_date
+            elif study_time:
+                study_datetime = study_time
+            else:
+                study_datetime = None
+
+            if study_id and study_patient_id and study_instance_uid:
+                rows.append(
+                    (study_id, study_patient_id, study_datetime, study_instance_uid, accession_number)
+                )
+    return rows
+
+
+# Columns of fieldsite.series filled from a SERIES-level C-FIND, in row
+# order: (column, tag, VR). Entries without a tag are filled from the study
+# being queried or derived from other attributes, see extract_series_rows.
+# Adding an entry here adds the attribute to the query, the extracted rows
+# and the upsert; ensure_series_columns creates the column as TEXT.
+SERIES_COLUMNS = [
+    ('studyid', None, None),
+    ('seriesinstanceuid', 0x0020000E, 'UI'),
+    ('series_datetime', None, None),
+    ('seriesnumber', 0x00200011, 'IS'),
+    ('modality', 0x00080060, 'CS'),
+    ('institutionname', 0x00080080, 'LO'),
+    ('institutionaldepartmentname', 0x00081040, 'LO'),
+    ('seriesdescription', 0x0008103E, 'LO'),
+    ('bodypartexamined', 0x00180015, 'CS'),
+    ('numberofimages', 0x00201209, 'IS'),
+    ('comments_on_radiation_dose', 0x00400310, 'ST'),
+    ('convolution_kernel', 0x00181210, 'SH'),
+    ('protocol_name', 0x00181030, 'LO'),
+    ('slice_thickness', 0x00180050, 'DS'),
+    ('number_of_slices', 0x00540081, 'US'),
+    ('spacing_between_slices', 0x00180088, 'DS'),
+    ('kvp', 0x00180060, 'DS'),
+    ('detector_configuration', 0x00187005, 'CS'),
+    ('aice', 0x10927005, 'CS'),
+    ('aidr_3d_estd', 0x100B7005, 'CS'),
+    ('patient_comments', 0x00104000, 'LT'),
+    ('scan_options', 0x00180022, 'CS'),
+    ('vol', 0x10117005, 'UN'),
+    ('studyinstanceuid', None, None),
+]
+
+# SeriesDate and SeriesTime, combined into series_datetime
+SERIES_DATE_TAG = 0x00080021
+SERIES_TIME_TAG = 0x00080031
+
+SERIES_COLUMN_NAMES = [column for column, _, _ in SERIES_COLUMNS]
+# Row positions and tags of the columns read straight from the identifier
+SERIES_TAG_COLUMNS = [(index, tag) for index, (_, tag, _) in enumerate(SERIES_COLUMNS) if tag is not None]
+SERIES_QUERY_TAGS = [(tag, vr) for _, tag, vr in SERIES_COLUMNS if tag is not None] + [
+    (SERIES_DATE_TAG, 'DA'),
+    (SERIES_TIME_TAG, 'TM'),
+]
+SERIES_UID_INDEX = SERIES_COLUMN_NAMES.index('seriesinstanceuid')
+
+
+def series_query_dataset(studyinstanceuid):
+    """SERIES-level C-FIND identifier asking for every attribute in SERIES_COLUMNS."""
+    ds = Dataset()
+    ds.QueryRetrieveLevel = 'SERIES'
+    ds.StudyInstanceUID = studyinstanceuid
+    for tag, vr in SERIES_QUERY_TAGS:
+        ds.add_new(tag, vr, '')
+    return ds
+
+
+def extract_series_rows(identifiers, studyinstanceuid, studyid):
+    """Turn the identifiers of one C-FIND into fieldsite.series rows in SERIES_COLUMNS order.
+
+    Every attribute is looked up once per identifier; identifiers without a
+    SeriesInstanceUID are dropped.
+    """
+    template = [None] * len(SERIES_COLUMNS)
+    template[SERIES_COLUMN_NAMES.index('studyid')] = studyid
+    template[SERIES_COLUMN_NAMES.index('studyinstanceuid')] = studyinstanceuid
+    datetime_index = SERIES_COLUMN_NAMES.index('series_datetime')
+
+    rows = []
+    for identifier in identifiers:
+        row = list(template)
+        for index, tag in SERIES_TAG_COLUMNS:
+            element = identifier.get(tag)
+            if element is not None:
+                row[index] = element.value
+        if not row[SERIES_UID_INDEX]:
+            continue
+
+        series_date = identifier.get(SERIES_DATE_TAG)
+        series_time = identifier.get(SERIES_TIME_TAG)
+        series_date = series_date.value if series_date is not None else None
+        series_time = series_time.value if series_time is not None else None
+        if series_date and series_time:
+            row[datetime_index] = f"{series_date} {series_time}"
+        else:
+            row[datetime_index] = series_date or series_time or None
+        rows.append(tuple(row))
+    return rows
+
+
+def query_study_series(assoc, studyinstanceuid, studyid):
+    """Run one series-level C-FIND for a study on `assoc` and return the series rows found."""
+    identifiers = []
+    # Send the C-FIND request
+    responses = assoc.send_c_find(series_query_dataset(studyinstanceuid), StudyRootQueryRetrieveInformationModelFind)
+
+    for (status, identifier) in responses:
+        if not status:
+            # An empty status means the association was aborted or timed out
+            raise PacsError(DIMSE_TIMEOUT, f"C-FIND for StudyInstanceUID {studyinstanceuid} did not complete")
+        if status.Status in (0xFF00, 0xFF01) and identifier is not None:
+            identifiers.append(identifier)
+    return extract_series_rows(identifiers, studyinstanceuid, studyid)
+
+
+def upsert_patients(conn, rows, counts):
+    """Insert or update a batch of patient rows and commit it, leaving unchanged patients alone."""
+    with conn.cursor() as cur:
+        returned = extras.execute_values(cur, sql.SQL("""
+            INSERT INTO fieldsite.patients AS t (patient_id, patient_name, patient_sex, content_hash)
+            VALUES %s
+            ON CONFLICT (patient_id) DO UPDATE
+            SET patient_name = EXCLUDED.patient_name,
+                patient_sex = EXCLUDED.patient_sex,
+                content_hash = EXCLUDED.content_hash,
+                date_modified = CURRENT_TIMESTAMP
+            WHERE t.content_hash IS DISTINCT FROM EXCLUDED.content_hash
+            RETURNING (xmax = 0);
+        """), [row + (content_hash(row),) for row in rows], fetch=True)
+    conn.commit()
+    count_upserts(counts, returned, len(rows))
+
+
+def upsert_studies(conn, rows, counts):
+    """Insert or update a batch of study rows and commit it, leaving unchanged studies alone."""
+    insert_query = """
+        INSERT INTO fieldsite.studies AS t (studyid, patient_id, study_datetime, studyinstanceuid, accession_number,
+                                            content_hash)
+        VALUES %s
+        ON CONFLICT (studyinstanceuid) DO UPDATE
+        SET patient_id = EXCLUDED.patient_id,
+            study_datetime = EXCLUDED.study_datetime,
+            studyinstanceuid = EXCLUDED.studyinstanceuid,
+            accession_number = EXCLUDED.accession_number,
+            content_hash = EXCLUDED.content_hash,
+            date_modified = CURRENT_TIMESTAMP
+        WHERE t.content_hash IS DISTINCT FROM EXCLUDED.content_hash
+        RETURNING (xmax = 0);
+    """
+    with conn.cursor() as cur:
+        returned = extras.execute_values(cur, insert_query, [row + (content_hash(row),) for row in rows], fetch=True)
+    conn.commit()
+    count_upserts(counts, returned, len(rows))
+
+
+def ensure_series_columns(conn):
+    """Add any SERIES_COLUMNS missing from fieldsite.series, as TEXT."""
+    missing = missing_columns(conn, 'series', SERIES_COLUMN_NAMES)
+    if not missing:
+        return
+    with conn.cursor() as cur:
+        cur.execute(sql.SQL("ALTER TABLE fieldsite.series {}").format(sql.SQL(', ').join(
+            sql.SQL("ADD COLUMN IF NOT EXISTS {} TEXT").format(sql.Identifier(column))
+            for column in missing
+        )))
+    conn.commit()
+
+
+# Generated from SERIES_COLUMNS, every column but the conflict key is updated
+SERIES_UPSERT = sql.SQL("""
+    INSERT INTO fieldsite.series AS t ({columns}, content_hash)
+    VALUES %s
+    ON CONFLICT (seriesinstanceuid) DO UPDATE
+    SET {updates},
+        content_hash = EXCLUDED.content_hash,
+        date_modified = CURRENT_TIMESTAMP
+    WHERE t.content_hash IS DISTINCT FROM EXCLUDED.content_hash
+    RETURNING (xmax = 0);
+""").format(
+    columns=sql.SQL(', ').join(map(sql.Identifier, SERIES_COLUMN_NAMES)),
+    updates=sql.SQL(', ').join(
+        sql.SQL("{column} = EXCLUDED.{column}").format(column=sql.Identifier(column))
+        for column in SERIES_COLUMN_NAMES if column != 'seriesinstanceuid'
+    ),
+)
+
+
+def upsert_series(conn, rows, counts):
+    """Insert or update a batch of series rows and commit it, leaving unchanged series alone."""
+    with conn.cursor() as cur:
+        returned = extras.execute_values(cur, SERIES_UPSERT, [row + (content_hash(row),) for row in rows], fetch=True)
+    conn.commit()
+    count_upserts(counts, returned, len(rows))
+
+
+# Upsert function per level, parents before children
+UPSERTS = {
+    'patients': upsert_patients,
+    'studies': upsert_studies,
+    'series': upsert_series,
+}
+
+
+class BatchWriter:
+    """Buffer patient, study and series rows and upsert them in batches.
+
+    Rows are keyed by their UID, so a row seen twice before a flush is
+    written once. Flushing a level first flushes the levels above it, so a
+    study is never written before its patient or a series before its study.
+    """
+
+    def __init__(self, conn, batch_size=500):
+        self.conn = conn
+        self.batch_size = batch_size
+        self.buffers = {level: {} for level in UPSERTS}
+        self.counts = {level: new_upsert_counts() for level in UPSERTS}
+
+    def add(self, level, key, row):
+        self.buffers[level][key] = row
+        if len(self.buffers[level]) >= self.batch_size:
+            self.flush(level)
+
+    def flush(self, level='series'):
+        """Upsert and commit everything buffered for `level` and the levels above it."""
+        for parent, upsert in UPSERTS.items():
+            if self.buffers[parent]:
+                upsert(self.conn, list(self.buffers[parent].values()), self.counts[parent])
+                self.buffers[parent] = {}
+            if parent == level:
+                break
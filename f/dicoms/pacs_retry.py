@@ -0,0 +1,172 @@
+import random
+import socket
+import threading
+import time
+
+# Shared retry policy for scripts talking to the PACS. Imported by the other
+# dicoms scripts with `from f.dicoms.pacs_retry import ...`.
+
+# Error classes a PACS operation can fail with
+ASSOCIATION_REJECTED = 'association_rejected'
+DIMSE_TIMEOUT = 'dimse_timeout'
+NETWORK = 'network'
+CIRCUIT_OPEN = 'circuit_open'
+SLOT_TIMEOUT = 'slot_timeout'
+FATAL = 'fatal'
+
+RETRYABLE = {ASSOCIATION_REJECTED, DIMSE_TIMEOUT, NETWORK, CIRCUIT_OPEN, SLOT_TIMEOUT}
+
+# Retryable errors that come from the PACS and count towards opening its
+# circuit breaker. CIRCUIT_OPEN is the breaker refusing locally, so counting
+# it would keep the breaker open for good, and SLOT_TIMEOUT is a wait for a
+# local PACS slot (see pacs_slots) that never reached the PACS.
+BREAKER_FAILURES = {ASSOCIATION_REJECTED, DIMSE_TIMEOUT, NETWORK}
+
+
+class PacsError(Exception):
+    """A failed PACS operation, tagged with the class of error that caused it."""
+
+    def __init__(self, kind, message=''):
+        super().__init__(f"{kind}: {message}" if message else kind)
+        self.kind = kind
+
+    @property
+    def retryable(self):
+        return self.kind in RETRYABLE
+
+
+def classify_association(assoc):
+    """Classify why an association could not be used."""
+    if assoc.is_rejected:
+        return ASSOCIATION_REJECTED
+    return NETWORK
+
+
+def classify_exception(error, assoc=None):
+    """Map an exception raised while talking to the PACS onto an error class.
+
+    pynetdicom surfaces a dropped association as an AttributeError on the
+    empty status it returns, so an AttributeError is only NETWORK when
+    `assoc`, the association the operation ran on, was aborted or is no
+    longer established. Any other AttributeError is a bug and FATAL.
+    """
+    if isinstance(error, PacsError):
+        return error.kind
+    if isinstance(error, socket.timeout):
+        return DIMSE_TIMEOUT
+    if isinstance(error, OSError):
+        return NETWORK
+    if isinstance(error, AttributeError) and assoc is not None and (assoc.is_aborted or not assoc.is_established):
+        return NETWORK
+    return FATAL
+
+
+class RetryPolicy:
+    """Exponential backoff with full jitter: attempt n waits up to base * 2**n, capped at max_delay."""
+
+    def __init__(self, max_attempts=8, base_delay=5.0, max_delay=300.0):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def delay(self, attempt):
+        """Seconds to wait before retrying after `attempt` failed attempts."""
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** max(attempt - 1, 0)))
+
+    def should_retry(self, kind, attempt):
+        return kind in RETRYABLE and attempt < self.max_attempts
+
+
+class CircuitBreaker:
+    """Stop hammering a PACS that keeps failing.
+
+    After `failure_threshold` consecutive failures the breaker opens and
+    `allow()` returns False for `reset_timeout` seconds. After that one trial
+    operation is let through per `reset_timeout`; a success closes the
+    breaker, a failure keeps it open.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=120.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.opened_at = None
+        self.times_opened = 0
+
+    def allow(self):
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at >= self.reset_timeout:
+                # Half-open, let this caller through and hold everyone else back another period
+                self.opened_at = time.monotonic()
+                return True
+            return False
+
+    def retry_after(self):
+        """Seconds until the breaker will let a trial operation through."""
+        with self.lock:
+            if self.opened_at is None:
+                return 0.0
+            return max(0.0, self.reset_timeout - (time.monotonic() - self.opened_at))
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.opened_at is None and self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+                self.times_opened += 1
+            elif self.opened_at is not None:
+                self.opened_at = time.monotonic()
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def breaker_for(pacs_address, pacs_port, called_aet, failure_threshold=5, reset_timeout=120.0):
+    """Return the process-wide circuit breaker for one PACS."""
+    key = (pacs_address, pacs_port, called_aet)
+    with _breakers_lock:
+        if key not in _breakers:
+            _breakers[key] = CircuitBreaker(failure_threshold, reset_timeout)
+        return _breakers[key]
+
+
+def run_with_retry(operation, policy, breaker=None, description=''):
+    """Call `operation()` until it succeeds, retrying retryable errors with backoff.
+
+    Blocks between attempts, so it suits the sequential metadata scripts.
+    Raises the last error once the policy gives up.
+    """
+    attempt = 0
+    while True:
+        if breaker is not None and not breaker.allow():
+            wait = breaker.retry_after()
+            print(f"Circuit open for PACS, waiting {wait:.0f}s before {description}")
+            time.sleep(max(wait, 1.0))
+            continue
+
+        attempt += 1
+        try:
+            result = operation()
+        except Exception as e:
+            kind = classify_exception(e)
+            if breaker is not None and kind in BREAKER_FAILURES:
+                breaker.record_failure()
+            if not policy.should_retry(kind, attempt):
+                raise
+            wait = policy.delay(attempt)
+            print(f"{description} failed with {kind} (attempt {attempt}/{policy.max_attempts}), retrying in {wait:.1f}s")
+            time.sleep(wait)
+            continue
+
+        if breaker is not None:
+            breaker.record_success()
+        return result
@@ -0,0 +1,40 @@
+import json
+import psycopg2
+import wmill
+from f.dicoms.pacs_slots import ensure_slot_tables, wait_report
+
+db_credentials = json.loads(wmill.get_variable("f/kobo/vultr_db"))
+db_credentials = db_credentials["db_settings"]
+
+
+def main(
+        hours: int = 24,
+):
+    """Report how long each script waited for PACS association slots and bandwidth."""
+    conn = psycopg2.connect(
+        dbname=db_credentials['dbname'],
+        user=db_credentials['username'],
+        password=db_credentials['password'],
+        host=db_credentials['host'],
+        port=db_credentials['port']
+    )
+    try:
+        ensure_slot_tables(conn)
+        with conn.cursor() as cur:
+            cur.execute("""
+                SELECT pacs, slot, script, acquired_at, expires_at
+                FROM fieldsite.pacs_slots
+                WHERE holder IS NOT NULL AND expires_at >= CURRENT_TIMESTAMP
+                ORDER BY pacs, slot
+            """)
+            held = [
+                {"pacs": pacs, "slot": slot, "script": script,
+                 "acquired_at": str(acquired_at), "expires_at": str(expires_at)}
+                for pacs, slot, script, acquired_at, expires_at in cur.fetchall()
+            ]
+        return {
+            "waits": wait_report(conn, hours),
+            "held_slots": held,
+        }
+    finally:
+        conn.close()
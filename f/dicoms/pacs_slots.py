@@ -0,0 +1,291 @@
+import os
+import socket
+import threading
+import time
+import uuid
+from decimal import Decimal
+from contextlib import contextmanager
+import psycopg2
+from f.dicoms.pacs_retry import PacsError, SLOT_TIMEOUT
+
+# Postgres-backed accounting of PACS association slots and transfer bandwidth,
+# shared by every script that talks to the same PACS. Imported with
+# `from f.dicoms.pacs_slots import PacsSlots`.
+#
+# fieldsite.pacs_limits holds one row per PACS with the number of concurrent
+# associations it accepts and an optional bandwidth cap, which doubles as the
+# token bucket. The first script to see a PACS creates its row from its own
+# defaults; after that the row is the single source of truth and can be
+# tuned with a plain UPDATE.
+
+
+class SlotTimeout(PacsError):
+    """No PACS association slot came free within the acquire timeout."""
+
+    def __init__(self, message=''):
+        super().__init__(SLOT_TIMEOUT, message)
+
+
+def pacs_key(pacs_credentials):
+    """Identify a PACS the same way in every script."""
+    return f"{pacs_credentials['aet']}@{pacs_credentials['ip']}:{pacs_credentials['port']}"
+
+
+def ensure_slot_tables(conn):
+    """Create the slot, limit and wait tables if they are missing."""
+    with conn.cursor() as cur:
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS fieldsite.pacs_limits (
+                pacs TEXT PRIMARY KEY,
+                max_associations INTEGER NOT NULL,
+                bandwidth_bytes_per_s BIGINT NOT NULL DEFAULT 0,
+                tokens DOUBLE PRECISION NOT NULL DEFAULT 0,
+                tokens_updated_at TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP
+            );
+            CREATE TABLE IF NOT EXISTS fieldsite.pacs_slots (
+                pacs TEXT NOT NULL,
+                slot INTEGER NOT NULL,
+                holder TEXT,
+                script TEXT,
+                acquired_at TIMESTAMPTZ,
+                expires_at TIMESTAMPTZ,
+                PRIMARY KEY (pacs, slot)
+            );
+            CREATE TABLE IF NOT EXISTS fieldsite.pacs_slot_waits (
+                id BIGSERIAL PRIMARY KEY,
+                pacs TEXT NOT NULL,
+                script TEXT NOT NULL,
+                kind TEXT NOT NULL,
+                waited_seconds DOUBLE PRECISION NOT NULL,
+                created_at TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP
+            );
+        """)
+    conn.commit()
+
+
+class PacsSlots:
+    """Acquire association slots and bandwidth for one PACS on behalf of one script.
+
+    Holds its own autocommit connection so slot bookkeeping never mixes with
+    the caller's transactions. A slot is leased for `lease_seconds` and a
+    heartbeat thread renews the leases of held slots every third of that,
+    so a slot stays held through a C-GET or scan of any length; slots of
+    crashed holders become free again once their lease runs out. acquire()
+    gives up after `acquire_timeout_seconds` unless told otherwise.
+    """
+
+    def __init__(self, db_credentials, pacs_key, script, max_associations=4,
+                 bandwidth_mb_s=0, lease_seconds=900, poll_seconds=2.0, burst_seconds=2.0,
+                 accounting_chunk_bytes=8 * 1024 * 1024, acquire_timeout_seconds=3600):
+        self.pacs_key = pacs_key
+        self.script = script
+        self.lease_seconds = lease_seconds
+        self.acquire_timeout_seconds = acquire_timeout_seconds
+        self.poll_seconds = poll_seconds
+        self.burst_seconds = burst_seconds
+        self.accounting_chunk_bytes = accounting_chunk_bytes
+        self.lock = threading.Lock()
+        self.pending_bytes = 0
+        self.held = set()
+        self.heartbeat = None
+        self.stopped = threading.Event()
+        self.waits = {
+            "slot": {"count": 0, "total_seconds": 0.0, "max_seconds": 0.0},
+            "bandwidth": {"count": 0, "total_seconds": 0.0, "max_seconds": 0.0},
+        }
+
+        self.conn = psycopg2.connect(
+            dbname=db_credentials['dbname'],
+            user=db_credentials['username'],
+            password=db_credentials['password'],
+            host=db_credentials['host'],
+            port=db_credentials['port']
+        )
+        ensure_slot_tables(self.conn)
+        self.conn.autocommit = True
+        with self.conn.cursor() as cur:
+            cur.execute("""
+                INSERT INTO fieldsite.pacs_limits (pacs, max_associations, bandwidth_bytes_per_s)
+                VALUES (%s, %s, %s)
+                ON CONFLICT (pacs) DO NOTHING
+            """, (pacs_key, max_associations, int(bandwidth_mb_s * 1e6)))
+            cur.execute("""
+                INSERT INTO fieldsite.pacs_slots (pacs, slot)
+                SELECT l.pacs, generate_series(1, l.max_associations)
+                FROM fieldsite.pacs_limits l
+                WHERE l.pacs = %s
+                ON CONFLICT DO NOTHING
+            """, (pacs_key,))
+
+    def _record_wait(self, kind, waited):
+        stats = self.waits[kind]
+        stats["count"] += 1
+        stats["total_seconds"] += waited
+        stats["max_seconds"] = max(stats["max_seconds"], waited)
+        with self.conn.cursor() as cur:
+            cur.execute("""
+                INSERT INTO fieldsite.pacs_slot_waits (pacs, script, kind, waited_seconds)
+                VALUES (%s, %s, %s, %s)
+            """, (self.pacs_key, self.script, kind, waited))
+
+    def _start_heartbeat(self):
+        if self.heartbeat is None:
+            self.heartbeat = threading.Thread(target=self._renew_held, name='pacs-slot-heartbeat', daemon=True)
+            self.heartbeat.start()
+
+    def _renew_held(self):
+        while not self.stopped.wait(self.lease_seconds / 3):
+            with self.lock:
+                holders = list(self.held)
+            if not holders:
+                continue
+            try:
+                self.renew(*holders)
+            except psycopg2.Error as e:
+                # Retried on the next beat, well before the lease runs out
+                print(f"Renewing PACS slot leases failed: {e}")
+
+    def acquire(self, timeout=None):
+        """Block until an association slot is free and return the holder token for release().
+
+        Raises SlotTimeout after `timeout` seconds, `acquire_timeout_seconds` by default.
+        """
+        if timeout is None:
+            timeout = self.acquire_timeout_seconds
+        holder = f"{self.script}:{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        start = time.monotonic()
+        while True:
+            with self.lock:
+                with self.conn.cursor() as cur:
+                    cur.execute("""
+                        UPDATE fieldsite.pacs_slots ps
+                        SET holder = %s,
+                            script = %s,
+                            acquired_at = CURRENT_TIMESTAMP,
+                            expires_at = CURRENT_TIMESTAMP + make_interval(secs => %s)
+                        WHERE (ps.pacs, ps.slot) = (
+                            SELECT s.pacs, s.slot
+                            FROM fieldsite.pacs_slots s
+                            JOIN fieldsite.pacs_limits l ON l.pacs = s.pacs
+                            WHERE s.pacs = %s
+                              AND s.slot <= l.max_associations
+                              AND (s.holder IS NULL OR s.expires_at < CURRENT_TIMESTAMP)
+                            ORDER BY s.slot
+                            FOR UPDATE OF s SKIP LOCKED
+                            LIMIT 1
+                        )
+                        RETURNING ps.slot
+                    """, (holder, self.script, self.lease_seconds, self.pacs_key))
+                    acquired = cur.fetchone()
+                if acquired:
+                    self.held.add(holder)
+                    self._record_wait("slot", time.monotonic() - start)
+                    self._start_heartbeat()
+                    return holder
+
+            if timeout is not None and time.monotonic() - start >= timeout:
+                raise SlotTimeout(f"No PACS association slot free for {self.script} after {timeout}s")
+            time.sleep(self.poll_seconds)
+
+    def renew(self, *holders):
+        """Extend the leases on slots that are still in use."""
+        with self.lock:
+            with self.conn.cursor() as cur:
+                cur.execute("""
+                    UPDATE fieldsite.pacs_slots
+                    SET expires_at = CURRENT_TIMESTAMP + make_interval(secs => %s)
+                    WHERE pacs = %s AND holder = ANY(%s)
+                """, (self.lease_seconds, self.pacs_key, list(holders)))
+
+    def release(self, holder):
+        with self.lock:
+            self.held.discard(holder)
+            with self.conn.cursor() as cur:
+                cur.execute("""
+                    UPDATE fieldsite.pacs_slots
+                    SET holder = NULL, script = NULL, acquired_at = NULL, expires_at = NULL
+                    WHERE pacs = %s AND holder = %s
+                """, (self.pacs_key, holder))
+
+    @contextmanager
+    def slot(self, timeout=None):
+        """Hold an association slot for the duration of the block."""
+        holder = self.acquire(timeout)
+        try:
+            yield holder
+        finally:
+            self.release(holder)
+
+    def account_bytes(self, nbytes):
+        """Charge received bytes against the PACS bandwidth budget, sleeping when it is overdrawn.
+
+        Bytes are charged in chunks of `accounting_chunk_bytes` so the token
+        bucket is not hit once per instance.
+        """
+        with self.lock:
+            self.pending_bytes += nbytes
+            if self.pending_bytes < self.accounting_chunk_bytes:
+                return
+            charge, self.pending_bytes = self.pending_bytes, 0
+
+            with self.conn.cursor() as cur:
+                cur.execute("""
+                    UPDATE fieldsite.pacs_limits
+                    SET tokens = LEAST(
+                            bandwidth_bytes_per_s * %s,
+                            tokens + bandwidth_bytes_per_s * EXTRACT(EPOCH FROM clock_timestamp() - tokens_updated_at)
+                        ) - %s,
+                        tokens_updated_at = clock_timestamp()
+                    WHERE pacs = %s AND bandwidth_bytes_per_s > 0
+                    RETURNING tokens, bandwidth_bytes_per_s
+                """, (self.burst_seconds, charge, self.pacs_key))
+                bucket = cur.fetchone()
+
+        if bucket and bucket[0] < 0:
+            # Overdrawn, pay the debt back in time before accepting more data
+            waited = -bucket[0] / bucket[1]
+            time.sleep(waited)
+            with self.lock:
+                self._record_wait("bandwidth", waited)
+
+    def summary(self):
+        """In-process wait statistics, for inclusion in a job result."""
+        return {
+            kind: {
+                "count": stats["count"],
+                "total_seconds": round(stats["total_seconds"], 2),
+                "max_seconds": round(stats["max_seconds"], 2),
+            }
+            for kind, stats in self.waits.items()
+        }
+
+    def close(self):
+        self.stopped.set()
+        if self.heartbeat is not None:
+            self.heartbeat.join()
+        self.conn.close()
+
+
+def wait_report(conn, hours=24):
+    """Wait times for slots and bandwidth per script over the last `hours` hours."""
+    with conn.cursor() as cur:
+        cur.execute("""
+            SELECT
+                pacs,
+                script,
+                kind,
+                count(*) AS acquisitions,
+                round(avg(waited_seconds)::numeric, 2) AS avg_wait_s,
+                round(percentile_cont(0.95) WITHIN GROUP (ORDER BY waited_seconds)::numeric, 2) AS p95_wait_s,
+                round(max(waited_seconds)::numeric, 2) AS max_wait_s,
+                round(sum(waited_seconds)::numeric, 2) AS total_wait_s
+            FROM fieldsite.pacs_slot_waits
+            WHERE created_at >= CURRENT_TIMESTAMP - make_interval(hours => %s)
+            GROUP BY pacs, script, kind
+            ORDER BY pacs, total_wait_s DESC
+        """, (hours,))
+        columns = [column.name for column in cur.description]
+        return [
+            {column: (float(value) if isinstance(value, Decimal) else value) for column, value in zip(columns, row)}
+            for row in cur.fetchall()
+        ]
@@ -0,0 +1,153 @@
+import hashlib
+import json
+from datetime import timedelta
+from psycopg2 import sql
+
+# Watermarks for the incremental PACS metadata sync, shared by
+# db_insert_patients, db_insert_studies and db_insert_series. Imported with
+# `from f.dicoms.pacs_sync import ...`.
+#
+# fieldsite.pacs_sync_watermarks holds one row per PACS and level
+# (patients, studies, series) with the time of the last successful run.
+# An incremental run only asks the PACS about studies acquired since that
+# run, minus `overlap_days` for studies that reach the PACS late. Every
+# `full_sync_every_days` days a run reconciles everything instead.
+#
+# Rows also carry a content_hash of the values synced from the PACS, so an
+# upsert only rewrites rows that actually changed.
+
+FULL = 'full'
+INCREMENTAL = 'incremental'
+
+
+def ensure_watermark_table(conn):
+    """Create the sync watermark table if it is missing."""
+    with conn.cursor() as cur:
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS fieldsite.pacs_sync_watermarks (
+                pacs TEXT NOT NULL,
+                level TEXT NOT NULL,
+                synced_at TIMESTAMPTZ NOT NULL,
+                last_full_sync_at TIMESTAMPTZ,
+                PRIMARY KEY (pacs, level)
+            )
+        """)
+    conn.commit()
+
+
+def plan_sync(conn, pacs, level, full_sync=False, full_sync_every_days=7, overlap_days=1):
+    """Decide whether this run is incremental or a full reconciliation.
+
+    Returns a dict with the `mode`, the first StudyDate to query (`since`,
+    None for a full run), the start of the last successful run
+    (`changed_since`, None for a full run) and this run's `started_at`,
+    which becomes the new watermark once the run succeeds.
+    """
+    ensure_watermark_table(conn)
+    with conn.cursor() as cur:
+        cur.execute("SELECT CURRENT_TIMESTAMP")
+        started_at = cur.fetchone()[0]
+        cur.execute("""
+            SELECT synced_at, last_full_sync_at
+            FROM fieldsite.pacs_sync_watermarks
+            WHERE pacs = %s AND level = %s
+        """, (pacs, level))
+        watermark = cur.fetchone()
+    conn.commit()
+
+    plan = {"level": level, "mode": FULL, "since": None, "changed_since": None, "started_at": started_at}
+    if full_sync or watermark is None:
+        return plan
+    synced_at, last_full_sync_at = watermark
+    if last_full_sync_at is None or started_at - last_full_sync_at >= timedelta(days=full_sync_every_days):
+        return plan
+
+    plan["mode"] = INCREMENTAL
+    plan["since"] = (synced_at - timedelta(days=overlap_days)).date()
+    plan["changed_since"] = synced_at
+    return plan
+
+
+def study_dates(plan):
+    """DICOM StudyDate values (YYYYMMDD) from the plan's `since` up to the day the run started."""
+    day = plan["since"]
+    dates = []
+    while day <= plan["started_at"].date():
+        dates.append(day.strftime('%Y%m%d'))
+        day += timedelta(days=1)
+    return dates
+
+
+def advance_watermark(conn, pacs, plan, complete=True):
+    """Record a run, so the next incremental run starts where this one started.
+
+    A run with failed queries (`complete` False) keeps the previous
+    watermark so the next incremental run covers its window again. A full
+    run with failed queries still counts as the periodic full sync, so one
+    bad query does not make every following run a full rescan; the keys it
+    missed are reconciled by the next full run.
+    """
+    if not complete and plan["mode"] != FULL:
+        return
+    with conn.cursor() as cur:
+        cur.execute("""
+            INSERT INTO fieldsite.pacs_sync_watermarks (pacs, level, synced_at, last_full_sync_at)
+            VALUES (%s, %s, %s, %s)
+            ON CONFLICT (pacs, level) DO UPDATE
+            SET synced_at = CASE WHEN %s THEN EXCLUDED.synced_at
+                                 ELSE fieldsite.pacs_sync_watermarks.synced_at END,
+                last_full_sync_at = COALESCE(EXCLUDED.last_full_sync_at,
+                                             fieldsite.pacs_sync_watermarks.last_full_sync_at)
+        """, (pacs, plan["level"], plan["started_at"],
+              plan["started_at"] if plan["mode"] == FULL else None, complete))
+    conn.commit()
+
+
+def content_hash(row):
+    """Stable hash of the values of one row, to tell whether it changed since it was stored."""
+    return hashlib.md5(json.dumps(list(row), default=str).encode()).hexdigest()
+
+
+def missing_columns(conn, table, columns):
+    """The `columns` a fieldsite table does not have yet.
+
+    ALTER TABLE takes an ACCESS EXCLUSIVE lock even when every column
+    exists, which would block the download queue on fieldsite.series, so
+    callers only alter the table when this is non-empty.
+    """
+    with conn.cursor() as cur:
+        cur.execute("""
+            SELECT column_name FROM information_schema.columns
+            WHERE table_schema = 'fieldsite' AND table_name = %s
+        """, (table,))
+        existing = {row[0] for row in cur.fetchall()}
+    conn.commit()
+    return [column for column in columns if column not in existing]
+
+
+def ensure_content_hash_column(conn, table):
+    """Add the content_hash column to a fieldsite table if it is missing."""
+    if not missing_columns(conn, table, ['content_hash']):
+        return
+    with conn.cursor() as cur:
+        cur.execute(sql.SQL("ALTER TABLE {} ADD COLUMN IF NOT EXISTS content_hash TEXT").format(
+            sql.Identifier('fieldsite', table)))
+    conn.commit()
+
+
+def count_upserts(counts, returned, batch_size):
+    """Add one batch to the inserted, updated and unchanged `counts`.
+
+    `returned` are the `RETURNING (xmax = 0)` rows of an upsert whose
+    DO UPDATE is skipped when the content hash did not change, so rows that
+    were left alone are missing from it.
+    """
+    inserted = sum(1 for (was_inserted,) in returned if was_inserted)
+    counts["inserted"] += inserted
+    counts["updated"] += len(returned) - inserted
+    counts["unchanged"] += batch_size - len(returned)
+    return counts
+
+
+def new_upsert_counts():
+    return {"inserted": 0, "updated": 0, "unchanged": 0}
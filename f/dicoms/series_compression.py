@@ -0,0 +1,83 @@
+import os
+import time
+import zipfile
+
+# Compression of series directories into zips, used by compress_series.
+# Imported with `from f.dicoms.series_compression import ...`.
+#
+# compress_directory holds no database connection or other state, so
+# compress_series runs it for several series at once in a process pool.
+# The zip is written through a `buffer_size` buffer to a .part file that is
+# renamed into place once it is complete.
+# Members keep the <patient_id>/<series>/<SOPInstanceUID>.dcm layout the
+# later stages expect.
+
+# Codec name -> zip compression method. zstd inside a zip needs
+# zipfile.ZIP_ZSTANDARD (Python 3.14+), also for the stages reading the zips.
+CODECS = {
+    'stored': zipfile.ZIP_STORED,
+    'deflate': zipfile.ZIP_DEFLATED,
+    'zstd': getattr(zipfile, 'ZIP_ZSTANDARD', None),
+}
+
+# Compression level range of each codec, None where the level has no effect
+LEVELS = {
+    'stored': None,
+    'deflate': (0, 9),
+    'zstd': (-7, 22),
+}
+
+
+def check_codec(codec, level=None):
+    """Raise ValueError for a codec this Python cannot write or a level it does not take."""
+    if codec not in CODECS:
+        raise ValueError(f"Unknown codec {codec!r}, expected one of {sorted(CODECS)}")
+    if CODECS[codec] is None:
+        raise ValueError(f"Codec {codec!r} is not supported by this Python's zipfile")
+    if level is not None and LEVELS[codec] is not None:
+        low, high = LEVELS[codec]
+        if not low <= level <= high:
+            raise ValueError(f"Level {level} is out of range for {codec}, expected {low} to {high}")
+
+
+def compress_directory(job):
+    """Zip one series directory and return its statistics. Runs in a process pool.
+
+    `job` is (series_dir, dest_zip_file, arc_root, codec, level, buffer_size)
+    with members named relative to `arc_root`. Errors are returned in the
+    result rather than raised, so one bad series does not stop the others.
+    """
+    series_dir, dest_zip_file, arc_root, codec, level, buffer_size = job
+    result = {"src_dir": series_dir, "dst_zip": dest_zip_file, "codec": codec, "level": level, "error": None}
+    part_path = dest_zip_file + '.part'
+    started = time.monotonic()
+    files = 0
+    bytes_in = 0
+    try:
+        with open(part_path, 'wb', buffering=buffer_size) as out, \
+                zipfile.ZipFile(out, 'w', compression=CODECS[codec], compresslevel=level) as zipf:
+            for root, dirs, names in os.walk(series_dir):
+                for name in sorted(names):
+                    file_path = os.path.join(root, name)
+                    # ZipFile.write applies the archive's compression and compresslevel
+                    zipf.write(file_path, os.path.relpath(file_path, start=arc_root))
+                    files += 1
+                    bytes_in += os.path.getsize(file_path)
+        os.replace(part_path, dest_zip_file)
+    except Exception as e:
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        result["error"] = f"{type(e).__name__}: {e}"
+        return result
+
+    seconds = time.monotonic() - started
+    bytes_out = os.path.getsize(dest_zip_file)
+    result.update(
+        files=files,
+        bytes_in=bytes_in,
+        bytes_out=bytes_out,
+        seconds=round(seconds, 2),
+        mb_per_s=round(bytes_in / 1e6 / seconds, 1) if seconds else None,
+        ratio=round(bytes_in / bytes_out, 3) if bytes_out else None,
+    )
+    return result
@@ -0,0 +1,134 @@
+import glob
+import os
+from psycopg2 import extras, sql
+
+# Index of where each downloaded series lives on disk, shared by
+# download_series, validate_series, compress_series, thumbnail_generator,
+# extract_dicoms and extract_dicom_metadata. Imported with
+# `from f.dicoms.series_locations import ...`.
+#
+# fieldsite.series_locations holds one row per series with its path
+# relative to the storage root, '<patient_id>/<series_name>___<short uid>',
+# the state it is in and its size. 'downloaded' series are a directory of
+# loose files under the in-progress root, 'archived' series a .zip of the
+# same name under the complete root. Paths are relative because the
+# archives are rsynced to central storage under a different root, where the
+# same relative path still holds.
+#
+# On-disk names end in the short series UID, the components of the
+# SeriesInstanceUID after the sixth. fieldsite.series.short_uid holds it as
+# a generated, indexed column, so stage queries select it instead of
+# splitting every UID.
+#
+# The writers record a series when it lands, so the stages join this table
+# in their queries instead of globbing patient directories. Series written
+# before the index existed are found with one glob and indexed then.
+
+DOWNLOADED = 'downloaded'
+ARCHIVED = 'archived'
+
+# Schema of the index table, benchmark_pacs points it at a scratch schema
+locations_schema = 'fieldsite'
+
+
+def locations_table():
+    return sql.Identifier(locations_schema, 'series_locations')
+
+
+def ensure_locations_table(conn):
+    """Create the series location table if it is missing."""
+    with conn.cursor() as cur:
+        cur.execute(sql.SQL("""
+            CREATE TABLE IF NOT EXISTS {} (
+                seriesinstanceuid TEXT PRIMARY KEY,
+                relpath TEXT NOT NULL,
+                state TEXT NOT NULL,
+                size_bytes BIGINT,
+                updated_at TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP
+            )
+        """).format(locations_table()))
+    conn.commit()
+
+
+def ensure_short_uid_column(conn):
+    """Add the generated short_uid column and its index to fieldsite.series if they are missing."""
+    with conn.cursor() as cur:
+        # ALTER TABLE locks the table even when the column exists, so only run it once
+        cur.execute("""
+            SELECT 1 FROM information_schema.columns
+            WHERE table_schema = 'fieldsite' AND table_name = 'series' AND column_name = 'short_uid'
+        """)
+        if cur.fetchone() is None:
+            cur.execute("""
+                ALTER TABLE fieldsite.series
+                    ADD COLUMN IF NOT EXISTS short_uid TEXT
+                    GENERATED ALWAYS AS (substring(seriesinstanceuid from '^(?:[^.]*[.]){6}(.*)$')) STORED;
+                CREATE INDEX IF NOT EXISTS series_short_uid_idx ON fieldsite.series (short_uid);
+            """)
+    conn.commit()
+
+
+def record_locations(conn, rows):
+    """Insert or update (seriesinstanceuid, relpath, state, size_bytes) rows and commit them."""
+    if not rows:
+        return
+    with conn.cursor() as cur:
+        extras.execute_values(cur, sql.SQL("""
+            INSERT INTO {} (seriesinstanceuid, relpath, state, size_bytes)
+            VALUES %s
+            ON CONFLICT (seriesinstanceuid) DO UPDATE
+            SET relpath = EXCLUDED.relpath,
+                state = EXCLUDED.state,
+                size_bytes = EXCLUDED.size_bytes,
+                updated_at = CURRENT_TIMESTAMP
+        """).format(locations_table()), rows)
+    conn.commit()
+
+
+def record_location(conn, seriesinstanceuid, relpath, state, size_bytes=None):
+    record_locations(conn, [(seriesinstanceuid, relpath, state, size_bytes)])
+
+
+def series_location(conn, seriesinstanceuid):
+    """(relpath, state) of an indexed series, None when it is not indexed."""
+    with conn.cursor() as cur:
+        cur.execute(sql.SQL("SELECT relpath, state FROM {} WHERE seriesinstanceuid = %s").format(locations_table()),
+                    (seriesinstanceuid,))
+        return cur.fetchone()
+
+
+def series_path(root, relpath, state):
+    """Absolute path of an indexed series under `root`: its directory, or its .zip once archived."""
+    return os.path.join(root, relpath + '.zip' if state == ARCHIVED else relpath)
+
+
+def directory_size(path):
+    return sum(entry.stat().st_size for entry in os.scandir(path) if entry.is_file())
+
+
+def locate_series(conn, root, patient_id, seriesinstanceuid, short_uid, relpath, state, wanted_state):
+    """Path of a series in `wanted_state` under `root`, or None.
+
+    Indexed series (`relpath` and `state` from a join on series_locations)
+    resolve with one stat. Series not in the index yet, or no longer at
+    their indexed path (renamed by rename_series, moved or deleted by
+    hand), are looked for with one glob and indexed again when found.
+    """
+    if relpath is not None:
+        if state != wanted_state:
+            return None
+        path = series_path(root, relpath, state)
+        if os.path.exists(path):
+            return path
+
+    suffix = '.zip' if wanted_state == ARCHIVED else ''
+    matches = glob.glob(os.path.join(root, patient_id, f'*___{short_uid}{suffix}'))
+    if not matches:
+        return None
+    path = matches[0]
+    size_bytes = os.path.getsize(path) if wanted_state == ARCHIVED else directory_size(path)
+    relpath = os.path.relpath(path, root)
+    if suffix:
+        relpath = relpath[:-len(suffix)]
+    record_location(conn, seriesinstanceuid, relpath, wanted_state, size_bytes)
+    return path
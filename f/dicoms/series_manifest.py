@@ -0,0 +1,241 @@
+import json
+import os
+import zipfile
+import zlib
+from pydicom import dcmread
+
+# Content checks and manifests of downloaded series, shared by
+# validate_series and compress_series. Imported with
+# `from f.dicoms.series_manifest import ...`.
+#
+# Every file of a series is read once: its header for the checks, and its
+# bytes for a CRC32. fieldsite.series_manifests keeps one compact manifest
+# per series, [SOPInstanceUID, size, CRC32] per instance. A zip stores the
+# size and CRC32 of every member in its central directory, so an archive is
+# verified against the manifest without reading it.
+
+# Attributes needed by the checks, everything else in the header is skipped
+HEADER_TAGS = [
+    'SOPInstanceUID',
+    'SeriesInstanceUID',
+    'InstanceNumber',
+    'ImagePositionPatient',
+    'ImageOrientationPatient',
+    'NumberOfFrames',
+    'PixelData',
+]
+
+CHUNK_SIZE = 1024 * 1024
+
+UNDEFINED_LENGTH = 0xFFFFFFFF
+
+
+def ensure_manifest_table(conn):
+    """Create the series manifest table if it is missing."""
+    with conn.cursor() as cur:
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS fieldsite.series_manifests (
+                seriesinstanceuid TEXT PRIMARY KEY,
+                files INTEGER NOT NULL,
+                total_bytes BIGINT NOT NULL,
+                manifest JSONB NOT NULL,
+                checks JSONB,
+                created_at TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+    conn.commit()
+
+
+def slice_position(ds):
+    """Position of a slice along the normal of its image plane, None without the geometry."""
+    if 'ImagePositionPatient' not in ds or len(ds.ImagePositionPatient) != 3:
+        return None
+    position = [float(value) for value in ds.ImagePositionPatient]
+    if 'ImageOrientationPatient' not in ds or len(ds.ImageOrientationPatient) != 6:
+        return position[2]
+    row = [float(value) for value in ds.ImageOrientationPatient[:3]]
+    column = [float(value) for value in ds.ImageOrientationPatient[3:]]
+    normal = [
+        row[1] * column[2] - row[2] * column[1],
+        row[2] * column[0] - row[0] * column[2],
+        row[0] * column[1] - row[1] * column[0],
+    ]
+    return sum(p * n for p, n in zip(position, normal))
+
+
+def header_entry(dicom_file, name, size):
+    """Facts about one instance from its header; large values such as the pixel data are not read."""
+    entry = {"name": name, "size": size, "frames": 0, "error": None}
+    try:
+        ds = dcmread(dicom_file, defer_size=1024, specific_tags=HEADER_TAGS)
+    except Exception as e:
+        entry["error"] = str(e)
+        return entry
+
+    entry["sop"] = str(ds.SOPInstanceUID) if 'SOPInstanceUID' in ds else None
+    entry["series"] = str(ds.SeriesInstanceUID) if 'SeriesInstanceUID' in ds else None
+    entry["instance"] = int(ds.InstanceNumber) if 'InstanceNumber' in ds and ds.InstanceNumber not in (None, '') else None
+    entry["position"] = slice_position(ds)
+    entry["frames"] = int(ds.NumberOfFrames) if 'NumberOfFrames' in ds and ds.NumberOfFrames else 1
+    # get_item returns the raw element, so the deferred pixel data is not loaded
+    pixel_data = ds.get_item('PixelData') if 'PixelData' in ds else None
+    entry["truncated"] = (
+        pixel_data is not None
+        and pixel_data.length != UNDEFINED_LENGTH
+        and pixel_data.value_tell + pixel_data.length > size
+    )
+    return entry
+
+
+def scan_file(path):
+    """Header facts, size and CRC32 of one DICOM file. Runs in a process pool."""
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        entry = header_entry(f, os.path.basename(path), size)
+        f.seek(0)
+        crc = 0
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            crc = zlib.crc32(chunk, crc)
+    entry["crc"] = crc
+    return entry
+
+
+def scan_directory(series_dir, pool=None):
+    """scan_file every .dcm file of a series directory, over `pool` when given."""
+    files = [entry.path for entry in os.scandir(series_dir) if entry.name.endswith('.dcm')]
+    if pool is None or len(files) < 2:
+        return [scan_file(path) for path in files]
+    return list(pool.imap_unordered(scan_file, files, chunksize=8))
+
+
+def scan_archive(zip_path):
+    """Header facts of every .dcm member of a series zip, with the size and CRC32 from its central directory."""
+    entries = []
+    with zipfile.ZipFile(zip_path, 'r') as zipf:
+        for info in zipf.infolist():
+            if not info.filename.endswith('.dcm'):
+                continue
+            with zipf.open(info) as dicom_file:
+                entry = header_entry(dicom_file, os.path.basename(info.filename), info.file_size)
+            entry["crc"] = info.CRC
+            entries.append(entry)
+    return entries
+
+
+def check_series(entries, seriesinstanceuid):
+    """Content checks over the scanned instances of one series.
+
+    Unreadable or truncated files, duplicate SOPInstanceUIDs and instances
+    of another series are problems that fail validation. Gaps in
+    InstanceNumber or in the slice spacing are reported as warnings, as
+    some series legitimately have them.
+    """
+    readable = [entry for entry in entries if entry["error"] is None]
+    sop_uids = [entry["sop"] for entry in readable]
+    numbers = sorted({entry["instance"] for entry in readable if entry["instance"] is not None})
+    positions = sorted({round(entry["position"], 3) for entry in readable if entry["position"] is not None})
+    spacings = [b - a for a, b in zip(positions, positions[1:])]
+    median_spacing = sorted(spacings)[len(spacings) // 2] if spacings else 0
+
+    checks = {
+        "files": len(entries),
+        "frames": sum(entry["frames"] for entry in readable),
+        "unreadable": len(entries) - len(readable),
+        "truncated": sum(1 for entry in readable if entry["truncated"]),
+        "duplicate_sop_uids": len(sop_uids) - len(set(sop_uids)),
+        "foreign_instances": sum(1 for entry in readable if entry["series"] != seriesinstanceuid),
+        "instance_number_gaps": numbers[-1] - numbers[0] + 1 - len(numbers) if numbers else 0,
+        "slice_position_gaps": sum(1 for spacing in spacings if median_spacing and spacing > 1.5 * median_spacing),
+    }
+    checks["problems"] = [
+        check for check in ("unreadable", "truncated", "duplicate_sop_uids", "foreign_instances") if checks[check]
+    ]
+    checks["warnings"] = [check for check in ("instance_number_gaps", "slice_position_gaps") if checks[check]]
+    return checks
+
+
+def flagged_files(entries, seriesinstanceuid):
+    """File names of the instances behind the problems check_series reports.
+
+    Unreadable, truncated and foreign files, and every file of a duplicated
+    SOPInstanceUID. Removing them lets a resumed download fetch those
+    instances again instead of counting them as present.
+    """
+    sop_counts = {}
+    for entry in entries:
+        if entry["error"] is None:
+            sop_counts[entry["sop"]] = sop_counts.get(entry["sop"], 0) + 1
+    return sorted(
+        entry["name"] for entry in entries
+        if entry["error"] is not None
+        or entry["truncated"]
+        or entry["series"] != seriesinstanceuid
+        or sop_counts[entry["sop"]] > 1
+    )
+
+
+def store_manifest(conn, seriesinstanceuid, entries, checks):
+    """Record the [SOPInstanceUID, size, CRC32] manifest of a series and commit it.
+
+    Instances are keyed by their <SOPInstanceUID>.dcm file name, which is
+    how download_series writes them and how they are named in the zip.
+    """
+    manifest = sorted([entry["name"][:-4], entry["size"], entry["crc"]] for entry in entries)
+    with conn.cursor() as cur:
+        cur.execute("""
+            INSERT INTO fieldsite.series_manifests (seriesinstanceuid, files, total_bytes, manifest, checks)
+            VALUES (%s, %s, %s, %s, %s)
+            ON CONFLICT (seriesinstanceuid) DO UPDATE
+            SET files = EXCLUDED.files,
+                total_bytes = EXCLUDED.total_bytes,
+                manifest = EXCLUDED.manifest,
+                checks = EXCLUDED.checks,
+                created_at = CURRENT_TIMESTAMP
+        """, (seriesinstanceuid, len(manifest), sum(size for _, size, _ in manifest), json.dumps(manifest),
+              json.dumps(checks)))
+    conn.commit()
+
+
+def drop_manifests(conn, seriesinstanceuids):
+    """Delete the manifests of series that failed or were revalidated without one.
+
+    Not committed here. validate_series runs it from its StatusWriter's
+    on_flush, so it commits in the same transaction as those series' statuses.
+    """
+    if not seriesinstanceuids:
+        return
+    with conn.cursor() as cur:
+        cur.execute("DELETE FROM fieldsite.series_manifests WHERE seriesinstanceuid = ANY(%s)",
+                    (list(seriesinstanceuids),))
+
+
+def load_manifest(conn, seriesinstanceuid):
+    """{SOPInstanceUID: (size, CRC32)} of a series, None when it has no manifest."""
+    with conn.cursor() as cur:
+        cur.execute("SELECT manifest FROM fieldsite.series_manifests WHERE seriesinstanceuid = %s",
+                    (seriesinstanceuid,))
+        row = cur.fetchone()
+    conn.commit()
+    if row is None:
+        return None
+    return {sop_uid: (size, crc) for sop_uid, size, crc in row[0]}
+
+
+def verify_archive(zip_path, manifest):
+    """Compare a series zip with its manifest using only the zip's central directory.
+
+    Returns a list of problems, empty when every instance is present with
+    the same size and CRC32.
+    """
+    with zipfile.ZipFile(zip_path, 'r') as zipf:
+        members = {
+            os.path.basename(info.filename)[:-4]: (info.file_size, info.CRC)
+            for info in zipf.infolist() if info.filename.endswith('.dcm')
+        }
+    problems = [f"missing {sop_uid}" for sop_uid in manifest if sop_uid not in members]
+    problems += [
+        f"{sop_uid} differs" for sop_uid, (size, crc) in manifest.items()
+        if sop_uid in members and members[sop_uid] != (size, crc)
+    ]
+    problems += [f"unexpected {sop_uid}" for sop_uid in members if sop_uid not in manifest]
+    return problems
@@ -0,0 +1,59 @@
+from psycopg2 import extras, sql
+
+# Batched writer of per-series pipeline statuses, shared by validate_series
+# and compress_series. Imported with `from f.dicoms.series_status import StatusWriter`.
+#
+# Statuses are keyed by the full SeriesInstanceUID, the primary key of
+# fieldsite.series, and applied with one UPDATE ... FROM (VALUES ...) per
+# batch instead of one UPDATE and commit per series.
+
+
+class StatusWriter:
+    """Buffer status columns per series and write them in batches.
+
+    `columns` are the fieldsite.series columns the stage sets; add() takes
+    one value per column. A series added twice before a flush is written
+    once, with its last values. Call flush() once at the end.
+
+    `on_flush(seriesinstanceuids)`, when given, runs on the same connection
+    before each batch is written, for writes that must commit together with
+    the statuses of those series.
+    """
+
+    def __init__(self, conn, columns, batch_size=200, on_flush=None):
+        self.conn = conn
+        self.columns = list(columns)
+        self.batch_size = batch_size
+        self.on_flush = on_flush
+        self.pending = {}
+        self.written = 0
+        self.query = sql.SQL("""
+            UPDATE fieldsite.series s
+            SET {assignments}, date_modified = CURRENT_TIMESTAMP
+            FROM (VALUES %s) AS v (seriesinstanceuid, {columns})
+            WHERE s.seriesinstanceuid = v.seriesinstanceuid
+        """).format(
+            assignments=sql.SQL(', ').join(
+                sql.SQL("{column} = v.{column}").format(column=sql.Identifier(column)) for column in self.columns
+            ),
+            columns=sql.SQL(', ').join(map(sql.Identifier, self.columns)),
+        )
+
+    def add(self, seriesinstanceuid, *values):
+        if len(values) != len(self.columns):
+            raise ValueError(f"Expected {len(self.columns)} values for {self.columns}, got {len(values)}")
+        self.pending[seriesinstanceuid] = (seriesinstanceuid,) + values
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Write and commit every buffered status."""
+        if not self.pending:
+            return
+        if self.on_flush is not None:
+            self.on_flush(list(self.pending))
+        with self.conn.cursor() as cur:
+            extras.execute_values(cur, self.query, list(self.pending.values()), page_size=self.batch_size)
+            self.written += cur.rowcount
+        self.conn.commit()
+        self.pending = {}
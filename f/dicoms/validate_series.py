@@ -1,10 +1,17 @@
 import os
 import json
+import time
+from multiprocessing import Pool
 import psycopg2
 from psycopg2 import sql
 from pydicom import dcmread
 import wmill
-import glob
+import zipfile
+from f.dicoms.series_locations import ARCHIVED, DOWNLOADED, ensure_locations_table, ensure_short_uid_column, locate_series
+from f.dicoms.series_manifest import (
+    check_series, drop_manifests, ensure_manifest_table, flagged_files, scan_archive, scan_directory, store_manifest
+)
+from f.dicoms.series_status import StatusWriter
 
 pacs_credentials = wmill.get_resource("f/dicoms/trinidad_pacs")
 db_credentials = json.loads(wmill.get_variable("f/kobo/vultr_db"))
@@ -24,59 +31,90 @@ conn = psycopg2.connect(
     port=db_credentials['port']
 )
 cur = conn.cursor()
+ensure_locations_table(conn)
+ensure_short_uid_column(conn)
+ensure_manifest_table(conn)
+
+def count_frames(dicom_file):
+    """Number of slices in one DICOM file, parsing its header only.
+
+    Reading stops at the pixel data and only NumberOfFrames is decoded, so
+    a CT slice costs a few KB of reads instead of the whole file.
+    """
+    ds = dcmread(dicom_file, stop_before_pixels=True, specific_tags=['NumberOfFrames'])
+    if 'NumberOfFrames' in ds and ds.NumberOfFrames:
+        return int(ds.NumberOfFrames)
+    return 1
 
-def get_downloaded_images_count(series_dir):
-    """Count the number of slices in the given series directory."""
+def get_downloaded_images_count(series_dir, pool=None):
+    """Count the number of slices in the given series directory, fanning the files out over `pool` when given."""
+    files = [entry.path for entry in os.scandir(series_dir) if entry.name.endswith('.dcm')]
+    if pool is None or len(files) < 2:
+        return sum(map(count_frames, files))
+    # Chunks keep the per-file inter-process overhead small next to a header read
+    return sum(pool.imap_unordered(count_frames, files, chunksize=32))
+
+def get_archived_images_count(zip_path):
+    """Count the number of slices in a series that was downloaded straight into a zip."""
     count = 0
-    for filename in os.listdir(series_dir):
-        if filename.endswith('.dcm'):
-            filepath = os.path.join(series_dir, filename)
-            ds = dcmread(filepath)
-            if hasattr(ds, 'NumberOfFrames'):
-                count += ds.NumberOfFrames
-            else:
-                count += 1
+    with zipfile.ZipFile(zip_path, 'r') as zipf:
+        for name in zipf.namelist():
+            if name.endswith('.dcm'):
+                with zipf.open(name) as dicom_file:
+                    count += count_frames(dicom_file)
     return count
 
-def update_validation_status(patient_id, seriesuid, status):
-    """Update the validation status in the PostgreSQL database."""
-    cur.execute("""
-        UPDATE fieldsite.series
-        SET validation = %s, date_modified = CURRENT_TIMESTAMP, download_status = %s
-        WHERE seriesinstanceuid LIKE %s AND studyid IN (
-            SELECT studyid FROM fieldsite.studies
-            WHERE patient_id = %s
-        )
-    """, (status, status, f"%{seriesuid}", patient_id))
+def discard_flagged(series_dir, series_zip, entries, seriesinstanceuid):
+    """Remove what failed the content checks and return the number of files removed.
+
+    Otherwise resume_partial in download_series would count the bad
+    instances as present and the series would fail the same way every run.
+    A zip is fetched again in full, so it is removed whole.
+    """
+    if series_zip:
+        os.remove(series_zip)
+        return 1
+    names = flagged_files(entries, seriesinstanceuid)
+    for name in names:
+        os.remove(os.path.join(series_dir, name))
+    return len(names)
 
+# Series whose manifest is deleted in the transaction that writes their status
+stale_manifests = set()
+
+def drop_stale_manifests(seriesinstanceuids):
+    stale = stale_manifests.intersection(seriesinstanceuids)
+    drop_manifests(conn, stale)
+    stale_manifests.difference_update(stale)
+
+# Written in batches on the full SeriesInstanceUID
+status_writer = StatusWriter(conn, ['validation', 'download_status'], on_flush=drop_stale_manifests)
+
+def update_validation_status(seriesinstanceuid, status):
+    """Queue the validation status of a series; failed series go back to the download queue unvalidated."""
     if status == 'failed':
-        cur.execute("""
-        UPDATE fieldsite.series
-        SET validation = '', date_modified = CURRENT_TIMESTAMP, download_status = %s
-        WHERE seriesinstanceuid LIKE %s AND studyid IN (
-            SELECT studyid FROM fieldsite.studies
-            WHERE patient_id = %s
-        )
-        """, (status, f"%{seriesuid}", patient_id))
-    conn.commit()
+        status_writer.add(seriesinstanceuid, '', status)
+    else:
+        status_writer.add(seriesinstanceuid, status, status)
 
 # Query all series with download status 'complete' grouped by seriesdescription
 cur.execute("""
     select
         p.patient_id,
         s.seriesdescription,
-        (
-        select string_agg(value, '.' order by idx)
-        from unnest(string_to_array(s.seriesinstanceuid, '.')) with ordinality as t(value, idx)
-        where idx > 6
-        ) as seriesuid,
-        s.numberofimages
+        s.short_uid as seriesuid,
+        s.numberofimages,
+        s.seriesinstanceuid,
+        sl.relpath,
+        sl.state
     from
         fieldsite.series s
     join fieldsite.studies st on
         s.studyid = st.studyid
     join fieldsite.patients p on
         st.patient_id = p.patient_id
+    left join fieldsite.series_locations sl on
+        sl.seriesinstanceuid = s.seriesinstanceuid
     where
         s.download_status = 'complete'
         and (s.validation = ''
@@ -89,22 +127,64 @@ slices_report = []
 
 # Iterate through each series and compare the downloaded images count with the expected number of images
 def main(
-        storage_dir = '/blockstorage/dicoms_inprogress'
+        storage_dir = '/blockstorage/dicoms_inprogress',
+        archive_dir = '/blockstorage/dicoms_complete',
+        header_workers = 4,
+        content_checks = False,
 ):
+    """Compare the slices on disk with the number of images the PACS reported for every downloaded series.
+
+    Only DICOM headers are read, and the files of a series are spread over
+    `header_workers` processes. Series downloaded with download_mode='zip'
+    are looked for in `archive_dir`, the default archive_path of
+    download_series.
+
+    With `content_checks` every file is also read once for its CRC32, and a
+    series with unreadable or truncated files, duplicate SOPInstanceUIDs or
+    instances of another series fails as invalid_content, and those files
+    (or its zip) are removed so the next download fetches them again. Gaps in
+    InstanceNumber or slice positions are reported without failing. The
+    manifest of each series that passes is stored in
+    fieldsite.series_manifests, where compress_series checks its archive
+    against it. Failed series, and series validated without content checks,
+    have their manifest dropped.
+    """
+    started = time.monotonic()
+    pool = Pool(processes=header_workers) if header_workers > 1 else None
     index = 1
     total_loop = len(series_list)
     for series_info in series_list:
-        patient_id, series_name, seriesuid, expected_num_images = series_info
+        patient_id, series_name, seriesuid, expected_num_images, fullseriesuid, relpath, state = series_info
         print(f"Working on: {series_info}")
-        # Use glob to find directories that end with the series name
-        pattern = os.path.join(storage_dir, patient_id, f'*___{seriesuid}')
-        matching_dirs = glob.glob(pattern)
-        print(f"Matching dirs: {matching_dirs}")
+        # Resolved from fieldsite.series_locations, series not indexed yet are searched for once
+        series_dir = locate_series(conn, storage_dir, patient_id, fullseriesuid, seriesuid, relpath, state, DOWNLOADED)
+        print(f"Series dir: {series_dir}")
 
+        # Series downloaded with download_mode='zip' only exist as an archive
+        series_zip = None
+        if not series_dir and archive_dir:
+            series_zip = locate_series(conn, archive_dir, patient_id, fullseriesuid, seriesuid, relpath, state, ARCHIVED)
+            print(f"Series zip: {series_zip}")
 
-        if not matching_dirs:
+        downloaded_num_images = None
+        checks = None
+        try:
+            if content_checks and (series_dir or series_zip):
+                entries = scan_directory(series_dir, pool) if series_dir else scan_archive(series_zip)
+                checks = check_series(entries, fullseriesuid)
+                downloaded_num_images = checks["frames"]
+            elif series_dir:
+                downloaded_num_images = get_downloaded_images_count(series_dir, pool)
+            elif series_zip:
+                downloaded_num_images = get_archived_images_count(series_zip)
+        except FileNotFoundError:
+            # Indexed, but no longer on disk
+            pass
+
+        if downloaded_num_images is None:
             print(f"Directory does not exist for series: {patient_id} - {series_name} - {seriesuid}")
-            update_validation_status(patient_id, seriesuid, 'failed')
+            stale_manifests.add(fullseriesuid)
+            update_validation_status(fullseriesuid, 'failed')
             wmill.set_progress(int(index / total_loop * 100))
             index +=1
             slices_report.append({
@@ -117,10 +197,22 @@ def main(
             })
             continue
 
-        series_dir = matching_dirs[0]
-        downloaded_num_images = get_downloaded_images_count(series_dir)
-
-        if downloaded_num_images < expected_num_images:
+        if checks and checks["problems"]:
+            removed_files = discard_flagged(series_dir, series_zip, entries, fullseriesuid)
+            slices_report.append({
+                "patient_id": patient_id,
+                "series_name": series_name,
+                "series_uid": seriesuid,
+                "expected_num_images": expected_num_images,
+                "downloaded_num_images": downloaded_num_images,
+                "status": "invalid_content",
+                "checks": checks,
+                "removed_files": removed_files
+            })
+            print(f"Failed content checks {series_info}: {checks['problems']}, removed {removed_files} files")
+            stale_manifests.add(fullseriesuid)
+            update_validation_status(fullseriesuid, 'failed')
+        elif downloaded_num_images < expected_num_images:
             slices_report.append({
                 "patient_id": patient_id,
                 "series_name": series_name,
@@ -130,7 +222,8 @@ def main(
                 "status": "incomplete_download"
             })
             print(f"Failed images count {series_info}")
-            update_validation_status(patient_id, seriesuid, 'failed')
+            stale_manifests.add(fullseriesuid)
+            update_validation_status(fullseriesuid, 'failed')
         else:
             slices_report.append({
                 "patient_id": patient_id,
@@ -138,14 +231,27 @@ def main(
                 "series_uid": seriesuid,
                 "expected_num_images": expected_num_images,
                 "downloaded_num_images": downloaded_num_images,
-                "status": "success"
+                "status": "success",
+                "warnings": checks["warnings"] if checks else []
             })
             print(f"Succeeded on {series_info}")
-            update_validation_status(patient_id, seriesuid, 'complete')
+            # Only a series that passed keeps a manifest for compress_series to check its zip against;
+            # without content checks any manifest from an earlier download is stale
+            if checks is not None:
+                store_manifest(conn, fullseriesuid, entries, checks)
+            else:
+                stale_manifests.add(fullseriesuid)
+            update_validation_status(fullseriesuid, 'complete')
         
         wmill.set_progress(int(index / total_loop * 100))
         index +=1
 
+    status_writer.flush()
+    if pool is not None:
+        pool.close()
+        pool.join()
+    print(f"Validated {total_loop} series in {time.monotonic() - started:.1f}s")
+
     # Print the report
     #for report in missing_slices_report:
     #    print(f"PatientID: {report['patient_id']}, SeriesName: {report['series_name']}, "